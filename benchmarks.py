@@ -0,0 +1,694 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks Module for the Recommendation System.
+
+The benchmarks run offline: Discogs and the Google geocoder are replaced by
+in-process fakes (see FakeDiscogs and FakeGeocoder) answering after a
+configurable latency, with a configurable rate of errors. Each benchmark
+runs in a new process, so that its peak resident memory is its own.
+
+The results can be saved as a baseline JSON file, and compared against it
+on the following runs: a benchmark whose throughput drops by more than the
+tolerance is reported as a regression.
+
+Usage: benchmarks.py [options]
+
+@author: ymiche
+@version: 0.1
+"""
+
+import gc
+import os
+import csv
+import json
+import time
+import shutil
+import random
+import resource
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+import numpy as np
+
+import discogs_client as discogs
+from geopy import geocoders
+
+import song as song_module
+from song import intern_song, clear_songs, distance_songs, GENRE_TAXONOMY, \
+    STYLE_TAXONOMY
+from user_state import UserState, ACTIVITIES, distance_user_states
+from countries import COUNTRY_NAMES
+from cache import MetadataCache
+from text_index import TextIndex
+from writer import UserStateWriter
+from store import UserStateStore
+import parser as parser_module
+
+
+# Query string of the song of the generated rows of the memory benchmark
+BENCHMARK_QUERY = 'Benchmark Artist - Benchmark Song'
+
+# Metadata of the benchmark song, as stored in the cache
+BENCHMARK_DETAILS = ('Rock', 'Pop Rock', 120, 1997, 'UK')
+
+# Default number of rows of the synthetic CSV files
+DEFAULT_SIZES = (10000, 1000000, 10000000)
+
+# Default path of the baseline results
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+# Default relative drop of throughput reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# Number of latencies kept by a _TimedStore to estimate the percentiles, so
+# that its memory does not grow with the number of rows
+RESERVOIR_SIZE = 100000
+
+
+class FakeDiscogs(object):
+    """
+    In-process stand-in for the Discogs API, replacing the Search and
+    Release classes of discogs_client while installed. The release found
+    for a query string, and its metadata, are derived from a hash of the
+    query string, so that they are the same on every run.
+
+    Use it as a context manager, or call install and uninstall.
+
+    Parameters
+    ----------
+    latency             : float
+                        The time, in seconds, every call takes.
+    error_rate          : float
+                        The probability of a call raising a
+                        discogs_client.DiscogsAPIError.
+    seed                : int
+                        The seed of the draws of the errors.
+
+    Attributes
+    ----------
+    calls               : int
+                        The number of calls made.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self._originals = None
+
+    def install(self):
+        self._originals = (discogs.Search, discogs.Release)
+        discogs.Search = self.search
+        discogs.Release = self.release
+
+    def uninstall(self):
+        if self._originals is not None:
+            discogs.Search, discogs.Release = self._originals
+            self._originals = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+
+    def search(self, query_string):
+        """
+        Stands for discogs_client.Search.
+        """
+        return _FakeSearch(self, query_string)
+
+    def release(self, release_id):
+        """
+        Stands for discogs_client.Release.
+        """
+        self.call()
+        seed = int(release_id)
+        data = {'id': release_id,
+                'genres': [GENRE_TAXONOMY.names[seed %
+                                                len(GENRE_TAXONOMY.names)]],
+                'styles': [STYLE_TAXONOMY.names[seed %
+                                                len(STYLE_TAXONOMY.names)]],
+                'year': 1950 + seed % 70,
+                'country': COUNTRY_NAMES[seed % len(COUNTRY_NAMES)],
+               }
+        return _FakeResult(data)
+
+    def call(self):
+        """
+        Waits for the latency, and raises an error at the error rate.
+        """
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise discogs.DiscogsAPIError('Fake Discogs error.')
+
+
+class _FakeSearch(object):
+
+    def __init__(self, service, query_string):
+        self.service = service
+        self.query_string = query_string
+
+    def results(self):
+        self.service.call()
+        release_id = abs(hash(self.query_string)) % 1000000 + 1
+        return [_FakeResult({'id': release_id})]
+
+
+class _FakeResult(object):
+
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeGeocoder(object):
+    """
+    In-process stand-in for the Google geocoder, replacing
+    geopy.geocoders.GoogleV3 while installed. The coordinates of a place
+    are derived from a hash of its name. A failed geocoding returns None,
+    as the real geocoder does when nothing is found.
+
+    Same parameters as FakeDiscogs.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self._original = None
+
+    def install(self):
+        self._original = geocoders.GoogleV3
+        geocoders.GoogleV3 = lambda *args, **kwargs: self
+
+    def uninstall(self):
+        if self._original is not None:
+            geocoders.GoogleV3 = self._original
+            self._original = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+
+    def geocode(self, query):
+        """
+        Stands for GoogleV3.geocode.
+        """
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return None
+        seed = abs(hash(query))
+        return query, (seed % 18000 / 100.0 - 90.0,
+                       seed // 18000 % 36000 / 100.0 - 180.0)
+
+
+class DictUserState(object):
+    """
+    The user state as it was before the slotted UserState: a plain object
+    holding its attributes in a dict. Only used to measure memory.
+    """
+
+    def __init__(self, imei, activity, location, timestamp, song):
+        self.imei = imei
+        self.activity = activity
+        self.location = location
+        self.timestamp = timestamp
+        self.song = song
+
+
+class _TimedStore(UserStateStore):
+    """
+    Store forwarding the user states to another one, and recording the
+    time between two writes. A uniform sample of RESERVOIR_SIZE of these
+    times is kept in a preallocated array, with reservoir sampling, so that
+    the bookkeeping does not weigh on the memory measured.
+    """
+
+    def __init__(self, store, seed=0):
+        self.store = store
+        self.reservoir = np.zeros(RESERVOIR_SIZE)
+        self.count = 0
+        self.random = random.Random(seed)
+        self.last = time.time()
+
+    @property
+    def intervals(self):
+        return self.reservoir[:min(self.count, RESERVOIR_SIZE)]
+
+    def write(self, user_state):
+        self.store.write(user_state)
+        now = time.time()
+        if self.count < RESERVOIR_SIZE:
+            self.reservoir[self.count] = now - self.last
+        else:
+            index = int(self.random.random() * (self.count + 1))
+            if index < RESERVOIR_SIZE:
+                self.reservoir[index] = now - self.last
+        self.count += 1
+        self.last = now
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+def use_offline_cache():
+    """
+    Sets an in-memory metadata cache holding the benchmark song, so that it
+    is resolved without any network call.
+    """
+    song_module.CACHE = MetadataCache()
+    song_module.CACHE.set_release_id(BENCHMARK_QUERY, 1)
+    song_module.CACHE.set_details(1, BENCHMARK_DETAILS)
+
+
+def generate_lines(count, imeis=1000, songs=None):
+    """
+    Iterates over count CSV lines in the format of the input files.
+
+    Parameters
+    ----------
+    count               : int
+                        The number of lines.
+    imeis               : int
+                        The number of distinct IMEIs.
+    songs               : int
+                        The number of distinct songs. If None, all the rows
+                        refer to BENCHMARK_QUERY.
+    """
+    activities = sorted(ACTIVITIES)
+    for index in xrange(count):
+        if songs is None:
+            query_string = BENCHMARK_QUERY
+        else:
+            query_string = 'Artist %d - Song %d' % (index % songs,
+                                                     index % songs)
+        yield '%d,2013-01-%02d %02d:%02d:%02d,%015d,x,%s,a,b,' \
+            '"%.6f,%.6f",%s\n' % (
+                index, 1 + index // 86400 % 28, index // 3600 % 24,
+                index // 60 % 60, index % 60, index % imeis, query_string,
+                60.0 + index % 1000 * 1e-4, 24.9 + index % 997 * 1e-4,
+                activities[index % 3])
+
+
+def generate_rows(count, imeis=1000, songs=None):
+    """
+    Iterates over count CSV rows, parsed by the csv module so that every
+    field is a new string, as when a file is read.
+    """
+    return csv.reader(generate_lines(count, imeis, songs), delimiter=',',
+                      quotechar='"')
+
+
+def write_csv(file_path, count, imeis=1000, songs=1000):
+    """
+    Writes a synthetic CSV file of count rows, with its header.
+    """
+    with open(file_path, 'wb') as csvfile:
+        csvfile.write('id,time,imei,x,song,a,b,location,activity\n')
+        csvfile.writelines(generate_lines(count, imeis, songs))
+
+
+def resident_memory():
+    """
+    Returns the resident memory of the process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * \
+                resource.getpagesize()
+    except IOError:
+        return peak_resident_memory()
+
+
+def peak_resident_memory():
+    """
+    Returns the peak resident memory of the process, in bytes.
+    """
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory_per_state(count=1000000, legacy=False):
+    """
+    Measures the memory used by count user states built from generated
+    rows, in a new process.
+
+    Parameters
+    ----------
+    count               : int
+                        The number of user states kept in memory.
+    legacy              : bool
+                        Whether to measure DictUserState objects instead of
+                        UserState ones.
+
+    Returns
+    -------
+    Returns the number of bytes of resident memory per user state.
+    """
+    return _in_process(_memory_per_state, count, legacy)
+
+
+def benchmark_parse_csv(count, workers=1, latency=0.001, error_rate=0.0,
+                        songs=1000):
+    """
+    Times parser.parse_csv end to end on a synthetic CSV file of count rows,
+    with a cold song registry and no metadata cache, the songs being looked
+    up on a FakeDiscogs. The latencies are the times between two user
+    states written.
+
+    Returns
+    -------
+    Returns a dict of results, see run.
+    """
+    return _in_process(_benchmark_parse_csv, count, workers, latency,
+                       error_rate, songs)
+
+
+def benchmark_distance_songs(count, songs=1000):
+    """
+    Times count calls to song.distance_songs between songs resolved on a
+    FakeDiscogs.
+    """
+    return _in_process(_benchmark_distance_songs, count, songs)
+
+
+def benchmark_distance_user_states(count, songs=1000):
+    """
+    Times count calls to user_state.distance_user_states.
+    """
+    return _in_process(_benchmark_distance_user_states, count, songs)
+
+
+def benchmark_user_state_write(count, imeis=100):
+    """
+    Times count calls to UserState.write, each appending to the gzip file of
+    its IMEI.
+    """
+    return _in_process(_benchmark_user_state_write, count, imeis)
+
+
+def benchmark_text_index(count, documents=100000):
+    """
+    Times count calls to text_index.TextIndex.release_id on an index of
+    documents synthetic release names, with query strings that are noisy
+    variants of them: other case and punctuation, featuring credits and
+    extra words.
+    """
+    return _in_process(_benchmark_text_index, count, documents)
+
+
+def run(sizes=DEFAULT_SIZES, calls=10000, workers=1, latency=0.001,
+        error_rate=0.0):
+    """
+    Runs all the benchmarks.
+
+    Parameters
+    ----------
+    sizes               : list of int
+                        The numbers of rows of the CSV files parsed.
+    calls               : int
+                        The number of calls timed by the other benchmarks.
+    workers             : int
+                        The number of threads resolving the songs in
+                        parse_csv.
+    latency             : float
+                        The latency of the fake Discogs, in seconds.
+    error_rate          : float
+                        The error rate of the fake Discogs.
+
+    Returns
+    -------
+    Returns a dict mapping the name of each benchmark to its results: the
+    number of operations, the seconds taken, the operations per second, the
+    p50 and p99 latencies of an operation in seconds, and the peak resident
+    memory in bytes.
+    """
+    results = {}
+    for size in sizes:
+        results['parse_csv_%d' % size] = benchmark_parse_csv(
+            size, workers, latency, error_rate)
+    results['distance_songs'] = benchmark_distance_songs(calls)
+    results['distance_user_states'] = benchmark_distance_user_states(calls)
+    results['user_state_write'] = benchmark_user_state_write(calls)
+    results['text_index'] = benchmark_text_index(calls)
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares the results of run against a baseline.
+
+    Returns
+    -------
+    Returns a dict mapping the name of each benchmark in both to the ratio
+    of its throughput to the baseline one, and the list of the names of the
+    benchmarks whose ratio is below 1 - tolerance.
+    """
+    ratios = {}
+    for name, result in results.iteritems():
+        if name in baseline and baseline[name]['per_second']:
+            ratios[name] = result['per_second'] / \
+                baseline[name]['per_second']
+    regressions = sorted(name for name, ratio in ratios.iteritems()
+                         if ratio < 1.0 - tolerance)
+    return ratios, regressions
+
+
+def _in_process(function, *arguments):
+    """
+    Calls the function in a new process, with a FakeGeocoder installed, and
+    returns its result.
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(_offline_call, (function, arguments))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _offline_call(function, arguments):
+    with FakeGeocoder():
+        return function(*arguments)
+
+
+def _result(count, seconds, latencies, peak_rss=None):
+    # The peak memory is measured before the percentiles are computed
+    if peak_rss is None:
+        peak_rss = peak_resident_memory()
+    latencies = np.asarray(latencies, dtype=np.float64)
+    return {'count': count,
+            'seconds': seconds,
+            'per_second': count / seconds if seconds else 0.0,
+            'p50': float(np.percentile(latencies, 50)) if len(latencies)
+                   else None,
+            'p99': float(np.percentile(latencies, 99)) if len(latencies)
+                   else None,
+            'peak_rss': peak_rss,
+           }
+
+
+def _timed_calls(function, arguments):
+    """
+    Calls the function on each tuple of arguments, and returns the result
+    of the timing.
+    """
+    latencies = []
+    start = time.time()
+    for call_arguments in arguments:
+        call_start = time.time()
+        function(*call_arguments)
+        latencies.append(time.time() - call_start)
+    return _result(len(latencies), time.time() - start, latencies)
+
+
+def _resolved_songs(count):
+    with FakeDiscogs():
+        return [intern_song('Artist %d - Song %d' % (index, index))
+                for index in xrange(count)]
+
+
+def _random_user_states(count, songs):
+    generator = np.random.RandomState(0)
+    activities = sorted(ACTIVITIES)
+    start = datetime(2013, 1, 1)
+    return [UserState('%015d' % generator.randint(1000),
+                      activities[generator.randint(3)],
+                      (generator.uniform(-60, 60),
+                       generator.uniform(-180, 180)),
+                      start + timedelta(seconds=generator.randint(1 << 24)),
+                      songs[generator.randint(len(songs))])
+            for _ in xrange(count)]
+
+
+def _memory_per_state(count, legacy):
+    use_offline_cache()
+    state_class = DictUserState if legacy else UserState
+    song = intern_song(BENCHMARK_QUERY)
+    rows = parser_module.parse_rows(generate_rows(count))
+    gc.collect()
+    start = resident_memory()
+    user_states = [state_class(imei, activity, location, timestamp, song)
+                   for imei, timestamp, _, activity, location in rows]
+    gc.collect()
+    used = resident_memory() - start
+    del user_states
+    return float(used) / count
+
+
+def _benchmark_parse_csv(count, workers, latency, error_rate, songs):
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        file_path = os.path.join(directory, 'rows.csv')
+        write_csv(file_path, count, songs=songs)
+        song_module.CACHE = None
+        clear_songs()
+        store = _TimedStore(UserStateWriter(directory))
+        with FakeDiscogs(latency, error_rate):
+            start = time.time()
+            with store:
+                parser_module.parse_csv(file_path, workers, store)
+            seconds = time.time() - start
+        return _result(count, seconds, store.intervals)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _benchmark_distance_songs(count, songs):
+    songs = _resolved_songs(songs)
+    generator = np.random.RandomState(0)
+    pairs = [(songs[index1], songs[index2]) for index1, index2
+             in generator.randint(len(songs), size=(count, 2))]
+    return _timed_calls(distance_songs, pairs)
+
+
+def _benchmark_distance_user_states(count, songs):
+    user_states = _random_user_states(count + 1,
+                                      _resolved_songs(songs))
+    return _timed_calls(distance_user_states,
+                        zip(user_states[:-1], user_states[1:]))
+
+
+def _benchmark_user_state_write(count, imeis):
+    user_states = _random_user_states(count, _resolved_songs(10))
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    current = os.getcwd()
+    try:
+        os.chdir(directory)
+        return _timed_calls(UserState.write,
+                            [(user_state,) for user_state in user_states])
+    finally:
+        os.chdir(current)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _benchmark_text_index(count, documents):
+    generator = random.Random(0)
+    words = ['word%d' % index for index in xrange(documents // 10)]
+    index = TextIndex()
+    for release_id in xrange(1, documents + 1):
+        index.add(release_id, '%s - %s' % (
+            ' '.join(generator.sample(words, generator.randint(1, 2))),
+            ' '.join(generator.sample(words, generator.randint(1, 4)))))
+    noise = ['%s', '%s (Live)', '%s feat. Someone', '%s - Remastered',
+             '"%s"!']
+    queries = [(generator.choice(noise) %
+                index.keys[generator.randrange(len(index))].title(),)
+               for _ in xrange(count)]
+    return _timed_calls(index.release_id, queries)
+
+
+def _format(value, unit=''):
+    if value is None:
+        return '-'
+    if value >= 100:
+        return '%.0f%s' % (value, unit)
+    return '%.3g%s' % (value, unit)
+
+
+def main():
+    """
+    Runs the benchmarks and prints their results.
+    """
+    option_parser = OptionParser(usage='%prog [options]')
+    option_parser.add_option('-s', '--sizes', dest='sizes',
+                             default=','.join(str(size) for size
+                                              in DEFAULT_SIZES),
+                             help='comma-separated numbers of rows of the '
+                                  'CSV files parsed')
+    option_parser.add_option('-n', '--calls', dest='calls', type='int',
+                             default=10000,
+                             help='number of calls timed by the distance, '
+                                  'write and text index benchmarks')
+    option_parser.add_option('-j', '--workers', dest='workers', type='int',
+                             default=1,
+                             help='number of threads resolving the songs')
+    option_parser.add_option('-l', '--latency', dest='latency',
+                             type='float', default=0.001,
+                             help='latency of the fake Discogs, in seconds')
+    option_parser.add_option('-e', '--error-rate', dest='error_rate',
+                             type='float', default=0.0,
+                             help='error rate of the fake Discogs')
+    option_parser.add_option('-b', '--baseline', dest='baseline',
+                             default=DEFAULT_BASELINE,
+                             help='baseline JSON file compared against, '
+                                  'default %default')
+    option_parser.add_option('-w', '--save-baseline', dest='save_baseline',
+                             action='store_true', default=False,
+                             help='save the results as the baseline')
+    option_parser.add_option('-t', '--tolerance', dest='tolerance',
+                             type='float', default=DEFAULT_TOLERANCE,
+                             help='relative drop of throughput reported as '
+                                  'a regression')
+    option_parser.add_option('-m', '--memory', dest='memory', type='int',
+                             help='also measure the memory per user state '
+                                  'for that many states')
+    options, _ = option_parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',') if size]
+    results = run(sizes, options.calls, options.workers, options.latency,
+                  options.error_rate)
+    baseline = {}
+    if not options.save_baseline and os.path.exists(options.baseline):
+        with open(options.baseline, 'rb') as baseline_file:
+            baseline = json.load(baseline_file)
+    ratios, regressions = compare(results, baseline, options.tolerance)
+    print '%-26s %10s %10s %10s %10s %10s %8s' % (
+        'benchmark', 'count', 'ops/s', 'p50 (s)', 'p99 (s)', 'peak RSS',
+        'vs base')
+    for name in sorted(results):
+        result = results[name]
+        print '%-26s %10d %10s %10s %10s %9.0fM %8s' % (
+            name, result['count'], _format(result['per_second']),
+            _format(result['p50']), _format(result['p99']),
+            result['peak_rss'] / 1e6,
+            _format(ratios[name], 'x') if name in ratios else '-')
+    if options.memory:
+        print 'Memory per user state, %d states: %.1f bytes dict-based, ' \
+            '%.1f bytes slotted' % (
+                options.memory, memory_per_state(options.memory, True),
+                memory_per_state(options.memory))
+    if options.save_baseline:
+        with open(options.baseline, 'wb') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if regressions:
+        print 'Regressions: %s' % ', '.join(regressions)
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
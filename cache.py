@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Cache Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import time
+import threading
+import gzip
+import contextlib
+import cPickle as pkl
+from collections import OrderedDict
+
+from song import normalize_query_string
+
+
+class MetadataCache(object):
+    """
+    Persistent, size-bounded cache for the Discogs metadata of the songs.
+
+    Two tables are kept: one mapping the normalized query strings (see
+    song.normalize_query_string) to the release ids,
+    and one mapping the release ids to the (genre, style, tempo, year,
+    country) details of the release. Both tables are evicted in least
+    recently used order once they hold more than max_size entries.
+    The cache can be shared between threads.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the gzipped pickle file in which the
+                        cache is persisted. If None, the cache only lives in
+                        memory.
+    max_size            : int
+                        The maximum number of entries kept in each table.
+    ttl                 : float
+                        The time to live of an entry, in seconds. If None,
+                        the entries never expire.
+
+    Attributes
+    ----------
+    hits                : int
+                        The number of lookups answered by the cache.
+    misses              : int
+                        The number of lookups not answered by the cache.
+    """
+
+    VERSION = 1
+
+    def __init__(self, file_path=None, max_size=100000, ttl=None):
+        if max_size <= 0:
+            raise Exception('Given cache size is not strictly positive.')
+        if ttl is not None and ttl <= 0:
+            raise Exception('Given cache time to live is not strictly \
+                positive.')
+        self.file_path = file_path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.release_ids = OrderedDict()
+        self.details = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if file_path is not None and os.path.exists(file_path):
+            self.load()
+
+    def get_release_id(self, query_string):
+        """
+        Returns the cached release id for the query string, or None.
+        """
+        return self._get(self.release_ids,
+                         normalize_query_string(query_string))
+
+    def set_release_id(self, query_string, release_id):
+        """
+        Stores the release id found for the query string.
+        """
+        self._set(self.release_ids, normalize_query_string(query_string),
+                  release_id)
+
+    def get_details(self, release_id):
+        """
+        Returns the cached (genre, style, tempo, year, country) details of
+        the release, or None.
+        """
+        return self._get(self.details, release_id)
+
+    def set_details(self, release_id, details):
+        """
+        Stores the (genre, style, tempo, year, country) details of the
+        release.
+        """
+        if len(details) != 5:
+            raise Exception('Given release details do not have the correct \
+                number of fields.')
+        self._set(self.details, release_id, tuple(details))
+
+    def entries(self, since=None):
+        """
+        Returns the (release id entries, details entries) couple of the
+        lists of the (key, (stored_at, value)) entries of the tables, the
+        ones stored at or after since only if it is given.
+        """
+        with self.lock:
+            return tuple([(key, entry) for key, entry in table.iteritems()
+                          if since is None or entry[0] >= since]
+                         for table in (self.release_ids, self.details))
+
+    def merge(self, release_ids=(), details=()):
+        """
+        Adds entries of another cache, such as the one of another process,
+        as returned by entries: they keep the time they were stored at, so
+        that they expire as they would have there. The entries older than
+        the ones already cached are skipped.
+        """
+        with self.lock:
+            for table, entries in ((self.release_ids, release_ids),
+                                   (self.details, details)):
+                for key, entry in entries:
+                    current = table.get(key)
+                    if current is not None and current[0] >= entry[0]:
+                        continue
+                    table.pop(key, None)
+                    table[key] = entry
+                self._evict(table)
+
+    def invalidate(self, query_string=None, release_id=None):
+        """
+        Removes the entries for the given query string and/or release id.
+        If neither is given, the whole cache is emptied.
+        """
+        with self.lock:
+            if query_string is None and release_id is None:
+                self.release_ids.clear()
+                self.details.clear()
+                return
+            if query_string is not None:
+                self.release_ids.pop(normalize_query_string(query_string),
+                                     None)
+            if release_id is not None:
+                self.details.pop(release_id, None)
+
+    def expire(self):
+        """
+        Removes all the entries older than the time to live.
+        Returns the number of entries removed.
+        """
+        if self.ttl is None:
+            return 0
+        limit = time.time() - self.ttl
+        removed = 0
+        with self.lock:
+            for table in (self.release_ids, self.details):
+                stale = [key for key, (stored_at, _) in table.iteritems()
+                         if stored_at < limit]
+                for key in stale:
+                    del table[key]
+                removed += len(stale)
+        return removed
+
+    def stats(self):
+        """
+        Returns a dict with the hit/miss counters and the table sizes.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'release_ids': len(self.release_ids),
+                'details': len(self.details),
+               }
+
+    def load(self):
+        """
+        Loads the cache content from file_path, replacing the current one.
+        Expired entries are dropped on the way.
+        """
+        with contextlib.closing(gzip.GzipFile(self.file_path, 'rb')) \
+                as read_file:
+            content = pkl.load(read_file)
+        if content.get('version') != self.VERSION:
+            raise Exception('Cache file has an unsupported version.')
+        # Files written before the normalization of the query strings hold
+        # them as they were
+        self.release_ids = OrderedDict(
+            (normalize_query_string(query_string), entry)
+            for query_string, entry in content['release_ids'])
+        self.details = OrderedDict(content['details'])
+        self.expire()
+        for table in (self.release_ids, self.details):
+            self._evict(table)
+
+    def save(self):
+        """
+        Writes the cache content to file_path.
+        The file is replaced atomically, so that a crash during the write
+        never leaves a truncated cache behind.
+        """
+        if self.file_path is None:
+            raise Exception('Cache has no file path to be saved to.')
+        with self.lock:
+            content = {'version': self.VERSION,
+                       'release_ids': self.release_ids.items(),
+                       'details': self.details.items(),
+                      }
+        temp_path = self.file_path + '.tmp'
+        with contextlib.closing(gzip.GzipFile(temp_path, 'wb')) \
+                as write_file:
+            pkl.dump(content, write_file, pkl.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.file_path)
+
+    def _get(self, table, key):
+        with self.lock:
+            entry = table.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                self.misses += 1
+                return None
+            # Re-inserting moves the entry to the most recently used end
+            table[key] = entry
+            self.hits += 1
+            return value
+
+    def _set(self, table, key, value):
+        with self.lock:
+            table.pop(key, None)
+            table[key] = (time.time(), value)
+            self._evict(table)
+
+    def _evict(self, table):
+        while len(table) > self.max_size:
+            table.popitem(last=False)
+
+
+class NegativeCache(object):
+    """
+    In-memory, size-bounded cache of the query strings that could not be
+    resolved, so that the rows referring to them are rejected without any
+    new Discogs lookup. The entries expire, so that the releases added to
+    Discogs in the meantime are eventually found, and are evicted in least
+    recently used order beyond max_size entries. The failures that may not
+    happen again, such as network errors, expire sooner than the others.
+    The cache can be shared between threads.
+
+    Parameters
+    ----------
+    max_size            : int
+                        The maximum number of query strings kept.
+    ttl                 : float
+                        The time to live of an entry, in seconds.
+    transient_ttl       : float
+                        The time to live of an entry of a transient failure,
+                        in seconds.
+
+    Attributes
+    ----------
+    hits                : int
+                        The number of lookups answered by the cache.
+    """
+
+    def __init__(self, max_size=100000, ttl=86400.0, transient_ttl=60.0):
+        if max_size <= 0:
+            raise Exception('Given cache size is not strictly positive.')
+        if ttl <= 0 or transient_ttl <= 0:
+            raise Exception('Given cache time to live is not strictly \
+                positive.')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.transient_ttl = transient_ttl
+        self.failures = OrderedDict()
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.failures)
+
+    def get(self, query_string):
+        """
+        Returns the error the query string could not be resolved on, or None
+        if it is not known to fail.
+        """
+        with self.lock:
+            entry = self.failures.pop(query_string, None)
+            if entry is None:
+                return None
+            expires_at, error = entry
+            if time.time() > expires_at:
+                return None
+            self.failures[query_string] = entry
+            self.hits += 1
+            return error
+
+    def set(self, query_string, error, transient=False):
+        """
+        Records that the query string could not be resolved, on the given
+        error.
+        """
+        ttl = self.transient_ttl if transient else self.ttl
+        with self.lock:
+            self.failures.pop(query_string, None)
+            self.failures[query_string] = (time.time() + ttl, error)
+            while len(self.failures) > self.max_size:
+                self.failures.popitem(last=False)
+
+    def invalidate(self, query_string=None):
+        """
+        Removes the entry of the query string, or all of them if None.
+        """
+        with self.lock:
+            if query_string is None:
+                self.failures.clear()
+            else:
+                self.failures.pop(query_string, None)
+
+    def stats(self):
+        """
+        Returns a dict with the hit counter and the number of entries.
+        """
+        return {'hits': self.hits, 'failures': len(self.failures)}
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import numpy as np
+
+from song import Song, NONE_CODE, GENRE_TAXONOMY, STYLE_TAXONOMY
+from countries import COUNTRY_INDEX, COUNTRY_DISTANCES
+
+
+# Code of the missing genres, styles and countries ('None' or unknown)
+MISSING = NONE_CODE
+
+# Distance components computed by SongCatalog.distance_matrix
+COMPONENTS = ('genre', 'style', 'country', 'year', 'tempo', 'sens_me')
+
+# Default weights of the components in SongCatalog.score, chosen so that
+# a weight times a typical distance is about one: 1000km between countries,
+# 10 years, 20 bpm.
+DEFAULT_WEIGHTS = {'genre': 1.0,
+                   'style': 1.0,
+                   'country': 1e-6,
+                   'year': 0.1,
+                   'tempo': 0.05,
+                   'sens_me': 1.0,
+                  }
+
+
+class SongCatalog(object):
+    """
+    Column-wise store of many songs, for the vectorized calculation of the
+    distances between them.
+
+    Parameters
+    ----------
+    songs               : iterable of Song
+                        The songs in the catalog, in order.
+
+    Attributes
+    ----------
+    query_strings       : list of str
+                        The query strings of the songs.
+    genres              : int array
+                        The code of the genre of each song in
+                        song.GENRE_TAXONOMY, or MISSING.
+    styles              : int array
+                        The code of the style of each song in
+                        song.STYLE_TAXONOMY, or MISSING.
+    countries           : int array
+                        The index of the country of each song in
+                        countries.COUNTRY_NAMES, or MISSING.
+    years               : float array
+                        The release year of each song, NaN if unknown.
+    tempos              : float array
+                        The tempo of each song.
+    sens_me_values      : float array of shape (N, 2)
+                        The sensMe couple of each song.
+    """
+
+    def __init__(self, songs=()):
+        songs = list(songs)
+        for song in songs:
+            if not isinstance(song, Song):
+                raise Exception('Given song is not a Song object.')
+        self.query_strings = [song.query_string for song in songs]
+        self.genres = np.array([song.genre_code for song in songs],
+                               dtype=np.int32)
+        self.styles = np.array([song.style_code for song in songs],
+                               dtype=np.int32)
+        self.countries = _codes([song.country for song in songs],
+                                COUNTRY_INDEX)
+        self.years = np.array([song.year if isinstance(song.year, int)
+                               else np.nan for song in songs],
+                              dtype=np.float64)
+        self.tempos = np.array([song.tempo for song in songs],
+                               dtype=np.float64)
+        self.sens_me_values = np.array([song.sens_me_values for song in songs],
+                                       dtype=np.float64).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.query_strings)
+
+    def subset(self, indices):
+        """
+        Returns a new catalog with the songs at the given indices.
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        catalog = SongCatalog()
+        catalog.query_strings = [self.query_strings[index]
+                                 for index in indices]
+        for column in ('genres', 'styles', 'countries', 'years', 'tempos',
+                       'sens_me_values'):
+            setattr(catalog, column, getattr(self, column)[indices])
+        return catalog
+
+    def extend(self, other):
+        """
+        Appends the songs of the other catalog to this one.
+        """
+        if not isinstance(other, SongCatalog):
+            raise Exception('Given catalog is not a SongCatalog object.')
+        self.query_strings.extend(other.query_strings)
+        for column in ('genres', 'styles', 'countries', 'years', 'tempos',
+                       'sens_me_values'):
+            setattr(self, column, np.concatenate([getattr(self, column),
+                                                  getattr(other, column)]))
+
+    def distance_matrix(self, other, component):
+        """
+        Calculates the distances between all the songs of this catalog and
+        all the songs of the other one, for one of the COMPONENTS. The
+        values are the same as the ones of the matching distance_* function
+        of the song module.
+
+        Parameters
+        ----------
+        other               : SongCatalog
+                            The catalog to compare against.
+        component           : str
+                            One of COMPONENTS.
+
+        Returns
+        -------
+        Returns a float array of shape (len(self), len(other)).
+        Genre, style and country distances are -1.0 if one of the two values
+        is missing, year distances are NaN if one of the years is unknown.
+        """
+        if not isinstance(other, SongCatalog):
+            raise Exception('Given catalog is not a SongCatalog object.')
+        if component == 'genre':
+            return GENRE_TAXONOMY.pairwise(self.genres, other.genres)
+        if component == 'style':
+            return STYLE_TAXONOMY.pairwise(self.styles, other.styles)
+        if component == 'country':
+            codes1 = self.countries[:, np.newaxis]
+            codes2 = other.countries[np.newaxis, :]
+            distances = COUNTRY_DISTANCES[np.maximum(codes1, 0),
+                                          np.maximum(codes2, 0)]
+            distances[(codes1 == MISSING) | (codes2 == MISSING)] = -1.0
+            return distances
+        if component == 'year':
+            return self.years[:, np.newaxis] - other.years[np.newaxis, :]
+        if component == 'tempo':
+            return self.tempos[:, np.newaxis] - other.tempos[np.newaxis, :]
+        if component == 'sens_me':
+            return _euclidean_distances(self.sens_me_values,
+                                        other.sens_me_values)
+        raise Exception('Given distance component is not recognized.')
+
+    def score(self, other, weights=None):
+        """
+        Calculates a combined distance between all the songs of this catalog
+        and all the songs of the other one: the weighted mean of the absolute
+        component distances. Missing components are left out of the mean.
+
+        Parameters
+        ----------
+        other               : SongCatalog
+                            The catalog to compare against.
+        weights             : dict
+                            The weight of each component, components
+                            missing from the dict are not used. Defaults to
+                            DEFAULT_WEIGHTS.
+
+        Returns
+        -------
+        Returns a float array of shape (len(self), len(other)), NaN where no
+        component is available.
+        """
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        total = np.zeros((len(self), len(other)))
+        total_weight = np.zeros((len(self), len(other)))
+        for component, weight in weights.iteritems():
+            if weight == 0:
+                continue
+            distances = self.distance_matrix(other, component)
+            if component in ('genre', 'style', 'country'):
+                available = distances >= 0
+            else:
+                available = ~np.isnan(distances)
+            np.abs(distances, out=distances)
+            distances[~available] = 0.0
+            distances *= weight
+            total += distances
+            total_weight += weight * available
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / total_weight
+
+
+def _codes(values, index):
+    """
+    Returns the int array of the indices of the values, MISSING for the
+    values not in the index.
+    """
+    return np.array([index.get(value, MISSING) for value in values],
+                    dtype=np.int32)
+
+
+def _euclidean_distances(points1, points2):
+    """
+    Returns the (N, M) matrix of the Euclidean distances between two sets
+    of 2D points.
+    """
+    return np.hypot(points1[:, 0][:, np.newaxis] - points2[:, 0][np.newaxis, :],
+                    points1[:, 1][:, np.newaxis] - points2[:, 1][np.newaxis, :])
+
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint Module for the Recommendation System.
+
+Bookkeeping of the resumable ingestion of a CSV file, see
+parser.parse_csv_incremental.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import csv
+import time
+import zlib
+import logging
+import cPickle as pkl
+
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes at the beginning of a file used to recognize it
+HEAD_SIZE = 4096
+
+
+class Checkpoint(object):
+    """
+    Persistent position of the ingestion of a CSV file: the identity of the
+    file, and the byte offset following the last row whose user states are
+    committed to the store.
+
+    The file is recognized by its device and inode numbers and a checksum of
+    its first bytes, so that a file replaced or truncated since the last
+    checkpoint is ingested again from its beginning.
+
+    The checkpoint also records the committed sizes of the output files
+    about to be appended to, before each commit of the store (see prepare),
+    so that the data appended by a run killed before its next checkpoint is
+    cut off when resuming.
+
+    Parameters
+    ----------
+    path                : str
+                        The path of the checkpoint file, loaded if it
+                        exists.
+
+    Attributes
+    ----------
+    identity            : tuple
+                        The identity of the file, see file_identity.
+    offset              : int
+                        The offset following the last committed row.
+    rows                : int
+                        The number of rows committed.
+    sizes               : dict
+                        The committed size of the output files, by path.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.identity = None
+        self.offset = 0
+        self.rows = 0
+        self.sizes = {}
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, 'rb') as checkpoint_file:
+            checkpoint = pkl.load(checkpoint_file)
+        if checkpoint.get('version') != self.VERSION:
+            logger.warning('Ignoring checkpoint %s of version %r.', self.path,
+                           checkpoint.get('version'))
+            return
+        self.identity = checkpoint['identity']
+        self.offset = checkpoint['offset']
+        self.rows = checkpoint['rows']
+        self.sizes = checkpoint.get('sizes', {})
+
+    def save(self):
+        """
+        Writes the checkpoint atomically.
+        """
+        checkpoint = {'version': self.VERSION,
+                      'identity': self.identity,
+                      'offset': self.offset,
+                      'rows': self.rows,
+                      'sizes': self.sizes,
+                      'saved_at': time.time(),
+                     }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as checkpoint_file:
+            pkl.dump(checkpoint, checkpoint_file, pkl.HIGHEST_PROTOCOL)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temp_path, self.path)
+
+    def start_offset(self, file_path):
+        """
+        Returns the offset the ingestion of the file resumes from: the
+        checkpointed one if the file is the checkpointed one, 0 otherwise.
+        The output files are first truncated back to their committed sizes.
+        """
+        self.truncate()
+        if self.identity is None:
+            return 0
+        size = os.path.getsize(file_path)
+        head_size = self.identity[2]
+        if size < self.offset or \
+                file_identity(file_path, head_size) != self.identity:
+            logger.info('%s changed since the checkpoint, ingesting it from '
+                        'the beginning.', file_path)
+            self.identity = None
+            self.offset = 0
+            self.rows = 0
+            return 0
+        logger.info('Resuming %s at byte %d, after %d rows.', file_path,
+                    self.offset, self.rows)
+        return self.offset
+
+    def truncate(self):
+        """
+        Truncates the output files back to their committed sizes, removing
+        the ones which did not exist.
+        Returns the number of files changed.
+        """
+        changed = 0
+        for path, size in sorted(self.sizes.iteritems()):
+            if not os.path.exists(path) or os.path.getsize(path) == size:
+                continue
+            logger.info('Truncating %s back to %d bytes.', path, size)
+            if size == 0:
+                os.remove(path)
+            else:
+                with open(path, 'r+b') as output_file:
+                    output_file.truncate(size)
+            changed += 1
+        return changed
+
+    def prepare(self, paths):
+        """
+        Records the sizes of the output files the store is about to append
+        to, as their committed sizes, and saves the checkpoint.
+        """
+        for path in paths:
+            if path not in self.sizes:
+                self.sizes[path] = os.path.getsize(path) \
+                    if os.path.exists(path) else 0
+        self.save()
+
+    def commit(self, file_path, offset, rows, paths=()):
+        """
+        Records that the rows up to offset, rows more of them, are
+        committed, and saves the checkpoint. The current sizes of the given
+        output files, such as a dead-letter file appended to before the
+        commit of the store, are recorded as their committed sizes.
+        """
+        self.identity = file_identity(file_path, min(HEAD_SIZE, offset))
+        self.offset = offset
+        self.rows += rows
+        self.sizes = dict((path, os.path.getsize(path)) for path in paths
+                          if os.path.exists(path))
+        self.save()
+
+
+def file_identity(file_path, head_size):
+    """
+    Returns the (device, inode, head_size, checksum) identity of the file,
+    the checksum being the CRC32 of its first head_size bytes.
+    """
+    status = os.stat(file_path)
+    with open(file_path, 'rb') as input_file:
+        head = input_file.read(head_size)
+    return (status.st_dev, status.st_ino, head_size,
+            zlib.crc32(head) & 0xffffffff)
+
+
+def read_batches(file_path, offset=0, batch_size=10000, tail=False):
+    """
+    Reads the lines of the file from the offset, in batches.
+
+    If the offset is 0, the header line is skipped if the file has one.
+    The lines must not contain quoted line breaks. Blank lines are skipped.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the CSV file.
+    offset              : int
+                        The offset of the first line read.
+    batch_size          : int
+                        The maximum number of lines in a batch.
+    tail                : bool
+                        Whether the file is still being written: a last line
+                        without its line break is then left for a later
+                        read.
+
+    Returns
+    -------
+    Yields (lines, offset) couples, offset following the last line of the
+    batch.
+    """
+    if batch_size < 1:
+        raise Exception('Given batch size is smaller than one.')
+    with open(file_path, 'rb') as input_file:
+        if offset == 0:
+            offset = _header_size(input_file, tail)
+        input_file.seek(offset)
+        while True:
+            lines = []
+            while len(lines) < batch_size:
+                line = input_file.readline()
+                if not line or tail and not line.endswith('\n'):
+                    break
+                offset += len(line)
+                if line.strip():
+                    lines.append(line)
+            if not lines:
+                return
+            yield lines, offset
+
+
+def _header_size(input_file, tail):
+    """
+    Returns the size of the header line of the file, 0 if it has none.
+    """
+    input_file.seek(0)
+    first_line = input_file.readline()
+    if not first_line or tail and not first_line.endswith('\n'):
+        return 0
+    input_file.seek(0)
+    try:
+        has_header = csv.Sniffer().has_header(input_file.read(1024))
+    except csv.Error:
+        has_header = False
+    return len(first_line) if has_header else 0
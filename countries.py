@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Countries Module for the Recommendation System.
+
+Offline table of the country names used by Discogs for the releases, with
+the approximate coordinates of their centroid, and the matrix of the
+distances between all of them, computed once at import.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import numpy as np
+
+from geodesic import many_to_many
+
+
+def country_index(country):
+    """
+    Returns the index of the country in COUNTRY_NAMES and
+    COUNTRY_DISTANCES, or None if the country is not in the table.
+    """
+    return COUNTRY_INDEX.get(country)
+
+
+# Country centroids
+# The keys are the country names as returned by Discogs, including its
+# regional labels, and the values the (latitude, longitude) couple of an
+# approximate centroid, in degrees. The regional labels are placed at the
+# centroid of the area they cover.
+COUNTRIES = {'Afghanistan': (33.9, 67.7),
+             'Albania': (41.2, 20.2),
+             'Algeria': (28.0, 1.7),
+             'Andorra': (42.5, 1.5),
+             'Angola': (-11.2, 17.9),
+             'Antigua & Barbuda': (17.1, -61.8),
+             'Argentina': (-38.4, -63.6),
+             'Armenia': (40.1, 45.0),
+             'Aruba': (12.5, -70.0),
+             'Australia': (-25.3, 133.8),
+             'Austria': (47.5, 14.6),
+             'Azerbaijan': (40.1, 47.6),
+             'Bahamas, The': (25.0, -77.4),
+             'Bahrain': (26.0, 50.6),
+             'Bangladesh': (23.7, 90.4),
+             'Barbados': (13.2, -59.5),
+             'Belarus': (53.7, 28.0),
+             'Belgium': (50.5, 4.5),
+             'Belize': (17.2, -88.5),
+             'Benin': (9.3, 2.3),
+             'Bermuda': (32.3, -64.8),
+             'Bhutan': (27.5, 90.4),
+             'Bolivia': (-16.3, -63.6),
+             'Bosnia & Herzegovina': (43.9, 17.7),
+             'Botswana': (-22.3, 24.7),
+             'Brazil': (-14.2, -51.9),
+             'Brunei': (4.5, 114.7),
+             'Bulgaria': (42.7, 25.5),
+             'Burkina Faso': (12.2, -1.6),
+             'Burma': (21.9, 95.9),
+             'Burundi': (-3.4, 29.9),
+             'Cambodia': (12.6, 104.9),
+             'Cameroon': (7.4, 12.4),
+             'Canada': (56.1, -106.3),
+             'Cape Verde': (16.0, -24.0),
+             'Cayman Islands': (19.3, -81.3),
+             'Central African Republic': (6.6, 20.9),
+             'Chad': (15.5, 18.7),
+             'Chile': (-35.7, -71.5),
+             'China': (35.9, 104.2),
+             'Colombia': (4.6, -74.3),
+             'Comoros': (-11.9, 43.9),
+             'Congo, Democratic Republic of the': (-4.0, 21.8),
+             'Congo, Republic of the': (-0.2, 15.8),
+             'Costa Rica': (9.7, -83.8),
+             'Croatia': (45.1, 15.2),
+             'Cuba': (21.5, -77.8),
+             'Curaçao': (12.2, -69.0),
+             'Cyprus': (35.1, 33.4),
+             'Czech Republic': (49.8, 15.5),
+             'Czechoslovakia': (49.2, 17.0),
+             'Denmark': (56.3, 9.5),
+             'Djibouti': (11.8, 42.6),
+             'Dominica': (15.4, -61.4),
+             'Dominican Republic': (18.7, -70.2),
+             'East Timor': (-8.9, 125.7),
+             'Ecuador': (-1.8, -78.2),
+             'Egypt': (26.8, 30.8),
+             'El Salvador': (13.8, -88.9),
+             'Equatorial Guinea': (1.7, 10.3),
+             'Eritrea': (15.2, 39.8),
+             'Estonia': (58.6, 25.0),
+             'Ethiopia': (9.1, 40.5),
+             'Faroe Islands': (61.9, -6.9),
+             'Fiji': (-17.7, 178.1),
+             'Finland': (61.9, 25.7),
+             'France': (46.2, 2.2),
+             'French Guiana': (3.9, -53.1),
+             'French Polynesia': (-17.7, -149.4),
+             'Gabon': (-0.8, 11.6),
+             'Gambia, The': (13.4, -15.3),
+             'Georgia': (42.3, 43.4),
+             'German Democratic Republic (GDR)': (52.0, 12.5),
+             'Germany': (51.2, 10.5),
+             'Ghana': (7.9, -1.0),
+             'Gibraltar': (36.1, -5.4),
+             'Greece': (39.1, 21.8),
+             'Greenland': (71.7, -42.6),
+             'Grenada': (12.1, -61.7),
+             'Guadeloupe': (16.3, -61.6),
+             'Guam': (13.4, 144.8),
+             'Guatemala': (15.8, -90.2),
+             'Guinea': (9.9, -9.7),
+             'Guinea-Bissau': (11.8, -15.2),
+             'Guyana': (4.9, -58.9),
+             'Haiti': (19.0, -72.3),
+             'Honduras': (15.2, -86.2),
+             'Hong Kong': (22.4, 114.1),
+             'Hungary': (47.2, 19.5),
+             'Iceland': (65.0, -19.0),
+             'India': (20.6, 79.0),
+             'Indonesia': (-0.8, 113.9),
+             'Iran': (32.4, 53.7),
+             'Iraq': (33.2, 43.7),
+             'Ireland': (53.4, -8.2),
+             'Israel': (31.0, 34.9),
+             'Italy': (41.9, 12.6),
+             'Ivory Coast': (7.5, -5.5),
+             'Jamaica': (18.1, -77.3),
+             'Japan': (36.2, 138.3),
+             'Jordan': (30.6, 36.2),
+             'Kazakhstan': (48.0, 66.9),
+             'Kenya': (-0.0, 37.9),
+             'Kosovo': (42.6, 20.9),
+             'Kuwait': (29.3, 47.5),
+             'Kyrgyzstan': (41.2, 74.8),
+             'Laos': (19.9, 102.5),
+             'Latvia': (56.9, 24.6),
+             'Lebanon': (33.9, 35.9),
+             'Lesotho': (-29.6, 28.2),
+             'Liberia': (6.4, -9.4),
+             'Libya': (26.3, 17.2),
+             'Liechtenstein': (47.2, 9.6),
+             'Lithuania': (55.2, 23.9),
+             'Luxembourg': (49.8, 6.1),
+             'Macau': (22.2, 113.5),
+             'Macedonia': (41.6, 21.7),
+             'Madagascar': (-18.8, 46.9),
+             'Malawi': (-13.3, 34.3),
+             'Malaysia': (4.2, 102.0),
+             'Maldives': (3.2, 73.2),
+             'Mali': (17.6, -4.0),
+             'Malta': (35.9, 14.4),
+             'Martinique': (14.6, -61.0),
+             'Mauritania': (21.0, -10.9),
+             'Mauritius': (-20.3, 57.6),
+             'Mexico': (23.6, -102.6),
+             'Moldova, Republic of': (47.4, 28.4),
+             'Monaco': (43.7, 7.4),
+             'Mongolia': (46.9, 103.8),
+             'Montenegro': (42.7, 19.4),
+             'Morocco': (31.8, -7.1),
+             'Mozambique': (-18.7, 35.5),
+             'Namibia': (-22.9, 18.5),
+             'Nepal': (28.4, 84.1),
+             'Netherlands': (52.1, 5.3),
+             'Netherlands Antilles': (12.2, -69.0),
+             'New Caledonia': (-20.9, 165.6),
+             'New Zealand': (-40.9, 174.9),
+             'Nicaragua': (12.9, -85.2),
+             'Niger': (17.6, 8.1),
+             'Nigeria': (9.1, 8.7),
+             'North Korea': (40.3, 127.5),
+             'Norway': (60.5, 8.5),
+             'Oman': (21.5, 55.9),
+             'Pakistan': (30.4, 69.3),
+             'Palestine': (31.9, 35.2),
+             'Panama': (8.5, -80.8),
+             'Papua New Guinea': (-6.3, 143.9),
+             'Paraguay': (-23.4, -58.4),
+             'Peru': (-9.2, -75.0),
+             'Philippines': (12.9, 121.8),
+             'Poland': (51.9, 19.1),
+             'Portugal': (39.4, -8.2),
+             'Puerto Rico': (18.2, -66.6),
+             'Qatar': (25.4, 51.2),
+             'Reunion': (-21.1, 55.5),
+             'Romania': (45.9, 25.0),
+             'Russia': (61.5, 105.3),
+             'Rwanda': (-1.9, 29.9),
+             'Saint Kitts and Nevis': (17.3, -62.7),
+             'Saint Lucia': (13.9, -61.0),
+             'Saint Vincent and the Grenadines': (12.98, -61.3),
+             'Samoa': (-13.8, -172.1),
+             'San Marino': (43.9, 12.5),
+             'Saudi Arabia': (23.9, 45.1),
+             'Senegal': (14.5, -14.5),
+             'Serbia': (44.0, 21.0),
+             'Serbia and Montenegro': (43.5, 20.5),
+             'Seychelles': (-4.7, 55.5),
+             'Sierra Leone': (8.5, -11.8),
+             'Singapore': (1.4, 103.8),
+             'Slovakia': (48.7, 19.7),
+             'Slovenia': (46.2, 15.0),
+             'Somalia': (5.2, 46.2),
+             'South Africa': (-30.6, 22.9),
+             'South Korea': (35.9, 127.8),
+             'South Sudan': (6.9, 31.3),
+             'Spain': (40.5, -3.7),
+             'Sri Lanka': (7.9, 80.8),
+             'Sudan': (12.9, 30.2),
+             'Suriname': (3.9, -56.0),
+             'Swaziland': (-26.5, 31.5),
+             'Sweden': (60.1, 18.6),
+             'Switzerland': (46.8, 8.2),
+             'Syria': (34.8, 39.0),
+             'Taiwan': (23.7, 121.0),
+             'Tajikistan': (38.9, 71.3),
+             'Tanzania': (-6.4, 34.9),
+             'Thailand': (15.9, 100.9),
+             'Togo': (8.6, 0.8),
+             'Tonga': (-21.2, -175.2),
+             'Trinidad & Tobago': (10.7, -61.2),
+             'Tunisia': (33.9, 9.5),
+             'Turkey': (39.0, 35.2),
+             'Turkmenistan': (39.0, 59.6),
+             'Uganda': (1.4, 32.3),
+             'UK': (55.4, -3.4),
+             'Ukraine': (48.4, 31.2),
+             'United Arab Emirates': (23.4, 53.8),
+             'Uruguay': (-32.5, -55.8),
+             'US': (37.1, -95.7),
+             'USSR': (55.0, 60.0),
+             'Uzbekistan': (41.4, 64.6),
+             'Vanuatu': (-15.4, 166.9),
+             'Vatican City': (41.9, 12.5),
+             'Venezuela': (6.4, -66.6),
+             'Vietnam': (14.1, 108.3),
+             'Virgin Islands': (18.3, -64.9),
+             'Yemen': (15.6, 48.5),
+             'Yugoslavia': (44.0, 19.0),
+             'Zaire': (-4.0, 21.8),
+             'Zambia': (-13.1, 27.8),
+             'Zimbabwe': (-19.0, 29.2),
+             # Discogs regional and multi-country labels
+             'Africa': (2.0, 17.0),
+             'Asia': (34.0, 100.0),
+             'Australasia': (-30.0, 145.0),
+             'Australia & New Zealand': (-32.0, 150.0),
+             'Benelux': (50.9, 5.2),
+             'Central America': (13.0, -86.0),
+             'Europe': (50.0, 10.0),
+             'Europe & US': (45.0, -40.0),
+             'France & Benelux': (48.0, 3.0),
+             'Germany & Switzerland': (49.5, 9.5),
+             'Germany, Austria, & Switzerland': (48.5, 11.0),
+             'Gulf Cooperation Council': (24.0, 50.0),
+             'Middle East': (29.0, 42.0),
+             'North & South America': (10.0, -80.0),
+             'North America (inc Mexico)': (40.0, -100.0),
+             'Scandinavia': (62.0, 15.0),
+             'South America': (-15.0, -60.0),
+             'South East Asia': (8.0, 108.0),
+             'UK & Europe': (51.0, 5.0),
+             'UK & France': (50.5, -0.5),
+             'UK & Ireland': (54.5, -5.5),
+             'UK & US': (47.0, -50.0),
+             'UK, Europe & US': (47.0, -35.0),
+             'USA & Canada': (45.0, -100.0),
+             'USA & Europe': (45.0, -40.0),
+             'USA, Canada & Europe': (47.0, -45.0),
+             'USA, Canada & UK': (48.0, -55.0),
+             'Worldwide': (20.0, 0.0),
+             }
+
+
+# Sorted country names, indexing the rows and columns of COUNTRY_DISTANCES
+COUNTRY_NAMES = sorted(COUNTRIES.keys())
+COUNTRY_INDEX = dict((name, index) for index, name in
+                     enumerate(COUNTRY_NAMES))
+COUNTRY_COORDINATES = np.array([COUNTRIES[name] for name in COUNTRY_NAMES])
+
+# Symmetric matrix of the distances between the country centroids, in meters
+COUNTRY_DISTANCES = many_to_many(COUNTRY_COORDINATES, COUNTRY_COORDINATES)
+# Vincenty's formula is only symmetric up to rounding, mirror the upper half
+COUNTRY_DISTANCES = np.triu(COUNTRY_DISTANCES) + \
+    np.triu(COUNTRY_DISTANCES, 1).T
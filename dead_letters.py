@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Dead Letters Module for the Recommendation System.
+
+The rows dropped because their song could not be resolved are recorded in
+a dead-letter CSV file, in the format of parser.parse_rows, so that they
+can be processed again in bulk once the lookups work:
+
+    rows = read_dead_letters(path, kinds=('transient',))
+    write_user_states(resolve_user_states(rows), store)
+
+@author: ymiche
+@version: 0.1
+"""
+
+import csv
+import time
+import threading
+from datetime import datetime
+
+from song import TransientLookupError
+
+
+# Columns of a dead-letter file. The kind is 'transient' for the rows
+# dropped after the retries of a failing Discogs call, 'permanent' for the
+# songs Discogs does not know.
+COLUMNS = ('imei', 'timestamp', 'query_string', 'activity', 'location',
+           'kind', 'reason', 'rejected_at')
+
+
+class DeadLetterWriter(object):
+    """
+    Appends the rejected rows to a dead-letter CSV file. The writer can be
+    shared between threads, and is used as a context manager or closed
+    explicitly.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the dead-letter file, created with a
+                        header line if it does not exist.
+
+    Attributes
+    ----------
+    rows_written        : int
+                        The number of rows recorded.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'ab')
+        self.csv_writer = csv.writer(self.file, delimiter=',', quotechar='"')
+        if self.file.tell() == 0:
+            self.csv_writer.writerow(COLUMNS)
+        self.rows_written = 0
+        self.lock = threading.Lock()
+
+    def write(self, imei, timestamp, query_string, activity, location, error):
+        """
+        Records a row, as returned by parser.parse_rows, rejected on the
+        given error.
+        """
+        kind = 'transient' if isinstance(error, TransientLookupError) \
+            else 'permanent'
+        row = (imei, timestamp.strftime('%Y-%m-%d %H:%M:%S'), query_string,
+               activity, '%r,%r' % tuple(location), kind, str(error),
+               '%.3f' % time.time())
+        with self.lock:
+            self.csv_writer.writerow(row)
+            self.rows_written += 1
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_dead_letters(file_path, kinds=None):
+    """
+    Iterates over the rows of a dead-letter file.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the dead-letter file.
+    kinds               : iterable of str
+                        The kinds of rejections read, all by default.
+
+    Returns
+    -------
+    Yields (imei, timestamp, query_string, activity, location) tuples, as
+    parser.parse_rows does.
+    """
+    with open(file_path, 'rb') as csvfile:
+        csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        header = csvreader.next()
+        if tuple(header) != COLUMNS:
+            raise Exception('Given file is not a dead-letter file.')
+        for imei, timestamp, query_string, activity, location, kind, _, _ \
+                in csvreader:
+            if kinds is not None and kind not in kinds:
+                continue
+            yield (imei, datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S'),
+                   query_string, activity,
+                   tuple([float(coordinate)
+                          for coordinate in location.split(',')]))
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Geodesic Module for the Recommendation System.
+
+Vectorized distances between GPS locations (WGS84 latitude and longitude,
+in degrees), computed with NumPy over whole arrays of points.
+
+Two methods are available:
+
+'vincenty'      : Vincenty's inverse formula on the WGS84 ellipsoid, the
+                  same as geopy.distance.vincenty, accurate to well under a
+                  millimeter. The pairs for which the iteration does not
+                  converge (nearly antipodal points) get the haversine
+                  distance instead.
+'haversine'     : The great circle distance on a sphere of radius
+                  EARTH_RADIUS. An order of magnitude faster, it differs from
+                  the ellipsoidal distance by at most 0.56%, and by less
+                  than 0.3% for most pairs (that is less than 3 meters per
+                  kilometer).
+
+@author: ymiche
+@version: 0.1
+"""
+
+import numpy as np
+
+
+# Mean Earth radius, in meters
+EARTH_RADIUS = 6371008.8
+
+# WGS84 ellipsoid
+MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+MINOR_AXIS = (1 - FLATTENING) * MAJOR_AXIS
+
+METHODS = ('vincenty', 'haversine')
+
+# Iteration limits of Vincenty's formula
+VINCENTY_TOLERANCE = 1e-12
+VINCENTY_ITERATIONS = 200
+
+# Default number of distances computed at once by many_to_many
+CHUNK_ELEMENTS = 1 << 20
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """
+    Calculates the great circle distances between the given points, on a
+    spherical Earth. The arguments are arrays of coordinates in degrees,
+    broadcast against each other.
+
+    Returns
+    -------
+    Returns the array of the distances in meters.
+    """
+    latitude1, longitude1, latitude2, longitude2 = \
+        [np.radians(np.asarray(coordinate, dtype=np.float64)) for coordinate
+         in (latitude1, longitude1, latitude2, longitude2)]
+    hav = np.sin((latitude2 - latitude1) / 2.0) ** 2 + \
+        np.cos(latitude1) * np.cos(latitude2) * \
+        np.sin((longitude2 - longitude1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(hav, 0.0, 1.0)))
+
+
+def vincenty(latitude1, longitude1, latitude2, longitude2):
+    """
+    Calculates the distances between the given points on the WGS84
+    ellipsoid, with Vincenty's inverse formula. The arguments are arrays of
+    coordinates in degrees, broadcast against each other.
+
+    Returns
+    -------
+    Returns the array of the distances in meters.
+    """
+    latitude1, longitude1, latitude2, longitude2 = np.broadcast_arrays(
+        *[np.asarray(coordinate, dtype=np.float64) for coordinate
+          in (latitude1, longitude1, latitude2, longitude2)])
+    shape = latitude1.shape
+    difference = np.radians(longitude2 - longitude1).ravel()
+    reduced1 = np.arctan((1 - FLATTENING) *
+                         np.tan(np.radians(latitude1))).ravel()
+    reduced2 = np.arctan((1 - FLATTENING) *
+                         np.tan(np.radians(latitude2))).ravel()
+    sin_u1, cos_u1 = np.sin(reduced1), np.cos(reduced1)
+    sin_u2, cos_u2 = np.sin(reduced2), np.cos(reduced2)
+
+    size = difference.size
+    sin_sigma = np.empty(size)
+    cos_sigma = np.empty(size)
+    sigma = np.empty(size)
+    cos_sq_alpha = np.empty(size)
+    cos_2sigma_m = np.empty(size)
+    lambda_ = difference.copy()
+    # Only the pairs which have not converged yet are iterated over
+    active = np.arange(size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in xrange(VINCENTY_ITERATIONS):
+            s_u1, c_u1 = sin_u1[active], cos_u1[active]
+            s_u2, c_u2 = sin_u2[active], cos_u2[active]
+            sin_lambda = np.sin(lambda_[active])
+            cos_lambda = np.cos(lambda_[active])
+            sin_s = np.hypot(c_u2 * sin_lambda,
+                             c_u1 * s_u2 - s_u1 * c_u2 * cos_lambda)
+            cos_s = s_u1 * s_u2 + c_u1 * c_u2 * cos_lambda
+            sig = np.arctan2(sin_s, cos_s)
+            # Coincident points have a null sin_sigma
+            sin_alpha = np.where(sin_s == 0, 0.0,
+                                 c_u1 * c_u2 * sin_lambda / sin_s)
+            cos_sq_a = 1 - sin_alpha ** 2
+            # Equatorial lines have a null cos_sq_alpha
+            cos_2s_m = np.where(cos_sq_a == 0, 0.0,
+                                cos_s - 2 * s_u1 * s_u2 / cos_sq_a)
+            c = FLATTENING / 16 * cos_sq_a * \
+                (4 + FLATTENING * (4 - 3 * cos_sq_a))
+            updated = difference[active] + \
+                (1 - c) * FLATTENING * sin_alpha * \
+                (sig + c * sin_s *
+                 (cos_2s_m + c * cos_s * (-1 + 2 * cos_2s_m ** 2)))
+            converged = np.abs(updated - lambda_[active]) <= \
+                VINCENTY_TOLERANCE
+            lambda_[active] = updated
+            sin_sigma[active] = sin_s
+            cos_sigma[active] = cos_s
+            sigma[active] = sig
+            cos_sq_alpha[active] = cos_sq_a
+            cos_2sigma_m[active] = cos_2s_m
+            active = active[~converged]
+            if active.size == 0:
+                break
+
+    u_sq = cos_sq_alpha * (MAJOR_AXIS ** 2 - MINOR_AXIS ** 2) / \
+        MINOR_AXIS ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * \
+        (cos_2sigma_m + b / 4 *
+         (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+          b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) *
+          (-3 + 4 * cos_2sigma_m ** 2)))
+    distances = MINOR_AXIS * a * (sigma - delta_sigma)
+    if active.size:
+        distances[active] = haversine(latitude1.ravel()[active],
+                                      longitude1.ravel()[active],
+                                      latitude2.ravel()[active],
+                                      longitude2.ravel()[active])
+    return distances.reshape(shape)
+
+
+def distances(points1, points2, method='vincenty'):
+    """
+    Calculates the distances between the pairs of points, element-wise.
+
+    Parameters
+    ----------
+    points1             : array of shape (..., 2)
+                        The (latitude, longitude) couples, in degrees.
+    points2             : array of shape (..., 2)
+                        Same as for points1, broadcast against points1.
+    method              : str
+                        One of METHODS.
+
+    Returns
+    -------
+    Returns the array of the distances in meters.
+    """
+    points1 = _points(points1)
+    points2 = _points(points2)
+    if method == 'vincenty':
+        kernel = vincenty
+    elif method == 'haversine':
+        kernel = haversine
+    else:
+        raise Exception('Given geodesic method is not recognized.')
+    return kernel(points1[..., 0], points1[..., 1],
+                  points2[..., 0], points2[..., 1])
+
+
+def distance(point1, point2, method='vincenty'):
+    """
+    Calculates the distance between two points, as a float in meters.
+    """
+    return float(distances(point1, point2, method))
+
+
+def one_to_many(point, points, method='vincenty'):
+    """
+    Calculates the distances between one point and an array of points.
+
+    Parameters
+    ----------
+    point               : (float, float)
+                        A couple of GPS coordinates.
+    points              : array of shape (M, 2)
+                        The points to compare against.
+    method              : str
+                        One of METHODS.
+
+    Returns
+    -------
+    Returns the array of the M distances in meters.
+    """
+    point = _points(point)
+    if point.shape != (2,):
+        raise Exception('Given point is not a couple of coordinates.')
+    return distances(point[np.newaxis, :], _points(points).reshape(-1, 2),
+                     method)
+
+
+def iter_many_to_many(points1, points2, method='vincenty', chunk_size=None):
+    """
+    Calculates the distances between all the points of points1 and all the
+    points of points2, a block of rows at a time, so that the memory used
+    stays bounded whatever the number of points.
+
+    Parameters
+    ----------
+    points1             : array of shape (N, 2)
+                        The first set of points.
+    points2             : array of shape (M, 2)
+                        The second set of points.
+    method              : str
+                        One of METHODS.
+    chunk_size          : int
+                        The number of rows of each block. Defaults to a size
+                        holding about CHUNK_ELEMENTS distances.
+
+    Returns
+    -------
+    Yields (start, block) couples, block being the array of shape
+    (rows, M) of the distances for points1[start:start + rows].
+    """
+    points1 = _points(points1).reshape(-1, 2)
+    points2 = _points(points2).reshape(-1, 2)
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_ELEMENTS // max(1, len(points2)))
+    if chunk_size < 1:
+        raise Exception('Given chunk size is smaller than one.')
+    for start in xrange(0, len(points1), chunk_size):
+        block = points1[start:start + chunk_size]
+        yield start, distances(block[:, np.newaxis, :],
+                               points2[np.newaxis, :, :], method)
+
+
+def many_to_many(points1, points2, method='vincenty', chunk_size=None):
+    """
+    Calculates the (N, M) matrix of the distances between all the points of
+    points1 and all the points of points2, in blocks of rows.
+    See iter_many_to_many for the parameters.
+    """
+    points1 = _points(points1).reshape(-1, 2)
+    points2 = _points(points2).reshape(-1, 2)
+    matrix = np.empty((len(points1), len(points2)))
+    for start, block in iter_many_to_many(points1, points2, method,
+                                          chunk_size):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+
+def _points(points):
+    """
+    Returns the points as a float array, the last axis holding the
+    coordinates.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim == 0 or points.shape[-1] != 2:
+        raise Exception('Given points do not have the correct number of \
+            coordinates.')
+    return points
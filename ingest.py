@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Ingest Module for the Recommendation System.
+
+Multi-process ingestion of a CSV file, sharded by IMEI.
+
+The file is split into byte ranges aligned on row boundaries. In a first
+pass, each process reads one range and spools its rows to one file per
+shard, the shard of a row being a hash of its IMEI. In a second pass, each
+process parses, resolves and writes the rows of one shard, reading the
+spool files of that shard in range order, so that the rows of an IMEI keep
+their order in the file. As the IMEIs of two shards never overlap, the
+processes never write to the same user state file.
+
+The rows must not contain quoted line breaks.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import csv
+import time
+import zlib
+import shutil
+import tempfile
+import multiprocessing
+
+import parser as parser_module
+import song as song_module
+from resolver import TokenBucket, resolve_songs
+from writer import UserStateWriter
+from store import ColumnarStore
+from metrics import METRICS
+
+
+def shard_of(imei, shards):
+    """
+    Returns the shard of the IMEI, stable across processes and runs.
+    """
+    return zlib.crc32(imei) % shards
+
+
+def split_byte_ranges(file_path, count):
+    """
+    Splits the CSV file into at most count byte ranges, each starting at the
+    beginning of a row, the header line excluded.
+
+    Returns
+    -------
+    Returns the list of the (start, end) offsets of the ranges.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as csvfile:
+        first = 0
+        if csv.Sniffer().has_header(csvfile.read(1024)):
+            csvfile.seek(0)
+            csvfile.readline()
+            first = csvfile.tell()
+        offsets = [first]
+        for index in xrange(1, count):
+            position = first + (size - first) * index // count
+            if position <= offsets[-1]:
+                continue
+            csvfile.seek(position - 1)
+            # Moves to the beginning of the next row, unless the position is
+            # one already
+            csvfile.readline()
+            if csvfile.tell() < size and csvfile.tell() > offsets[-1]:
+                offsets.append(csvfile.tell())
+    offsets.append(size)
+    return [(offsets[index], offsets[index + 1])
+            for index in xrange(len(offsets) - 1)]
+
+
+def read_range(file_path, start, end):
+    """
+    Iterates over the lines of the file starting in [start, end).
+    """
+    with open(file_path, 'rb') as csvfile:
+        csvfile.seek(start)
+        while csvfile.tell() < end:
+            line = csvfile.readline()
+            if not line:
+                return
+            yield line
+
+
+def spool_path(spool_directory, range_index, shard):
+    """
+    Returns the path of the spool file of a range and a shard.
+    """
+    return os.path.join(spool_directory, '%d-%d.csv' % (range_index, shard))
+
+
+def parallel_parse_csv(file_path, processes=None, output='.', store='pickle',
+                       workers=1):
+    """
+    Parses the CSV file on several processes, and writes the user states.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the CSV file.
+    processes           : int
+                        The number of processes, defaults to the number of
+                        CPUs.
+    output              : str
+                        The directory the user states are written to.
+    store               : str
+                        The kind of store written to: 'pickle' for the
+                        writer.UserStateWriter files, 'columnar' for a
+                        store.ColumnarStore. The columnar store of each
+                        process is merged into the output one at the end.
+    workers             : int
+                        The number of threads resolving the songs in each
+                        process, see parser.parse_csv.
+
+    Returns
+    -------
+    Returns a dict with the statistics of the ingestion, summed over the
+    processes, and the ones of each shard under 'shards'.
+    """
+    if store not in ('pickle', 'columnar'):
+        raise Exception('Given store kind is not recognized.')
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 1:
+        raise Exception('Given number of processes is smaller than one.')
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    start_time = time.time()
+    ranges = split_byte_ranges(file_path, processes)
+    spool_directory = tempfile.mkdtemp(prefix='ingest-', dir=output)
+    rate = None
+    if song_module.RATE_LIMITER is not None:
+        rate = song_module.RATE_LIMITER.rate / processes
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(_partition_range,
+                 [(file_path, start, end, processes, spool_directory, index)
+                  for index, (start, end) in enumerate(ranges)])
+        shard_stats = pool.map(_ingest_shard,
+                               [(shard, len(ranges), processes,
+                                 spool_directory, output, store, workers,
+                                 rate)
+                                for shard in xrange(processes)])
+        pool.close()
+        if store == 'columnar':
+            with ColumnarStore(output) as columnar_store:
+                for shard in xrange(processes):
+                    columnar_store.merge(os.path.join(spool_directory,
+                                                      'shard-%d' % shard))
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(spool_directory, ignore_errors=True)
+    stats = {'rows': 0, 'states_written': 0, 'rows_dropped': 0}
+    for shard in shard_stats:
+        for key in stats:
+            stats[key] += shard[key]
+        if song_module.CACHE is not None:
+            song_module.CACHE.merge(shard['release_ids'], shard['details'])
+        METRICS.merge(shard['metrics'])
+        del shard['release_ids'], shard['details'], shard['metrics']
+    stats['shards'] = shard_stats
+    stats['seconds'] = time.time() - start_time
+    stats['rows_per_second'] = stats['rows'] / stats['seconds'] \
+        if stats['seconds'] else 0.0
+    return stats
+
+
+def _partition_range(arguments):
+    """
+    Spools the rows of a byte range to one file per shard.
+    Returns the number of rows spooled.
+    """
+    file_path, start, end, shards, spool_directory, range_index = arguments
+    spool_files = [open(spool_path(spool_directory, range_index, shard), 'wb')
+                   for shard in xrange(shards)]
+    count = 0
+    try:
+        for line in read_range(file_path, start, end):
+            row = csv.reader([line], delimiter=',', quotechar='"').next()
+            if len(row) < 3:
+                continue
+            spool_files[shard_of(row[2], shards)].write(line)
+            count += 1
+    finally:
+        for spool_file in spool_files:
+            spool_file.close()
+    return count
+
+
+def _ingest_shard(arguments):
+    """
+    Parses, resolves and writes the spooled rows of a shard.
+    Returns the statistics of the shard.
+    """
+    shard, range_count, shards, spool_directory, output, store, workers, \
+        rate = arguments
+    start_time = time.time()
+    # The metrics of the process are sent back to the parent ones
+    METRICS.reset()
+    if rate is not None:
+        song_module.RATE_LIMITER = TokenBucket(rate)
+    paths = [spool_path(spool_directory, range_index, shard)
+             for range_index in xrange(range_count)]
+    counter = {'rows': 0}
+
+    def rows():
+        for path in paths:
+            with open(path, 'rb') as spool_file:
+                for row in csv.reader(spool_file, delimiter=',',
+                                      quotechar='"'):
+                    counter['rows'] += 1
+                    yield row
+
+    if workers > 1:
+        resolve_songs(set(row[4] for row in rows() if len(row) > 4), workers)
+        counter['rows'] = 0
+    if store == 'columnar':
+        shard_store = ColumnarStore(os.path.join(spool_directory,
+                                                 'shard-%d' % shard))
+    else:
+        shard_store = UserStateWriter(output)
+    with shard_store:
+        written = parser_module.write_user_states(
+            parser_module.resolve_user_states(
+                parser_module.parse_rows(rows())), shard_store)
+    stats = {'shard': shard,
+             'rows': counter['rows'],
+             'states_written': written,
+             'rows_dropped': counter['rows'] - written,
+             'seconds': time.time() - start_time,
+             'release_ids': [],
+             'details': [],
+             'metrics': METRICS.snapshot(),
+            }
+    # The metadata resolved by the process is sent back to the parent cache,
+    # leaving out the entries inherited from it
+    if song_module.CACHE is not None:
+        stats['release_ids'], stats['details'] = \
+            song_module.CACHE.entries(since=start_time)
+    return stats
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics Module for the Recommendation System.
+
+Counters and stage timers of the ingestion pipeline, shared by all the
+modules through METRICS:
+
+Counters        : rows_parsed, rows_dropped, discogs_calls, discogs_retries,
+                  cache_hits, cache_misses, negative_cache_hits,
+                  release_db_hits, release_db_misses, text_index_hits,
+                  text_index_misses, coalesced_calls, geocode_calls,
+                  states_written, bytes_written.
+Timers          : parse, resolve, write (the stages of parser.parse_csv),
+                  discogs and geocode (the time spent waiting on them).
+
+The metrics are logged, and passed to the hooks registered with
+Metrics.add_hook, on every Metrics.emit call, periodically with a
+ProgressReporter.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters and timers.
+
+    Parameters
+    ----------
+    enabled             : bool
+                        Whether the counts and times are recorded. A
+                        disabled registry returns at once from every call.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}
+        self.timers = {}
+        self.hooks = []
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def increment(self, name, count=1):
+        """
+        Adds count to the counter.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def add_time(self, name, seconds, count=1):
+        """
+        Adds the seconds spent in count calls to the timer.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            total, calls = self.timers.get(name, (0.0, 0))
+            self.timers[name] = (total + seconds, calls + count)
+
+    def timer(self, name):
+        """
+        Returns a context manager adding the time spent in its block to the
+        timer.
+        """
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """
+        Returns a dict with the counters, the timers as {'seconds', 'count'}
+        dicts, and the seconds elapsed since the registry was started or
+        reset.
+        """
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'timers': dict((name, {'seconds': total, 'count': calls})
+                                   for name, (total, calls)
+                                   in self.timers.iteritems()),
+                    'elapsed': time.time() - self.started,
+                   }
+
+    def merge(self, snapshot):
+        """
+        Adds the counters and timers of a snapshot, such as one taken in
+        another process.
+        """
+        for name, count in snapshot['counters'].iteritems():
+            self.increment(name, count)
+        for name, timer in snapshot['timers'].iteritems():
+            self.add_time(name, timer['seconds'], timer['count'])
+
+    def reset(self):
+        """
+        Clears the counters and timers.
+        """
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+            self.started = time.time()
+
+    def add_hook(self, hook):
+        """
+        Registers a callable exporting the metrics: it is called with every
+        snapshot emitted.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def emit(self):
+        """
+        Logs a snapshot of the metrics, and passes it to the hooks.
+        Returns the snapshot.
+        """
+        snapshot = self.snapshot()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s', format_snapshot(snapshot))
+        for hook in list(self.hooks):
+            try:
+                hook(snapshot)
+            except Exception:
+                logger.exception('Metrics hook %r failed.', hook)
+        return snapshot
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.time() - self.start)
+
+
+class ProgressReporter(object):
+    """
+    Background thread emitting the metrics every interval seconds, and once
+    more when stopped. Use it as a context manager, or call start and stop.
+
+    Parameters
+    ----------
+    metrics             : Metrics
+                        The registry emitted, METRICS by default.
+    interval            : float
+                        The time between two emissions, in seconds.
+    """
+
+    def __init__(self, metrics=None, interval=10.0):
+        if interval <= 0:
+            raise Exception('Given interval is not strictly positive.')
+        self.metrics = metrics if metrics is not None else METRICS
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.metrics.emit()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.emit()
+
+
+def format_snapshot(snapshot):
+    """
+    Returns a one-line summary of a snapshot, with the rate of rows parsed.
+    """
+    counters = snapshot['counters']
+    elapsed = snapshot['elapsed']
+    parts = ['%.1fs' % elapsed]
+    if elapsed > 0 and 'rows_parsed' in counters:
+        parts.append('%.0f rows/s' % (counters['rows_parsed'] / elapsed))
+    parts.extend('%s=%d' % item for item in sorted(counters.iteritems()))
+    parts.extend('%s=%.3fs' % (name, timer['seconds']) for name, timer
+                 in sorted(snapshot['timers'].iteritems()))
+    return ' '.join(parts)
+
+
+# Registry shared by the modules of the pipeline
+METRICS = Metrics()
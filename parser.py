@@ -6,67 +6,716 @@ Parser Module for the Recommendation System.
 @version: 0.1
 """
 
-from song import Song
-from user_state import UserState
+import song as song_module
+from song import intern_song
+from user_state import UserState, ACTIVITIES, ACTIVITY_NAMES
+from cache import MetadataCache, NegativeCache
+from dead_letters import DeadLetterWriter
+from release_db import ReleaseDatabase
+from text_index import TextIndex
+from resolver import TokenBucket, resolve_songs
+from writer import UserStateWriter
+from store import ColumnarStore
+from metrics import METRICS, ProgressReporter
+from checkpoint import Checkpoint, read_batches
+import ingest
 
+import time
+import logging
 from datetime import datetime
+from optparse import OptionParser
+from itertools import islice
+import numpy as np
 import csv
 import cPickle as pkl
-import sys
 import discogs_client as discogs
 
 
-def parse_csv(file_path):
+logger = logging.getLogger(__name__)
+
+# Writer the rows dropped on a failed song lookup are recorded with, see
+# dead_letters.DeadLetterWriter. Left to None, they are only counted.
+DEAD_LETTERS = None
+
+# Number of rows whose times and counts the row by row stages add up before
+# passing them to METRICS
+METRICS_BATCH = 1000
+
+
+def open_csv(csvfile):
+    """
+    Returns a csv reader over the opened file, positioned after the header
+    line if the file has one.
     """
-    Parse the data from the CSV file to a dict of user states.
+    if csv.Sniffer().has_header(csvfile.read(1024)):
+        logger.debug('CSV file has header, skipping first line.')
+        csvfile.seek(0)
+        csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        csvreader.next()
+    else:
+        csvfile.seek(0)
+        csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
+    return csvreader
+
+
+def read_rows(file_path):
+    """
+    Iterates over the rows of the CSV file, header excluded.
 
     Parameters
     ----------
+    file_path           : str
+                        The path of the CSV file.
 
     Returns
     -------
-    A dict of user states, imei as keys, values are list of user states
-    in the order they occurred.
+    Yields the rows as lists of strings.
     """
-    user_states_dict = {}
     with open(file_path, 'rb') as csvfile:
-        if __debug__:
-            print 'CSV file has header, skipping first line.'
-        if csv.Sniffer().has_header(csvfile.read(1024)):
-            csvfile.seek(0)
-            csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            csvreader.next()
-        else:
-            csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        for row in csvreader:
-            if __debug__:
-                print 'Iterating over rows of CSV file.'
+        for row in open_csv(csvfile):
+            yield row
+
+
+def parse_rows(rows):
+    """
+    Parses the CSV rows, without resolving their songs.
+
+    Parameters
+    ----------
+    rows                : iterable of lists of str
+                        The rows, as returned by read_rows.
+
+    Returns
+    -------
+    Yields (imei, timestamp, query_string, activity, location) tuples, with
+    the timestamp as a datetime and the location as a couple of floats.
+    """
+    if not METRICS.enabled:
+        for row in rows:
+            yield _parse_row(row)
+        return
+    seconds = 0.0
+    count = 0
+    try:
+        for row in rows:
+            start = time.time()
+            parsed_row = _parse_row(row)
+            seconds += time.time() - start
+            count += 1
+            if count == METRICS_BATCH:
+                _report('parse', seconds, count, 'rows_parsed', count)
+                seconds = 0.0
+                count = 0
+            yield parsed_row
+    finally:
+        _report('parse', seconds, count, 'rows_parsed', count)
+
+
+def _parse_row(row):
+    timestamp = datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S')
+    location = tuple([float(coordinate) for coordinate in row[7].split(',')])
+    return row[2], timestamp, row[4], row[8], location
+
+
+def _report(timer, seconds, count, counter, counter_count):
+    """
+    Adds the time spent on count rows, and a count to a counter, to METRICS.
+    """
+    if count:
+        METRICS.add_time(timer, seconds, count)
+    if counter_count:
+        METRICS.increment(counter, counter_count)
+
+
+def resolve_user_states(parsed_rows):
+    """
+    Builds the user states of the parsed rows, resolving their songs through
+    the song registry. The rows whose song lookup fails are dropped, and
+    recorded to DEAD_LETTERS if set.
+
+    Parameters
+    ----------
+    parsed_rows         : iterable of tuples
+                        The rows, as returned by parse_rows.
+
+    Returns
+    -------
+    Yields the UserState objects, in the order of the rows.
+    """
+    enabled = METRICS.enabled
+    seconds = 0.0
+    count = 0
+    dropped = 0
+    try:
+        for imei, timestamp, query_string, activity, location in parsed_rows:
+            if enabled:
+                start = time.time()
             try:
-                imei = row[2]
-                timestamp = datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S')
-                if __debug__:
-                    print 'Creating song object.'
-                song = Song(row[4])
-                activity = row[8]
-                location = tuple([float(coordinate) for coordinate in row[7].split(',')])
-                if __debug__:
-                    print 'Creating user state object.'
-                user_state = UserState(imei, activity, location, timestamp, song)
-                user_state.write()
-            except discogs.DiscogsAPIError:
-                pass
+                user_state = UserState(imei, activity, location, timestamp,
+                                       intern_song(query_string))
+            except discogs.DiscogsAPIError, error:
+                user_state = None
+                dropped += 1
+                logger.debug('Dropping row of %r: %s', query_string, error)
+                if DEAD_LETTERS is not None:
+                    DEAD_LETTERS.write(imei, timestamp, query_string,
+                                       activity, location, error)
+            if enabled:
+                seconds += time.time() - start
+                count += 1
+                if count == METRICS_BATCH:
+                    _report('resolve', seconds, count, 'rows_dropped',
+                            dropped)
+                    seconds = 0.0
+                    count = 0
+                    dropped = 0
+            if user_state is not None:
+                yield user_state
+    finally:
+        if enabled:
+            _report('resolve', seconds, count, 'rows_dropped', dropped)
+
+
+def write_user_states(user_states, store):
+    """
+    Writes the user states to the store.
+
+    Parameters
+    ----------
+    user_states         : iterable of UserState
+                        The user states to write, in order.
+    store               : store.UserStateStore
+                        The store the user states are written to.
+
+    Returns
+    -------
+    Returns the number of user states written.
+    """
+    count = 0
+    if not METRICS.enabled:
+        for user_state in user_states:
+            user_state.write(store)
+            count += 1
+        return count
+    seconds = 0.0
+    reported = 0
+    try:
+        for user_state in user_states:
+            start = time.time()
+            user_state.write(store)
+            seconds += time.time() - start
+            count += 1
+            if count - reported == METRICS_BATCH:
+                _report('write', seconds, METRICS_BATCH, 'states_written',
+                        METRICS_BATCH)
+                seconds = 0.0
+                reported = count
+    finally:
+        _report('write', seconds, count - reported, 'states_written',
+                count - reported)
+    return count
+
+
+def prefetch_songs(file_path, workers):
+    """
+    Resolves all the distinct songs of the CSV file concurrently, so that
+    the sequential parsing finds them in the song registry.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the CSV file.
+    workers             : int
+                        The number of threads doing the lookups.
+
+    Returns
+    -------
+    See resolver.resolve_songs.
+    """
+    query_strings = set(row[4] for row in read_rows(file_path)
+                        if len(row) > 4)
+    logger.info('Resolving %d distinct songs with %d workers.',
+                len(query_strings), workers)
+    return resolve_songs(query_strings, workers)
+
+
+def iter_user_states(file_path, workers=1):
+    """
+    Iterates over the user states of the CSV file, in constant memory.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the CSV file.
+    workers             : int
+                        The number of threads resolving the songs. With more
+                        than one worker, the distinct songs of the file are
+                        all resolved concurrently before the first user state
+                        is returned.
+
+    Returns
+    -------
+    Yields the UserState objects, in the order of the file.
+    """
+    if workers > 1:
+        prefetch_songs(file_path, workers)
+    return resolve_user_states(parse_rows(read_rows(file_path)))
+
+
+def parse_csv(file_path, workers=1, store=None):
+    """
+    Parse the data from the CSV file to user states, and write them to the
+    store. This chains read_rows, parse_rows, resolve_user_states and
+    write_user_states, which can also be used on their own.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the CSV file.
+    workers             : int
+                        The number of threads resolving the songs. With more
+                        than one worker, the distinct songs of the file are
+                        all resolved concurrently first, and the user states
+                        are then built and written in the file order.
+    store               : store.UserStateStore
+                        The store the user states are written to. If None,
+                        a writer.UserStateWriter is opened in the current
+                        directory, and closed at the end of the parsing.
+
+    Returns
+    -------
+    Returns the number of user states written.
+    """
+    close_store = store is None
+    if close_store:
+        store = UserStateWriter()
+    try:
+        return write_user_states(iter_user_states(file_path, workers), store)
+    finally:
+        if close_store:
+            store.close()
+            logger.info('Writer stats: %s', store.stats())
+
+
+def read_chunks(file_path, chunk_size=10000):
+    """
+    Reads the CSV file in blocks of rows, and parses each block into column
+    arrays, see parse_chunk.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the CSV file.
+    chunk_size          : int
+                        The number of rows in each block.
+
+    Returns
+    -------
+    Yields the parsed blocks, in the order of the file.
+    """
+    if chunk_size < 1:
+        raise Exception('Given chunk size is smaller than one.')
+    with open(file_path, 'rb') as csvfile:
+        csvreader = open_csv(csvfile)
+        while True:
+            rows = list(islice(csvreader, chunk_size))
+            if not rows:
+                return
+            with METRICS.timer('parse'):
+                chunk = parse_chunk(rows)
+            METRICS.increment('rows_parsed', len(rows))
+            yield chunk
+
+
+def parse_chunk(rows):
+    """
+    Parses a block of CSV rows into column arrays, without resolving their
+    songs. The timestamps and locations are converted in bulk by NumPy, and
+    the IMEIs and activities are validated for the whole block at once.
+
+    Parameters
+    ----------
+    rows                : list of lists of str
+                        The rows, as read from the CSV file.
+
+    Returns
+    -------
+    Returns a dict of arrays of the same length:
+    'imei'              : str array of the IMEIs
+    'timestamp'         : datetime64[s] array of the timestamps
+    'query_string'      : object array of the song query strings
+    'activity'          : int8 array of the activity codes (see
+                        user_state.ACTIVITIES)
+    'latitude'          : float64 array
+    'longitude'         : float64 array
+    """
+    imeis, timestamps, query_strings, activities, locations = \
+        zip(*[(row[2], row[1], row[4], row[8], row[7]) for row in rows])
+    imeis = np.array(imeis)
+    if (np.char.str_len(imeis) != 15).any():
+        raise Exception('Given IMEI has not the proper length \
+                                                        (15 digits).')
+    timestamps = np.array(timestamps)
+    if (np.char.str_len(timestamps) != 19).any():
+        raise Exception('Given timestamp is not in the expected format.')
+    timestamps = timestamps.astype('datetime64[s]')
+    names, inverse = np.unique(np.array(activities), return_inverse=True)
+    unknown = [name for name in names if name not in ACTIVITIES]
+    if unknown:
+        raise Exception('Given activity is not recognized.')
+    activities = np.array([ACTIVITIES[name] for name in names],
+                          dtype=np.int8)[inverse]
+    # The count of the whole block would let a row with three coordinates
+    # make up for one with a single one
+    if (np.char.count(np.array(locations), ',') != 1).any():
+        raise Exception('Given location does not have the correct number \
+            of coordinates.')
+    coordinates = np.fromstring(','.join(locations), sep=',')
+    if coordinates.size != 2 * len(rows):
+        raise Exception('Given location does not have the correct number \
+            of coordinates.')
+    coordinates = coordinates.reshape(-1, 2)
+    query_string_array = np.empty(len(rows), dtype=object)
+    query_string_array[:] = query_strings
+    return {'imei': imeis,
+            'timestamp': timestamps,
+            'query_string': query_string_array,
+            'activity': activities,
+            'latitude': coordinates[:, 0].copy(),
+            'longitude': coordinates[:, 1].copy(),
+           }
+
+
+def resolve_chunk(chunk, workers=1):
+    """
+    Resolves the distinct songs of a parsed block, and drops the rows whose
+    song lookup fails, recording them to DEAD_LETTERS if set.
+
+    Parameters
+    ----------
+    chunk               : dict of arrays
+                        The block, as returned by parse_chunk.
+    workers             : int
+                        The number of threads resolving the songs.
+
+    Returns
+    -------
+    Returns the block of the resolved rows, with an additional 'song'
+    object array of the Song objects.
+    """
+    start = time.time()
+    distinct = set(chunk['query_string'])
+    if workers > 1:
+        resolve_songs(distinct, workers)
+    songs = {}
+    errors = {}
+    for query_string in distinct:
+        try:
+            songs[query_string] = intern_song(query_string)
+        except discogs.DiscogsAPIError, error:
+            logger.debug('Dropping rows of %r: %s', query_string, error)
+            errors[query_string] = error
+    song_array = np.empty(len(chunk['query_string']), dtype=object)
+    song_array[:] = [songs.get(query_string) for query_string
+                     in chunk['query_string']]
+    resolved = np.not_equal(song_array, None)
+    if not resolved.all():
+        METRICS.increment('rows_dropped', len(resolved) - resolved.sum())
+        if DEAD_LETTERS is not None:
+            for index in np.flatnonzero(~resolved):
+                query_string = chunk['query_string'][index]
+                DEAD_LETTERS.write(
+                    str(chunk['imei'][index]),
+                    chunk['timestamp'][index].astype(object), query_string,
+                    ACTIVITY_NAMES[chunk['activity'][index]],
+                    (chunk['latitude'][index], chunk['longitude'][index]),
+                    errors[query_string])
+        chunk = dict((key, column[resolved]) for key, column
+                     in chunk.iteritems())
+        song_array = song_array[resolved]
+    chunk['song'] = song_array
+    METRICS.add_time('resolve', time.time() - start)
+    return chunk
+
+
+def chunk_user_states(chunks):
+    """
+    Iterates over the user states of resolved blocks, in order.
+    """
+    for chunk in chunks:
+        for imei, timestamp, activity, latitude, longitude, song in \
+                zip(chunk['imei'], chunk['timestamp'].astype(object),
+                    chunk['activity'], chunk['latitude'], chunk['longitude'],
+                    chunk['song']):
+            yield UserState(str(imei), ACTIVITY_NAMES[activity],
+                            (float(latitude), float(longitude)), timestamp,
+                            song)
+
+
+def write_chunks(chunks, store):
+    """
+    Writes resolved blocks to the store, a whole block at a time if the
+    store supports it (see store.ColumnarStore.write_chunk), one user state
+    at a time otherwise.
+
+    Returns
+    -------
+    Returns the number of user states written.
+    """
+    if not hasattr(store, 'write_chunk'):
+        return write_user_states(chunk_user_states(chunks), store)
+    count = 0
+    for chunk in chunks:
+        with METRICS.timer('write'):
+            store.write_chunk(chunk)
+        METRICS.increment('states_written', len(chunk['imei']))
+        count += len(chunk['imei'])
+    return count
+
+
+def parse_csv_chunked(file_path, workers=1, store=None, chunk_size=10000):
+    """
+    Same as parse_csv, the CSV file being read, parsed, resolved and written
+    in blocks of chunk_size rows.
+    """
+    close_store = store is None
+    if close_store:
+        store = UserStateWriter()
+    try:
+        return write_chunks((resolve_chunk(chunk, workers) for chunk
+                             in read_chunks(file_path, chunk_size)), store)
+    finally:
+        if close_store:
+            store.close()
+
+
+def parse_csv_incremental(file_path, checkpoint_path, workers=1, store=None,
+                          batch_size=10000, tail=False):
+    """
+    Same as parse_csv, resuming from the checkpoint of a previous run.
+
+    The rows are processed in batches of batch_size. The store only writes
+    when committed, after each batch, and the checkpoint records the byte
+    offset following the batch along with the committed sizes of the output
+    files, so that a run killed midway, even while committing, resumes after
+    the last committed batch with the output files truncated back to it.
+    Run again on a file appended to, only the new rows are processed; a file
+    replaced or truncated is processed from its beginning.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the CSV file. Its rows must not contain
+                        quoted line breaks.
+    checkpoint_path     : str
+                        The path of the checkpoint file, see
+                        checkpoint.Checkpoint.
+    workers             : int
+                        The number of threads resolving the songs of each
+                        batch.
+    store               : store.UserStateStore
+                        The store the user states are written to. If None,
+                        a writer.UserStateWriter is opened in the current
+                        directory, and closed at the end of the parsing.
+    batch_size          : int
+                        The number of rows committed at once.
+    tail                : bool
+                        Whether the file is still being appended to: an
+                        incomplete last line is then left for the next run.
+
+    Returns
+    -------
+    Returns the number of user states written.
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    offset = checkpoint.start_offset(file_path)
+    dead_letter_paths = [DEAD_LETTERS.file_path] \
+        if DEAD_LETTERS is not None else []
+    checkpoint.prepare(dead_letter_paths)
+    close_store = store is None
+    if close_store:
+        store = UserStateWriter()
+    deferred = store.deferred
+    store.deferred = True
+    count = 0
+    try:
+        for lines, offset in read_batches(file_path, offset, batch_size,
+                                          tail):
+            rows = list(csv.reader(lines, delimiter=',', quotechar='"'))
+            if workers > 1:
+                resolve_songs(set(row[4] for row in rows if len(row) > 4),
+                              workers)
+            count += write_user_states(resolve_user_states(parse_rows(rows)),
+                                       store)
+            checkpoint.prepare(store.pending_paths())
+            store.commit()
+            if DEAD_LETTERS is not None:
+                DEAD_LETTERS.flush()
+            checkpoint.commit(file_path, offset, len(rows), dead_letter_paths)
+            logger.debug('Committed %s up to byte %d.', file_path, offset)
+    except BaseException:
+        # The batch buffered is written when the store is closed: it is
+        # truncated when resuming
+        checkpoint.prepare(store.pending_paths())
+        raise
+    finally:
+        store.deferred = deferred
+        if close_store:
+            store.close()
+    return count
 
 
 def main():
     """
     Runs the parsing on the csv file, and writes the updates to the user
     states to disk.
-    """
-    args = sys.argv
-    if __debug__:
-        print 'Starting the parsing of CSV file...'
-    parse_csv(args[1])
 
+    Usage: parser.py [options] <csv file>
+    """
+    global DEAD_LETTERS
+    option_parser = OptionParser(usage='%prog [options] <csv file>')
+    option_parser.add_option('-c', '--cache', dest='cache',
+                             help='metadata cache file')
+    option_parser.add_option('-j', '--workers', dest='workers', type='int',
+                             default=1,
+                             help='number of threads resolving the songs')
+    option_parser.add_option('-r', '--rate', dest='rate', type='float',
+                             help='maximum number of Discogs calls per second')
+    option_parser.add_option('-s', '--store', dest='store', default='pickle',
+                             choices=['pickle', 'columnar'],
+                             help='user state store: pickle (default) or '
+                                  'columnar')
+    option_parser.add_option('-o', '--output', dest='output', default='.',
+                             help='directory the user states are written to')
+    option_parser.add_option('-k', '--chunk-size', dest='chunk_size',
+                             type='int',
+                             help='parse the file in blocks of that many '
+                                  'rows')
+    option_parser.add_option('-p', '--processes', dest='processes',
+                             type='int', default=1,
+                             help='number of processes, the rows being '
+                                  'sharded by IMEI')
+    option_parser.add_option('-v', '--verbose', dest='log_level',
+                             action='store_const', const=logging.DEBUG,
+                             default=logging.INFO,
+                             help='log every lookup and dropped row')
+    option_parser.add_option('-q', '--quiet', dest='log_level',
+                             action='store_const', const=logging.WARNING,
+                             help='only log warnings and errors')
+    option_parser.add_option('-i', '--progress', dest='progress',
+                             type='float', default=10.0,
+                             help='seconds between two progress reports, 0 '
+                                  'to disable them')
+    option_parser.add_option('-M', '--no-metrics', dest='metrics',
+                             action='store_false', default=True,
+                             help='do not record the pipeline metrics, nor '
+                                  'report the progress')
+    option_parser.add_option('-C', '--checkpoint', dest='checkpoint',
+                             help='checkpoint file: resume from it, and '
+                                  'update it after every block of rows')
+    option_parser.add_option('-t', '--tail', dest='tail',
+                             action='store_true', default=False,
+                             help='only process the complete rows appended '
+                                  'since the checkpoint, for a file still '
+                                  'being written')
+    option_parser.add_option('-d', '--dead-letters', dest='dead_letters',
+                             help='CSV file the rows dropped on a failed '
+                                  'song lookup are appended to')
+    option_parser.add_option('-n', '--negative-ttl', dest='negative_ttl',
+                             type='float', default=86400.0,
+                             help='seconds a query string that could not be '
+                                  'resolved is not looked up again, 0 to '
+                                  'always look it up')
+    option_parser.add_option('-R', '--retries', dest='retries', type='int',
+                             default=song_module.RETRIES,
+                             help='number of retries of a Discogs call '
+                                  'failing with a transient error')
+    option_parser.add_option('-D', '--release-db', dest='release_db',
+                             help='local release database, see release_db')
+    option_parser.add_option('-T', '--text-index', dest='text_index',
+                             help='full-text index of the releases, see '
+                                  'text_index, updated with the songs '
+                                  'found on Discogs')
+    option_parser.add_option('-x', '--offline', dest='offline',
+                             action='store_true', default=False,
+                             help='never call Discogs, dropping the songs '
+                                  'not in the cache nor the release database')
+    options, args = option_parser.parse_args()
+    if len(args) != 1:
+        option_parser.error('Expected exactly one CSV file.')
+    if options.workers < 1:
+        option_parser.error('The number of workers must be at least one.')
+    if options.processes < 1:
+        option_parser.error('The number of processes must be at least one.')
+    if options.tail and options.checkpoint is None:
+        option_parser.error('Tail mode requires a checkpoint file.')
+    if options.checkpoint is not None and options.processes > 1:
+        option_parser.error('Checkpoints require a single process.')
+    if options.dead_letters is not None and options.processes > 1:
+        option_parser.error('Dead letters require a single process.')
+    if options.retries < 0:
+        option_parser.error('The number of retries cannot be negative.')
+    song_module.RETRIES = options.retries
+    if options.release_db is not None:
+        song_module.RELEASE_DB = ReleaseDatabase(options.release_db)
+    if options.text_index is not None:
+        song_module.TEXT_INDEX = TextIndex(options.text_index)
+    song_module.OFFLINE = options.offline
+    if options.negative_ttl > 0:
+        song_module.NEGATIVE_CACHE = NegativeCache(ttl=options.negative_ttl)
+    if options.cache is not None:
+        song_module.CACHE = MetadataCache(options.cache)
+    if options.rate is not None:
+        song_module.RATE_LIMITER = TokenBucket(options.rate)
+    logging.basicConfig(level=options.log_level,
+                        format='%(asctime)s %(levelname)s %(name)s: '
+                               '%(message)s')
+    logger.info('Starting the parsing of CSV file %s.', args[0])
+    if options.dead_letters is not None:
+        DEAD_LETTERS = DeadLetterWriter(options.dead_letters)
+    METRICS.enabled = options.metrics
+    reporter = None
+    if options.metrics and options.progress > 0:
+        reporter = ProgressReporter(METRICS, options.progress)
+        reporter.start()
+    try:
+        if options.processes > 1:
+            stats = ingest.parallel_parse_csv(args[0], options.processes,
+                                              options.output, options.store,
+                                              options.workers)
+            logger.info('Ingest stats: %s', stats)
+        else:
+            if options.store == 'columnar':
+                store = ColumnarStore(options.output)
+            else:
+                store = UserStateWriter(options.output)
+            with store:
+                if options.checkpoint is not None:
+                    parse_csv_incremental(args[0], options.checkpoint,
+                                          options.workers, store,
+                                          options.chunk_size or 10000,
+                                          options.tail)
+                elif options.chunk_size is not None:
+                    parse_csv_chunked(args[0], options.workers, store,
+                                      options.chunk_size)
+                else:
+                    parse_csv(args[0], options.workers, store)
+    finally:
+        if reporter is not None:
+            reporter.stop()
+        if song_module.CACHE is not None:
+            song_module.CACHE.save()
+            logger.info('Metadata cache stats: %s',
+                        song_module.CACHE.stats())
+        if song_module.TEXT_INDEX is not None:
+            song_module.TEXT_INDEX.save()
+        if song_module.NEGATIVE_CACHE is not None:
+            logger.info('Negative cache stats: %s',
+                        song_module.NEGATIVE_CACHE.stats())
+        if DEAD_LETTERS is not None:
+            DEAD_LETTERS.close()
+            logger.info('%d rows written to the dead letters.',
+                        DEAD_LETTERS.rows_written)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Reader Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import sys
+import zlib
+import cPickle as pkl
+from cStringIO import StringIO
+
+import numpy as np
+
+from store import encode_timestamp
+
+
+# zlib window bits for decoding a gzip member
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+READ_SIZE = 1 << 16
+
+
+class UserStateReader(object):
+    """
+    Lazy reader of the '<imei>.pkl.gz' user state files written by
+    UserState.write and writer.UserStateWriter.
+
+    A sidecar '<imei>.pkl.gz.idx' index maps every user state to the offset
+    of its gzip member in the file, its offset in the decompressed member
+    and its timestamp. The index is built on first use, updated for the
+    data appended since, and saved along the file, so that the most recent
+    states or the states of a time window are read by decoding only the
+    members holding them. writer.UserStateWriter bounds the size of the
+    members for that purpose; a file written as a single member is decoded
+    in full.
+
+    A gzip member still being written (by a writer not yet closed) is left
+    out of the index until it is complete.
+
+    Parameters
+    ----------
+    path                : str
+                        The path of the user state file.
+    index_path          : str
+                        The path of the sidecar index, defaults to path
+                        followed by '.idx'.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self.size = 0
+        self.members = np.zeros(0, dtype=np.int64)
+        self.record_members = np.zeros(0, dtype=np.int32)
+        self.record_offsets = np.zeros(0, dtype=np.int64)
+        self.timestamps = np.zeros(0, dtype=np.int64)
+        if os.path.exists(self.index_path):
+            self._load_index()
+        self.build_index()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        """
+        Iterates lazily over all the indexed user states, in file order.
+        """
+        return self.read(xrange(len(self)))
+
+    def build_index(self):
+        """
+        Indexes the gzip members appended to the file since the index was
+        last built, and saves the index if it changed.
+        Returns the number of user states added to the index.
+        """
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size < self.size:
+            # The file was rewritten, the index is stale
+            self.size = 0
+            self.members = np.zeros(0, dtype=np.int64)
+            self.record_members = np.zeros(0, dtype=np.int32)
+            self.record_offsets = np.zeros(0, dtype=np.int64)
+            self.timestamps = np.zeros(0, dtype=np.int64)
+        if size == self.size:
+            return 0
+        members = list(self.members)
+        record_members = []
+        record_offsets = []
+        timestamps = []
+        with open(self.path, 'rb') as raw_file:
+            for start, end, data in _members(raw_file, self.size):
+                member_index = len(members)
+                members.append(start)
+                for offset, timestamp in _scan_records(data):
+                    record_members.append(member_index)
+                    record_offsets.append(offset)
+                    timestamps.append(timestamp)
+                self.size = end
+        if not record_members and len(members) == len(self.members):
+            return 0
+        self.members = np.array(members, dtype=np.int64)
+        self.record_members = np.concatenate(
+            [self.record_members, np.array(record_members, dtype=np.int32)])
+        self.record_offsets = np.concatenate(
+            [self.record_offsets, np.array(record_offsets, dtype=np.int64)])
+        self.timestamps = np.concatenate(
+            [self.timestamps, np.array(timestamps, dtype=np.int64)])
+        self._save_index()
+        return len(record_members)
+
+    def read(self, positions):
+        """
+        Iterates over the user states at the given positions in the file
+        (0 being the first one written), decoding each gzip member once for
+        consecutive positions in the same member.
+        """
+        member_index = None
+        data = None
+        for position in positions:
+            if self.record_members[position] != member_index:
+                member_index = self.record_members[position]
+                data = self._member_data(member_index)
+            yield pkl.load(StringIO(
+                buffer(data, int(self.record_offsets[position]))))
+
+    def latest(self, count):
+        """
+        Returns the list of the count most recently written user states, in
+        the order they were written.
+        """
+        return list(self.read(xrange(max(0, len(self) - count), len(self))))
+
+    def between(self, start, end):
+        """
+        Iterates over the user states with a timestamp in [start, end), in
+        the order they were written.
+
+        Parameters
+        ----------
+        start               : datetime.datetime
+                            The beginning of the time window.
+        end                 : datetime.datetime
+                            The end of the time window, excluded.
+        """
+        start, end = encode_timestamp(start), encode_timestamp(end)
+        if len(self) and (np.diff(self.timestamps) >= 0).all():
+            positions = xrange(np.searchsorted(self.timestamps, start),
+                               np.searchsorted(self.timestamps, end))
+        else:
+            positions = np.flatnonzero((self.timestamps >= start) &
+                                       (self.timestamps < end))
+        return self.read(positions)
+
+    def _member_data(self, member_index):
+        """
+        Returns the decompressed data of a gzip member.
+        """
+        start = self.members[member_index]
+        if member_index + 1 < len(self.members):
+            end = self.members[member_index + 1]
+        else:
+            end = self.size
+        with open(self.path, 'rb') as raw_file:
+            raw_file.seek(start)
+            return zlib.decompressobj(GZIP_WBITS).decompress(
+                raw_file.read(end - start))
+
+    def _load_index(self):
+        with open(self.index_path, 'rb') as index_file:
+            index = pkl.load(index_file)
+        if index.get('version') != self.VERSION:
+            return
+        self.size = index['size']
+        self.members = index['members']
+        self.record_members = index['record_members']
+        self.record_offsets = index['record_offsets']
+        self.timestamps = index['timestamps']
+
+    def _save_index(self):
+        index = {'version': self.VERSION,
+                 'size': self.size,
+                 'members': self.members,
+                 'record_members': self.record_members,
+                 'record_offsets': self.record_offsets,
+                 'timestamps': self.timestamps,
+                }
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as index_file:
+            pkl.dump(index, index_file, pkl.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.index_path)
+
+
+def _members(raw_file, start):
+    """
+    Iterates over the complete gzip members of the file from the start
+    offset. Yields (start, end, decompressed data) triples.
+    """
+    raw_file.seek(start)
+    position = start
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    parts = []
+    while True:
+        chunk = raw_file.read(READ_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            parts.append(decompressor.decompress(chunk))
+            if decompressor.unused_data:
+                # The member ended inside this chunk
+                end = position + len(chunk) - len(decompressor.unused_data)
+                chunk = decompressor.unused_data
+                yield start, end, ''.join(parts)
+                start = position = end
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                parts = []
+            else:
+                position += len(chunk)
+                chunk = ''
+    # A finished decompressor leaves any further input in unused_data, which
+    # tells whether the last member is complete
+    if parts and decompressor.decompress('\x1f') == '' and \
+            decompressor.unused_data == '\x1f':
+        yield start, position, ''.join(parts)
+
+
+def _scan_records(data):
+    """
+    Iterates over the pickled user states of a decompressed member, without
+    resolving their songs. Yields (offset, timestamp) couples.
+    """
+    stream = StringIO(data)
+    while stream.tell() < len(data):
+        offset = stream.tell()
+        unpickler = pkl.Unpickler(stream)
+        unpickler.find_global = _find_global
+        user_state = unpickler.load()
+        yield offset, encode_timestamp(user_state.timestamp)
+
+
+def _find_global(module, name):
+    """
+    Resolves the globals of the pickles, replacing the song interning by the
+    bare query string so that scanning never looks a song up.
+    """
+    if module == 'song' and name == 'intern_song':
+        return _query_string
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+def _query_string(query_string, lazy=False):
+    """
+    Stands for song.intern_song in the pickles scanned, see _find_global.
+    """
+    return query_string
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Recommender Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import numpy as np
+import discogs_client as discogs
+
+import geodesic
+from song import intern_song, normalize_query_string
+from user_state import UserState, ACTIVITIES
+from store import ColumnarStore, encode_timestamp
+from spatial_index import SpatialIndex
+from catalog import SongCatalog, DEFAULT_WEIGHTS as SONG_WEIGHTS
+from resolver import resolve_all
+
+
+# Components of the score of a stored user state against the current one:
+# location      : distance in meters
+# activity      : absolute difference of the activity codes
+# time          : difference of the times of day, in hours (0 to 12)
+# age           : time elapsed between the two, in days
+# song          : combined distance of the songs, see catalog.SongCatalog.score
+COMPONENTS = ('location', 'activity', 'time', 'age', 'song')
+
+# Default weights of the components, chosen so that a weight times a typical
+# distance is about one: 1km, one step of activity, an hour of the day.
+DEFAULT_WEIGHTS = {'location': 1e-3,
+                   'activity': 1.0,
+                   'time': 1.0,
+                   'age': 0.0,
+                   'song': 1.0,
+                  }
+
+
+class Recommender(object):
+    """
+    Recommends songs for a user state from the histories of a
+    store.ColumnarStore: the songs played in the contexts closest to it.
+
+    Every stored user state near the current one gets a score, the weighted
+    sum of its COMPONENTS distances to the current one, computed over
+    arrays. A song scores the best score of the user states it was played
+    in, and the count best songs are selected with argpartition.
+
+    The candidate user states come from a spatial_index.SpatialIndex: those
+    within radius of the current location, the radius being widened until
+    min_candidates are found, and at most the max_candidates nearest of
+    them scored, which bounds the time of a request. The index, and the
+    catalog of the stored songs, are built once and kept up to date, so
+    that a Recommender is meant to live as long as the process.
+
+    Parameters
+    ----------
+    store               : store.ColumnarStore
+                        The store holding the histories.
+    weights             : dict
+                        The weight of each of the COMPONENTS, missing ones
+                        being unused. Defaults to DEFAULT_WEIGHTS.
+    radius              : float
+                        The initial radius of the search of the candidates,
+                        in meters.
+    min_candidates      : int
+                        The number of candidates below which the radius is
+                        widened.
+    max_candidates      : int
+                        The maximum number of candidates scored.
+    spatial_index       : spatial_index.SpatialIndex
+                        The index of the store, built if None.
+    workers             : int
+                        The number of threads resolving the stored songs.
+    """
+
+    def __init__(self, store, weights=None, radius=50000.0,
+                 min_candidates=1000, max_candidates=200000,
+                 spatial_index=None, workers=4):
+        if not isinstance(store, ColumnarStore):
+            raise Exception('Given store is not a ColumnarStore object.')
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        for component in weights:
+            if component not in COMPONENTS:
+                raise Exception('Given score component is not recognized.')
+        self.store = store
+        self.weights = dict(weights)
+        self.radius = radius
+        self.min_candidates = min_candidates
+        self.max_candidates = max_candidates
+        self.workers = workers
+        if spatial_index is None:
+            spatial_index = SpatialIndex(store)
+        self.spatial_index = spatial_index
+        self.catalog = SongCatalog()
+        # Row of each song id of the store in the catalog, -1 for the songs
+        # that could not be resolved
+        self.catalog_rows = np.zeros(0, dtype=np.intp)
+        # Song ids of each normalized query string
+        self.song_ids = {}
+        self.update_catalog()
+
+    def update_catalog(self):
+        """
+        Resolves the songs added to the store since the last call, and adds
+        them to the catalog.
+        """
+        query_strings = self.store.query_strings[len(self.catalog_rows):]
+        if not query_strings:
+            return
+        for song_id, query_string in enumerate(query_strings,
+                                               len(self.catalog_rows)):
+            self.song_ids.setdefault(normalize_query_string(query_string),
+                                     []).append(song_id)
+        songs = [intern_song(query_string, lazy=True)
+                 for query_string in query_strings]
+        resolve_all(songs, self.workers)
+        resolved = [song for song in songs if song.is_resolved()]
+        rows = np.full(len(songs), -1, dtype=np.intp)
+        rows[[index for index, song in enumerate(songs)
+              if song.is_resolved()]] = \
+            np.arange(len(self.catalog), len(self.catalog) + len(resolved))
+        self.catalog.extend(SongCatalog(resolved))
+        self.catalog_rows = np.concatenate([self.catalog_rows, rows])
+
+    def candidates(self, user_state, activities=None, start=None, end=None):
+        """
+        Returns the spatial_index.ENTRY array of the candidate user states
+        for the user state, and the array of their distances to it.
+        """
+        radius = self.radius
+        while True:
+            entries, distances = self.spatial_index.search(
+                user_state.location, radius, activities, start, end)
+            if len(distances) >= self.min_candidates or \
+                    radius >= np.pi * geodesic.EARTH_RADIUS:
+                break
+            radius *= 4
+        if len(distances) > self.max_candidates:
+            selected = np.argpartition(distances,
+                                       self.max_candidates - 1)[
+                                           :self.max_candidates]
+            entries, distances = entries[selected], distances[selected]
+        return entries, distances
+
+    def scores(self, user_state, entries, distances):
+        """
+        Returns the float array of the scores of the candidate user states,
+        lower being better.
+        """
+        weights = self.weights
+        scores = np.zeros(len(entries))
+        if weights.get('location'):
+            scores += weights['location'] * distances
+        if weights.get('activity'):
+            scores += weights['activity'] * np.abs(
+                entries['activity'] - ACTIVITIES[user_state.activity])
+        timestamp = encode_timestamp(user_state.timestamp)
+        if weights.get('time'):
+            hours = np.abs(entries['timestamp'] % 86400 -
+                           timestamp % 86400) / 3600.0
+            scores += weights['time'] * np.minimum(hours, 24.0 - hours)
+        if weights.get('age'):
+            scores += weights['age'] * np.abs(
+                entries['timestamp'] - timestamp) / 86400.0
+        if weights.get('song'):
+            song_distances = self.song_distances(user_state.song)
+            scores += weights['song'] * song_distances[entries['song']]
+        return scores
+
+    def song_distances(self, song):
+        """
+        Returns the float array of the distances between the song and each
+        song of the store, by song id. Where they cannot be compared, the
+        distance is the mean of the other ones, so that these songs are
+        neither favoured nor penalized. If the song cannot be looked up, all
+        the distances are 0.0, which leaves the song out of the scores.
+        """
+        if len(self.catalog_rows) < len(self.store.query_strings):
+            self.update_catalog()
+        distances = np.zeros(len(self.catalog_rows))
+        if not len(self.catalog):
+            return distances
+        try:
+            scores = SongCatalog([song]).score(self.catalog, SONG_WEIGHTS)[0]
+        except discogs.DiscogsAPIError:
+            # Discogs errors derive from BaseException
+            return distances
+        known = self.catalog_rows >= 0
+        distances[known] = scores[self.catalog_rows[known]]
+        compared = known & ~np.isnan(distances)
+        distances[~compared] = distances[compared].mean() \
+            if compared.any() else 0.0
+        return distances
+
+    def recommend(self, user_state, count=10, exclude=None, activities=None,
+                  start=None, end=None):
+        """
+        Returns the count songs best suited to the user state.
+
+        Parameters
+        ----------
+        user_state          : UserState
+                            The current user state.
+        count               : int
+                            The number of songs recommended.
+        exclude             : iterable of str
+                            The query strings of the songs never
+                            recommended, by default the song of the user
+                            state.
+        activities          : list
+                            The activities the candidate user states are
+                            restricted to, all by default.
+        start               : datetime.datetime
+                            The earliest timestamp of the candidate user
+                            states.
+        end                 : datetime.datetime
+                            The timestamp the candidate user states are
+                            before.
+
+        Returns
+        -------
+        Returns the list of the (score, song) couples of the recommended
+        songs, best first.
+        """
+        if not isinstance(user_state, UserState):
+            raise Exception('Given user state is not a valid one.')
+        if count < 1:
+            return []
+        if exclude is None:
+            exclude = [user_state.song.query_string]
+        entries, distances = self.candidates(user_state, activities, start,
+                                             end)
+        if not len(entries):
+            return []
+        scores = self.scores(user_state, entries, distances)
+        # Best score of each song
+        song_scores = np.full(len(self.store.query_strings), np.inf)
+        np.minimum.at(song_scores, entries['song'], scores)
+        for query_string in exclude:
+            song_scores[self.song_ids.get(
+                normalize_query_string(query_string), [])] = np.inf
+        available = np.count_nonzero(np.isfinite(song_scores))
+        count = min(count, available)
+        if count == 0:
+            return []
+        selected = np.argpartition(song_scores, count - 1)[:count]
+        selected = selected[np.argsort(song_scores[selected],
+                                       kind='mergesort')]
+        return [(float(song_scores[song_id]),
+                 intern_song(self.store.query_strings[song_id], lazy=True))
+                for song_id in selected]
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Release Database Module for the Recommendation System.
+
+Local SQLite copy of the Discogs release metadata, built from the monthly
+XML data dumps (discogs_YYYYMMDD_releases.xml.gz and, optionally,
+discogs_YYYYMMDD_masters.xml.gz), so that the songs can be resolved without
+any network call, see song.RELEASE_DB.
+
+Usage: release_db.py [options] <dump file> [<dump file> ...]
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import re
+import gzip
+import sqlite3
+import logging
+import threading
+import xml.etree.cElementTree as ElementTree
+from optparse import OptionParser
+
+from song import normalize_query_string
+
+
+logger = logging.getLogger(__name__)
+
+# Discogs suffix telling apart the artists with the same name, as in
+# 'Aqua (2)'
+ARTIST_SUFFIX = re.compile(r'\s+\(\d+\)$')
+
+SCHEMA = '''
+CREATE TABLE releases (
+    id INTEGER PRIMARY KEY,
+    genre TEXT,
+    style TEXT,
+    tempo INTEGER,
+    year INTEGER,
+    country TEXT
+);
+CREATE TABLE keys (
+    key TEXT,
+    priority INTEGER,
+    release_id INTEGER
+);
+'''
+
+# Version of the database, stored as its user_version, to be increased with
+# every change of SCHEMA or of song.normalize_query_string
+VERSION = 3
+
+# Priority of the release a key points to, the lowest one being returned:
+# the main release of a master, then the other releases
+MAIN_RELEASE = 0
+OTHER_RELEASE = 1
+
+
+class ReleaseDatabase(object):
+    """
+    Read access to a release database built by build_release_database.
+    The database can be shared between threads and processes, each of them
+    opening its own connection.
+
+    Parameters
+    ----------
+    path                : str
+                        The path of the SQLite database file.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise Exception('Given release database does not exist.')
+        self.path = path
+        self.local = threading.local()
+        if self._connection().execute(
+                'PRAGMA user_version').fetchone()[0] != VERSION:
+            raise Exception('Given release database was built with another \
+                schema or other query string keys, it must be rebuilt.')
+
+    def release_id(self, query_string):
+        """
+        Returns the id of the release whose 'title' or 'artist - title'
+        matches the query string once normalized, None if there is none.
+        """
+        row = self._connection().execute(
+            'SELECT release_id FROM keys WHERE key = ? '
+            'ORDER BY priority, release_id LIMIT 1',
+            (normalize_query_string(query_string),)).fetchone()
+        return row[0] if row is not None else None
+
+    def details(self, release_id):
+        """
+        Returns the (genre, style, tempo, year, country) details of the
+        release, with the same defaults as
+        song.Song.look_up_details_by_release_id, None if it is unknown.
+        """
+        row = self._connection().execute(
+            'SELECT genre, style, tempo, year, country FROM releases '
+            'WHERE id = ?', (release_id,)).fetchone()
+        if row is None:
+            return None
+        genre, style, tempo, year, country = row
+        # The songs and their distances expect integer tempos
+        return genre, style, int(tempo), \
+            year if year is not None else 'None', country
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM releases').fetchone()[0]
+
+    def documents(self):
+        """
+        Iterates over the (release id, key) couples of the database, the
+        longest key of each release, that is its normalized 'artist -
+        title' if the artist is known, the main releases first. A release
+        with keys of both priorities, such as the main release of a master
+        of another title, is listed once for each.
+        """
+        for priority in (MAIN_RELEASE, OTHER_RELEASE):
+            # With a single MAX, SQLite takes the bare columns from its row
+            for release_id, key, _ in self._connection().execute(
+                    'SELECT release_id, key, MAX(LENGTH(key)) FROM keys '
+                    'WHERE priority = ? GROUP BY release_id', (priority,)):
+                yield release_id, key
+
+    def _connection(self):
+        # A connection cannot be used by another thread, nor survive a fork
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path)
+            connection.text_factory = str
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+
+def build_release_database(dump_paths, path, batch_size=10000):
+    """
+    Builds a release database from Discogs XML dumps, in constant memory:
+    the dumps are parsed incrementally, every release being discarded once
+    written.
+
+    Parameters
+    ----------
+    dump_paths          : list of str
+                        The paths of the release and master dumps, gzipped
+                        or not. The masters only tell which release is the
+                        main one of each title.
+    path                : str
+                        The path of the database, replaced atomically once
+                        built.
+    batch_size          : int
+                        The number of rows inserted at once.
+
+    Returns
+    -------
+    Returns a dict with the numbers of releases and masters read.
+    """
+    if batch_size < 1:
+        raise Exception('Given batch size is smaller than one.')
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    connection.text_factory = str
+    counts = {'releases': 0, 'masters': 0}
+    try:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.executescript(SCHEMA)
+        connection.execute('PRAGMA user_version = %d' % VERSION)
+        releases = []
+        keys = []
+        for dump_path in dump_paths:
+            logger.info('Loading %s.', dump_path)
+            for kind, fields in iter_dump(dump_path):
+                counts[kind + 's'] += 1
+                if kind == 'release':
+                    releases.append(fields[:6])
+                    release_id, priority = fields[0], fields[6]
+                elif fields[0]:
+                    release_id, priority = fields[0], MAIN_RELEASE
+                else:
+                    continue
+                keys.extend((key, priority, release_id)
+                            for key in _keys(*fields[-2:]))
+                if len(releases) >= batch_size or len(keys) >= batch_size:
+                    _insert(connection, releases, keys)
+                    releases, keys = [], []
+        _insert(connection, releases, keys)
+        connection.execute('CREATE INDEX keys_key ON keys '
+                           '(key, priority, release_id)')
+        connection.commit()
+    finally:
+        connection.close()
+    os.rename(temp_path, path)
+    logger.info('Built %s: %s.', path, counts)
+    return counts
+
+
+def iter_dump(dump_path):
+    """
+    Iterates over the releases and masters of a Discogs XML dump.
+
+    Returns
+    -------
+    Yields ('release', (id, genre, style, tempo, year, country, priority,
+    artist, title)) tuples, and ('master', (main release id, artist,
+    title)) ones, the missing values being set as by
+    song.Song.look_up_details_by_release_id, except for the unknown year
+    which is None.
+    """
+    if dump_path.endswith('.gz'):
+        dump_file = gzip.open(dump_path, 'rb')
+    else:
+        dump_file = open(dump_path, 'rb')
+    try:
+        events = ElementTree.iterparse(dump_file, events=('start', 'end'))
+        _, root = next(events)
+        depth = 0
+        for event, element in events:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            # Only the children of the root are complete items
+            if depth != 0:
+                continue
+            if element.tag == 'release':
+                yield 'release', _release_fields(element)
+            elif element.tag == 'master':
+                yield 'master', _master_fields(element)
+            # Drops the item, and the reference the root keeps to it
+            element.clear()
+            root.clear()
+    finally:
+        dump_file.close()
+
+
+def _release_fields(element):
+    master_id = element.find('master_id')
+    is_main = master_id is not None and \
+        master_id.get('is_main_release') == 'true'
+    released = _text(element, 'released', '')
+    year = int(released[:4]) if released[:4].isdigit() and \
+        int(released[:4]) > 0 else None
+    return (int(element.get('id')),
+            _text(element, 'genres/genre', 'None'),
+            _text(element, 'styles/style', 'None'),
+            0,
+            year,
+            _text(element, 'country', 'None'),
+            MAIN_RELEASE if is_main else OTHER_RELEASE,
+            _text(element, 'artists/artist/name', ''),
+            _text(element, 'title', ''))
+
+
+def _master_fields(element):
+    return (int(_text(element, 'main_release', '0')),
+            _text(element, 'artists/artist/name', ''),
+            _text(element, 'title', ''))
+
+
+def _text(element, path, default):
+    """
+    Returns the stripped text of the first element at path, as a UTF-8
+    string, or the default if there is none or it is empty.
+    """
+    text = element.findtext(path)
+    if text is None or not text.strip():
+        return default
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return text.strip()
+
+
+def _keys(artist, title):
+    """
+    Returns the normalized query strings matching a release.
+    """
+    if not title:
+        return []
+    keys = [normalize_query_string(title)]
+    artist = ARTIST_SUFFIX.sub('', artist)
+    if artist:
+        keys.append(normalize_query_string(artist + ' - ' + title))
+    return keys
+
+
+def _insert(connection, releases, keys):
+    connection.executemany('INSERT OR REPLACE INTO releases VALUES '
+                           '(?, ?, ?, ?, ?, ?)', releases)
+    connection.executemany('INSERT INTO keys VALUES (?, ?, ?)', keys)
+
+
+def main():
+    """
+    Builds a release database from Discogs XML dumps.
+
+    Usage: release_db.py [options] <dump file> [<dump file> ...]
+    """
+    option_parser = OptionParser(
+        usage='%prog [options] <dump file> [<dump file> ...]')
+    option_parser.add_option('-o', '--output', dest='output',
+                             default='releases.db',
+                             help='path of the database built')
+    options, args = option_parser.parse_args()
+    if not args:
+        option_parser.error('Expected at least one dump file.')
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: '
+                               '%(message)s')
+    build_release_database(args, options.output)
+
+
+if __name__ == '__main__':
+    main()
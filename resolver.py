@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Resolver Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import time
+import threading
+import Queue
+
+import discogs_client as discogs
+
+from song import Song, intern_song, normalize_query_string
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter.
+
+    Parameters
+    ----------
+    rate                : float
+                        The number of tokens added to the bucket per second.
+    capacity            : int
+                        The maximum number of tokens the bucket holds, that
+                        is the largest burst allowed. Defaults to one.
+    """
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise Exception('Given rate is not strictly positive.')
+        if capacity < 1:
+            raise Exception('Given capacity is smaller than one token.')
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token from the bucket, sleeping until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def resolve_songs(query_strings, workers=4):
+    """
+    Resolves the given query strings to Song objects on a pool of threads.
+    The query strings are deduplicated on their normalized form, and each
+    resolved Song is registered through intern_song, so that the following
+    intern_song calls are answered without any lookup.
+
+    The Discogs calls are rate limited through song.RATE_LIMITER, if set.
+
+    Parameters
+    ----------
+    query_strings       : iterable of str
+                        The query strings to resolve.
+    workers             : int
+                        The number of threads doing the lookups.
+
+    Returns
+    -------
+    Returns a dict with the normalized query strings as keys, and either the
+    Song object or the error raised while resolving it as values.
+    """
+    return resolve_all((intern_song(query_string, lazy=True)
+                        for query_string in query_strings), workers)
+
+
+def resolve_all(songs, workers=4):
+    """
+    Resolves the given lazy Song objects on a pool of threads. The songs
+    are deduplicated on the normalized form of their query string: the
+    metadata of each one is looked up once, and assigned to all the songs
+    sharing it.
+
+    The Discogs calls are rate limited through song.RATE_LIMITER, if set.
+
+    Parameters
+    ----------
+    songs               : iterable of Song
+                        The songs to resolve, resolved ones being skipped.
+    workers             : int
+                        The number of threads doing the lookups.
+
+    Returns
+    -------
+    Returns a dict with the normalized query strings as keys, and either the
+    first Song object or the error raised while resolving it as values.
+    """
+    if workers < 1:
+        raise Exception('Given number of workers is smaller than one.')
+    pending = Queue.Queue()
+    distinct = {}
+    for song in songs:
+        if not isinstance(song, Song):
+            raise Exception('Given song is not a Song object.')
+        key = normalize_query_string(song.query_string)
+        if key not in distinct:
+            distinct[key] = [song]
+            pending.put(key)
+        elif song is not distinct[key][0]:
+            distinct[key].append(song)
+    results = {}
+
+    def work():
+        while True:
+            try:
+                key = pending.get_nowait()
+            except Queue.Empty:
+                return
+            first = distinct[key][0]
+            try:
+                first.resolve()
+            except (discogs.DiscogsAPIError, Exception), error:
+                results[key] = error
+                continue
+            for song in distinct[key][1:]:
+                song.assign(first.metadata())
+            results[key] = first
+
+    threads = [threading.Thread(target=work)
+               for _ in xrange(min(workers, len(distinct)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Single Flight Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import threading
+
+from metrics import METRICS
+
+
+class SingleFlight(object):
+    """
+    Coalesces the concurrent calls for the same key: the first caller runs
+    the call, and the ones arriving while it is in flight wait for it and
+    share its result, or its error. A call arriving once it is over runs
+    again. The instances are shared between threads.
+
+    Parameters
+    ----------
+    counter             : str
+                        The metrics.METRICS counter incremented for every
+                        coalesced call.
+
+    Attributes
+    ----------
+    coalesced           : int
+                        The number of calls that waited for another one
+                        instead of running.
+    """
+
+    def __init__(self, counter='coalesced_calls'):
+        self.counter = counter
+        self.coalesced = 0
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def call(self, key, function, *arguments):
+        """
+        Returns function(*arguments), or the result of the call for the
+        same key in flight, raising its error if it failed.
+        """
+        with self.lock:
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            METRICS.increment(self.counter)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*arguments)
+            return flight.result
+        except BaseException, error:
+            # Discogs errors derive from BaseException
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+
+
+class _Flight(object):
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
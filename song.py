@@ -6,13 +6,126 @@ Song Module for the Recommendation System.
 @version: 0.1
 """
 
+import re
+import time
+import logging
+import threading
+import unicodedata
+
 import numpy as np
+import requests
 from geopy.distance import vincenty
 from geopy import geocoders
 
+from countries import COUNTRY_INDEX, COUNTRY_COORDINATES, \
+    COUNTRY_DISTANCES
+
 import discogs_client as discogs
 discogs.user_agent = 'MyRecommendationSystem/0.1'
 
+from metrics import METRICS
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Metadata cache checked before any Discogs lookup, see cache.MetadataCache.
+# Left to None, every song is looked up on the network.
+CACHE = None
+
+# Rate limiter acquired before every Discogs call, see resolver.TokenBucket.
+# Left to None, the calls are not rate limited.
+RATE_LIMITER = None
+
+# Local release database checked after CACHE and before any Discogs lookup,
+# see release_db.ReleaseDatabase. Left to None, it is not used.
+RELEASE_DB = None
+
+# Full-text index of the known releases checked after RELEASE_DB, see
+# text_index.TextIndex. The release ids found on Discogs are added to it.
+# Left to None, it is not used.
+TEXT_INDEX = None
+
+# Whether the songs are only resolved from CACHE, RELEASE_DB and TEXT_INDEX,
+# the ones found in none of them raising SongNotFoundError without any
+# Discogs call.
+OFFLINE = False
+
+# Cache of the query strings that could not be resolved, and of the errors
+# raised for them, see cache.NegativeCache. Left to None, they are looked up
+# again every time.
+NEGATIVE_CACHE = None
+
+# Lookups in flight, so that the concurrent resolutions of the same query
+# string, or of query strings of the same release, share one lookup, see
+# single_flight.SingleFlight
+IN_FLIGHT = SingleFlight('coalesced_calls')
+
+# Lock of the assignments of the metadata of the songs, so that the threads
+# resolving the same song at once set it only once. The lookups are done
+# without it.
+ASSIGN_LOCK = threading.Lock()
+
+# Number of retries of a Discogs call failing with a transient error, and
+# the delay before the first retry in seconds, doubled on every retry
+RETRIES = 3
+RETRY_DELAY = 1.0
+
+# Whether the countries missing from countries.COUNTRIES are geocoded with
+# the Google geocoder. Left to False, they are treated as missing, as by
+# catalog.SongCatalog.
+GEOCODE_UNKNOWN_COUNTRIES = False
+
+# Countries of the releases whose country is not known: the 'None' default
+# and the 'Unknown' country of Discogs
+MISSING_COUNTRIES = ('None', 'Unknown')
+
+# Coordinates of the countries geocoded so far, by name
+GEOCODED_COUNTRIES = {}
+
+# Attributes of a Song looked up on resolution
+METADATA = ('release_id', 'genre', 'style', 'tempo', 'year', 'country',
+            'sens_me_values', 'genre_code', 'style_code')
+
+# Shared genre, style and country labels, see intern_label
+LABELS = {}
+
+# Code of the 'None' genre and style, see Taxonomy
+NONE_CODE = -1
+
+# Registry of the shared Song instances, keyed on the normalized query string,
+# see intern_song.
+SONGS = {}
+
+# Featuring credit of a query string, as in 'Song (feat. Artist)' or
+# 'Artist ft. Other - Song', up to a closing bracket or a ' - ' separator
+FEATURING = re.compile(r'[\(\[]?\b(?:feat|ft|featuring)\b\.?.*?'
+                       r'(?:[\)\]]|(?=\s-\s)|$)', re.UNICODE)
+
+# Characters dropped without separating words, and the ones that do
+APOSTROPHES = re.compile(u"['\u2019`]", re.UNICODE)
+PUNCTUATION = re.compile(r'[\W_]+', re.UNICODE)
+
+# Normalized form of the query strings seen lately, see
+# normalize_query_string
+NORMALIZED = {}
+MAX_NORMALIZED = 100000
+
+
+class SongNotFoundError(discogs.DiscogsAPIError):
+    """
+    Raised when a song cannot be resolved and retrying would not help: the
+    Discogs search found nothing, or Discogs answered with a client error.
+    """
+    pass
+
+
+class TransientLookupError(discogs.DiscogsAPIError):
+    """
+    Raised when a Discogs call still fails on a network error, a server
+    error or a rate limit after RETRIES retries.
+    """
+    pass
+
 
 class Song(object):
     # FIXME : The querystring is insufficient to find the sensMe values
@@ -23,7 +136,13 @@ class Song(object):
 
     Parameters
     ----------
-
+    query_string        : str
+                        The query string used to identify the song.
+    lazy                : bool
+                        Whether to defer the lookup of the metadata to the
+                        first access to one of the METADATA attributes, or
+                        to an explicit call to resolve (see also
+                        resolver.resolve_all).
 
     Attributes
     ----------
@@ -47,19 +166,141 @@ class Song(object):
     sens_me             : (float, float)
                         A couple with the coordinates for that song in the \
                         sensMe system.
+    genre_code          : int
+                        The code of the genre in GENRE_TAXONOMY, NONE_CODE
+                        if the genre is 'None' or not in GENRES.
+    style_code          : int
+                        The code of the style in STYLE_TAXONOMY, NONE_CODE
+                        if the style is 'None' or not in STYLES.
+
+    Song objects are immutable once resolved, so that a single instance can
+    be shared by all the user states referring to it (see intern_song).
+    They pickle as a reference to their query string, and are interned again
+    as lazy songs when unpickled, without any lookup. Their genre, style and
+    country labels are interned with intern_label.
     """
 
-    def __init__(self, query_string):
+    __slots__ = ('query_string', 'release_id', 'genre', 'style', 'tempo',
+                 'year', 'country', 'sens_me_values', 'genre_code',
+                 'style_code', '_frozen')
+
+    def __init__(self, query_string, lazy=False):
         if not isinstance(query_string, str):
             raise Exception('Given query string for song init is not a \
                                                                 string.')
         if query_string == '':
             raise Exception('Given query string for song is empty.')
         self.query_string = query_string
-        self.release_id = self.look_up_release_id()
-        self.genre, self.style, self.tempo, self.year, self.country = \
-            self.look_up_details_by_release_id()
-        self.sens_me_values = self.sens_me()
+        if not lazy:
+            self.resolve()
+
+    def __getattr__(self, name):
+        # Only reached for the slots not set yet, that is the metadata of a
+        # lazy song
+        if name in METADATA:
+            self.resolve()
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise Exception('Song objects are immutable.')
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        return (intern_song, (self.query_string, True))
+
+    def __setstate__(self, state):
+        # Pickles written before the slots hold the attributes of a resolved
+        # song. The metadata is shared with the interned song, which takes
+        # this one if there is none yet.
+        object.__setattr__(self, 'query_string', state['query_string'])
+        if all(name in state for name in METADATA[:7]):
+            self.assign(tuple(state[name] for name in METADATA[:7]))
+        song = SONGS.setdefault(normalize_query_string(self.query_string),
+                                self)
+        if song is not self and self.is_resolved():
+            song.assign(self.metadata())
+
+    def is_resolved(self):
+        """
+        Returns whether the metadata of the song has been looked up.
+        """
+        return getattr(self, '_frozen', False)
+
+    def resolve(self):
+        """
+        Looks the metadata of the song up, if not done yet.
+        """
+        if self.is_resolved():
+            return
+        key = normalize_query_string(self.query_string)
+        if NEGATIVE_CACHE is not None:
+            error = NEGATIVE_CACHE.get(key)
+            if error is not None:
+                METRICS.increment('negative_cache_hits')
+                raise error
+        try:
+            # The threads resolving the song, or another song of the same
+            # query string, share one lookup
+            metadata = IN_FLIGHT.call(('song', key), self._look_up)
+        except (SongNotFoundError, TransientLookupError), error:
+            if NEGATIVE_CACHE is not None:
+                NEGATIVE_CACHE.set(key, error,
+                                   isinstance(error, TransientLookupError))
+            raise
+        self.assign(metadata)
+
+    def _look_up(self):
+        """
+        Looks the metadata of the song up, and returns it as the metadata
+        method does, without assigning it.
+        """
+        if not self._has_release_id():
+            release_id = self.look_up_release_id()
+            with ASSIGN_LOCK:
+                # Another thread may have resolved the song
+                if not self._has_release_id():
+                    self.release_id = release_id
+        # Songs of different query strings may share a release
+        genre, style, tempo, year, country = IN_FLIGHT.call(
+            ('details', self.release_id), self.look_up_details_by_release_id)
+        return (self.release_id, genre, style, tempo, year, country,
+                self.sens_me())
+
+    def metadata(self):
+        """
+        Returns the values of the METADATA attributes resolved from Discogs,
+        in order.
+        """
+        return tuple(getattr(self, name) for name in METADATA[:7])
+
+    def assign(self, metadata):
+        """
+        Resolves the song with the values of the METADATA attributes looked
+        up for another song with the same query string, as returned by its
+        metadata method.
+        """
+        with ASSIGN_LOCK:
+            if self.is_resolved():
+                return
+            self.release_id, genre, style, self.tempo, self.year, country, \
+                self.sens_me_values = metadata
+            self.genre = intern_label(genre)
+            self.style = intern_label(style)
+            self.country = intern_label(country)
+            self.genre_code = GENRE_TAXONOMY.code(self.genre)
+            self.style_code = STYLE_TAXONOMY.code(self.style)
+            self._frozen = True
+
+    def _has_release_id(self):
+        # Set by an earlier call that failed on the details, or by another
+        # thread
+        try:
+            object.__getattribute__(self, 'release_id')
+        except AttributeError:
+            return False
+        return True
 
     def look_up_release_id(self):
         """
@@ -80,12 +321,41 @@ class Song(object):
         Returns
         -------
         Returns the master_id associated with the query.
+        Raises SongNotFoundError if the search finds nothing.
         """
-        my_search = discogs.Search(self.query_string)
-        if __debug__:
-            print 'Looking up release id.'
-        release = my_search.results()[0]
-        return release.data['id']
+        if CACHE is not None:
+            release_id = CACHE.get_release_id(self.query_string)
+            if release_id is not None:
+                METRICS.increment('cache_hits')
+                return release_id
+            METRICS.increment('cache_misses')
+        if RELEASE_DB is not None:
+            release_id = RELEASE_DB.release_id(self.query_string)
+            if release_id is not None:
+                METRICS.increment('release_db_hits')
+                return release_id
+            METRICS.increment('release_db_misses')
+        if TEXT_INDEX is not None:
+            release_id = TEXT_INDEX.release_id(self.query_string)
+            if release_id is not None:
+                METRICS.increment('text_index_hits')
+                return release_id
+            METRICS.increment('text_index_misses')
+        logger.debug('Looking up release id of %r.', self.query_string)
+
+        def search():
+            results = discogs.Search(self.query_string).results()
+            if not results:
+                raise SongNotFoundError('No Discogs release found for %r.'
+                                        % self.query_string)
+            return results[0].data['id']
+
+        release_id = call_discogs(search)
+        if CACHE is not None:
+            CACHE.set_release_id(self.query_string, release_id)
+        if TEXT_INDEX is not None:
+            TEXT_INDEX.add(release_id, self.query_string)
+        return release_id
 
     def look_up_details_by_release_id(self):
         # FIXME : The current strategy is to use only one style and genre
@@ -108,10 +378,21 @@ class Song(object):
         that song in the database.
 
         """
-        release = discogs.Release(self.release_id)
-        if __debug__:
-            print 'Looking up release data.'
-        release_data = release.data
+        if CACHE is not None:
+            details = CACHE.get_details(self.release_id)
+            if details is not None:
+                METRICS.increment('cache_hits')
+                return details
+            METRICS.increment('cache_misses')
+        if RELEASE_DB is not None:
+            details = RELEASE_DB.details(self.release_id)
+            if details is not None:
+                METRICS.increment('release_db_hits')
+                return details
+            METRICS.increment('release_db_misses')
+        logger.debug('Looking up release data of %r.', self.release_id)
+        release_data = call_discogs(lambda: discogs.Release(
+            self.release_id).data)
         genre = 'None'
         style = 'None'
         tempo = 0
@@ -128,6 +409,9 @@ class Song(object):
         if 'country' in release_data.keys():
             country = release_data['country']
 
+        if CACHE is not None:
+            CACHE.set_details(self.release_id,
+                              (genre, style, tempo, year, country))
         return genre, style, tempo, year, country
 
     def sens_me(self):
@@ -160,15 +444,247 @@ class Song(object):
         print 'SensMe {}'.format(self.sens_me_values)
 
 
+class Taxonomy(object):
+    """
+    Integer coding of a table of genres or styles, with the dense matrix of
+    the sensMe distances between all of them, compiled once.
+
+    The names are coded by their rank in sorted order. The code of 'None',
+    and of any name missing from the table, is NONE_CODE: it indexes the
+    last row and column of the matrix, which hold -1.0, so that the
+    distance between two codes is always a single lookup.
+
+    Parameters
+    ----------
+    table               : dict
+                        The (x, y) sensMe couple of each name, such as
+                        GENRES or STYLES.
+
+    Attributes
+    ----------
+    names               : list of str
+                        The names, in code order.
+    index               : dict
+                        The code of each name.
+    coordinates         : float array of shape (N, 2)
+                        The sensMe couple of each name, in code order.
+    matrix              : float array of shape (N + 1, N + 1)
+                        The distances between the codes, NONE_CODE
+                        included.
+    """
+
+    def __init__(self, table):
+        self.load(table)
+
+    def load(self, table):
+        """
+        Compiles the codes and distances of the table, such as after the
+        sensMe couples in it are recalibrated.
+        """
+        self.names = sorted(name for name in table if name != 'None')
+        self.index = dict((name, code) for code, name
+                          in enumerate(self.names))
+        self.coordinates = np.array([table[name] for name in self.names],
+                                    dtype=np.float64).reshape(-1, 2)
+        self.matrix = np.empty((len(self.names) + 1,) * 2)
+        self.matrix[:-1, :-1] = np.hypot(
+            self.coordinates[:, 0][:, np.newaxis] -
+            self.coordinates[:, 0][np.newaxis, :],
+            self.coordinates[:, 1][:, np.newaxis] -
+            self.coordinates[:, 1][np.newaxis, :])
+        self.matrix[NONE_CODE, :] = -1.0
+        self.matrix[:, NONE_CODE] = -1.0
+
+    def code(self, name):
+        """
+        Returns the code of the name, NONE_CODE if it is 'None' or not in
+        the table.
+        """
+        return self.index.get(name, NONE_CODE)
+
+    def codes(self, names):
+        """
+        Returns the int array of the codes of the names.
+        """
+        return np.array([self.index.get(name, NONE_CODE) for name in names],
+                        dtype=np.int32)
+
+    def distances(self, codes1, codes2):
+        """
+        Returns the distances between the codes of two arrays, broadcast
+        against each other, -1.0 where one of the codes is NONE_CODE.
+        """
+        return self.matrix[np.asarray(codes1), np.asarray(codes2)]
+
+    def pairwise(self, codes1, codes2):
+        """
+        Returns the (N, M) matrix of the distances between all the codes of
+        codes1 and all the codes of codes2.
+        """
+        return self.matrix[np.ix_(np.asarray(codes1, dtype=np.intp),
+                                  np.asarray(codes2, dtype=np.intp))]
+
+
+def reload_taxonomies():
+    """
+    Compiles GENRE_TAXONOMY and STYLE_TAXONOMY again from GENRES and STYLES,
+    to be called once their sensMe couples are recalibrated. If the names
+    changed, the codes of the songs built so far are stale, so the song
+    registry is emptied.
+    """
+    genre_names = GENRE_TAXONOMY.names
+    style_names = STYLE_TAXONOMY.names
+    GENRE_TAXONOMY.load(GENRES)
+    STYLE_TAXONOMY.load(STYLES)
+    if GENRE_TAXONOMY.names != genre_names or \
+            STYLE_TAXONOMY.names != style_names:
+        clear_songs()
+
+
+def call_discogs(function):
+    """
+    Calls a function querying Discogs, rate limited through RATE_LIMITER,
+    and retries it with an exponential backoff as long as it fails with a
+    transient error, see is_transient_error.
+
+    Parameters
+    ----------
+    function            : callable
+                        The function, called without arguments.
+
+    Returns
+    -------
+    Returns the result of the function.
+    Raises TransientLookupError if it still fails after RETRIES retries, and
+    SongNotFoundError if it fails with another Discogs error, or at once if
+    OFFLINE is set.
+    """
+    if OFFLINE:
+        raise SongNotFoundError('Song not found offline.')
+    attempt = 0
+    while True:
+        if RATE_LIMITER is not None:
+            RATE_LIMITER.acquire()
+        METRICS.increment('discogs_calls')
+        start = time.time()
+        try:
+            return function()
+        except SongNotFoundError:
+            raise
+        except (discogs.DiscogsAPIError, requests.RequestException), error:
+            if not is_transient_error(error):
+                raise SongNotFoundError(str(error))
+            if attempt >= RETRIES:
+                raise TransientLookupError(str(error))
+        finally:
+            METRICS.add_time('discogs', time.time() - start)
+        delay = RETRY_DELAY * 2 ** attempt
+        logger.debug('Retrying Discogs call in %.1fs after: %s', delay, error)
+        METRICS.increment('discogs_retries')
+        time.sleep(delay)
+        attempt += 1
+
+
+def is_transient_error(error):
+    """
+    Returns whether a failed Discogs call may succeed when retried: on a
+    network error, a server error or a rate limit (HTTP status 429).
+    """
+    if isinstance(error, requests.RequestException):
+        return True
+    status = str(error).split(' ', 1)[0]
+    return status.isdigit() and (status == '429' or status.startswith('5'))
+
+
+def normalize_query_string(query_string):
+    """
+    Returns the normalized form of a query string, shared by the song
+    registry, cache.MetadataCache, release_db and text_index, so that near
+    duplicate query strings resolve to the same song: lower case, without
+    accents nor featuring credits, and the punctuation replaced by single
+    spaces. A query string made only of punctuation is only lowered.
+    """
+    key = NORMALIZED.get(query_string)
+    if key is None:
+        if len(NORMALIZED) >= MAX_NORMALIZED:
+            NORMALIZED.clear()
+        key = _normalize(query_string)
+        NORMALIZED[query_string] = key
+    return key
+
+
+def _normalize(query_string):
+    text = query_string.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join(character for character in text
+                    if not unicodedata.combining(character))
+    text = FEATURING.sub(u' ', text)
+    text = APOSTROPHES.sub(u'', text)
+    text = PUNCTUATION.sub(u' ', text)
+    text = text.strip()
+    if not text:
+        # Titles made only of punctuation, such as '!!!', keep it
+        return query_string.lower().strip()
+    return text.encode('utf-8')
+
+
+def intern_song(query_string, lazy=False):
+    """
+    Returns the shared Song instance for the query string, creating and
+    registering it on first use. Query strings with the same normalized form
+    (see normalize_query_string) share the same instance.
+
+    Parameters
+    ----------
+    query_string        : str
+                        The query string used to identify the song.
+    lazy                : bool
+                        Whether the song may be returned unresolved, see
+                        Song. Otherwise a registered lazy song is resolved.
+
+    Returns
+    -------
+    Returns the Song object registered for that query string.
+    """
+    if not isinstance(query_string, str):
+        raise Exception('Given query string for song init is not a \
+                                                            string.')
+    key = normalize_query_string(query_string)
+    song = SONGS.get(key)
+    if song is None:
+        # setdefault keeps the registry consistent when several threads
+        # resolve the same song at once
+        song = SONGS.setdefault(key, Song(query_string, lazy))
+    if not lazy:
+        song.resolve()
+    return song
+
+
+def intern_label(label):
+    """
+    Returns the shared instance of a genre, style or country label, so that
+    the songs with the same labels do not each hold a copy of them.
+    """
+    return LABELS.setdefault(label, label)
+
+
+def clear_songs():
+    """
+    Empties the song registry, releasing the shared Song instances.
+    """
+    SONGS.clear()
+
+
 def distance_genres(genre1, genre2):
     """
     Calculates the distance between two musical genres according to their
     'sensMe' 2D representation.
+    See GENRE_TAXONOMY for the distances between genre codes.
 
     Parameters
     ----------
     genre1              : str
-                        One of the genres in GENRES
+                        One of the genres in GENRES, or 'None'
     genre2              : same as for genre1
 
     Returns
@@ -177,24 +693,24 @@ def distance_genres(genre1, genre2):
     representation in the sensMe 2D system.
     If one of the genres is 'None', the returned distance is -1.0
     """
-    if genre1 not in GENRES.keys():
+    if genre1 not in GENRE_TAXONOMY.index and genre1 != 'None':
         raise Exception('Given first genre is not recognized.')
-    if genre2 not in GENRES.keys():
+    if genre2 not in GENRE_TAXONOMY.index and genre2 != 'None':
         raise Exception('Given second genre is not recognized.')
-    if genre1 == 'None' or genre2 == 'None':
-        return -1.0
-    return np.linalg.norm(np.array(GENRES[genre1]) - np.array(GENRES[genre2]))
+    return GENRE_TAXONOMY.matrix[GENRE_TAXONOMY.code(genre1),
+                                 GENRE_TAXONOMY.code(genre2)]
 
 
 def distance_styles(style1, style2):
     """
     Calculates the distance between two musical styles according to their
     'sensMe' 2D representation.
+    See STYLE_TAXONOMY for the distances between style codes.
 
     Parameters
     ----------
     style1              : str
-                        One of the styles in STYLES
+                        One of the styles in STYLES, or 'None'
     style2              : same as for style1
 
     Returns
@@ -203,47 +719,73 @@ def distance_styles(style1, style2):
     representation in the sensMe 2D system.
     If one of the styles is 'None', the returned distance is -1.0
     """
-    if style1 not in STYLES.keys():
+    if style1 not in STYLE_TAXONOMY.index and style1 != 'None':
         raise Exception('Given first style is not recognized.')
-    if style2 not in STYLES.keys():
+    if style2 not in STYLE_TAXONOMY.index and style2 != 'None':
         raise Exception('Given second style is not recognized.')
-    if style1 == 'None' or style2 == 'None':
-        return -1.0
-    return np.linalg.norm(np.array(STYLES[style1]) - np.array(STYLES[style2]))
+    return STYLE_TAXONOMY.matrix[STYLE_TAXONOMY.code(style1),
+                                 STYLE_TAXONOMY.code(style2)]
 
 
 def distance_countries(country1, country2):
     """
     Calculates the distance between the two countries, in meters.
-    Uses Google Engine to return GPS coordinates for the country,
-    and Vincenty's formula for the distance calculation again.
+    Looks the distance up in the precomputed matrix of the distances between
+    the country centroids of the countries module.
+
+    Countries missing from the table are only geocoded, with the Google
+    geocoder and Vincenty's formula, if GEOCODE_UNKNOWN_COUNTRIES is set,
+    and treated as missing otherwise.
 
     Parameters
     ----------
     country1            : str
-                        The name of the country (as recognizable by Google)
+                        The name of the country, as returned by Discogs
     country2            : same as for country1
 
     Returns
     -------
-    A distance in meters between the two countries, using the Vincenty
-    Formula.
-    If one of the countries is 'None', the returned distance is -1.0
+    A distance in meters between the two countries.
+    If one of the countries is 'None', 'Unknown' or, unless
+    GEOCODE_UNKNOWN_COUNTRIES is set, missing from the table, the returned
+    distance is -1.0
 
     """
     if not isinstance(country1, str):
         raise Exception('Given first country is not a string.')
     if not isinstance(country2, str):
         raise Exception('Given second country is not a string.')
-    if country1 == 'None' or country2 == 'None':
+    if country1 in MISSING_COUNTRIES or country2 in MISSING_COUNTRIES:
+        return -1.0
+    index1 = COUNTRY_INDEX.get(country1)
+    index2 = COUNTRY_INDEX.get(country2)
+    if index1 is not None and index2 is not None:
+        return COUNTRY_DISTANCES[index1, index2]
+    if not GEOCODE_UNKNOWN_COUNTRIES:
         return -1.0
-    my_geocoder = geocoders.GoogleV3()
-    try:
-        _, coordinates1 = my_geocoder.geocode(country1)
-        _, coordinates2 = my_geocoder.geocode(country2)
-    except TypeError:
-        raise Exception('Could not geocode the country name.')
-    return vincenty(coordinates1, coordinates2).m
+    return vincenty(geocode_country(country1), geocode_country(country2)).m
+
+
+def geocode_country(country):
+    """
+    Returns the GPS coordinates of the country: from the countries table if
+    it is in there, from the Google geocoder otherwise. Geocoded countries
+    are remembered in GEOCODED_COUNTRIES.
+    """
+    index = COUNTRY_INDEX.get(country)
+    if index is not None:
+        return tuple(COUNTRY_COORDINATES[index])
+    if country not in GEOCODED_COUNTRIES:
+        logger.debug('Geocoding country %r.', country)
+        METRICS.increment('geocode_calls')
+        my_geocoder = geocoders.GoogleV3()
+        with METRICS.timer('geocode'):
+            try:
+                _, coordinates = my_geocoder.geocode(country)
+            except TypeError:
+                raise Exception('Could not geocode the country name.')
+        GEOCODED_COUNTRIES[country] = coordinates
+    return GEOCODED_COUNTRIES[country]
 
 
 def distance_years(year1, year2):
@@ -338,10 +880,10 @@ def distance_songs(song1, song2):
         raise Exception('Given first song is not a song object.')
     if not isinstance(song2, Song):
         raise Exception('Given second song is not a song object.')
-    distance_set = {'distance_genre': distance_genres(song1.genre,
-                    song2.genre),
-                    'distance_style': distance_styles(song1.style,
-                    song2.style),
+    distance_set = {'distance_genre': GENRE_TAXONOMY.matrix[
+                        song1.genre_code, song2.genre_code],
+                    'distance_style': STYLE_TAXONOMY.matrix[
+                        song1.style_code, song2.style_code],
                     'distance_country': distance_countries(song1.country,
                     song2.country),
                     'distance_year': distance_years(song1.year, song2.year),
@@ -706,3 +1248,8 @@ STYLES = {'Soundtrack': (0.0, 0.0),
           'Zouk': (0.0, 0.0),
           'Éntekhno': (0.0, 0.0),
           }
+
+
+# Compiled genre and style tables, see Taxonomy and reload_taxonomies
+GENRE_TAXONOMY = Taxonomy(GENRES)
+STYLE_TAXONOMY = Taxonomy(STYLES)
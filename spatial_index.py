@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial Index Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import numpy as np
+
+import geodesic
+from store import ColumnarStore, encode_timestamp
+from user_state import ACTIVITIES
+
+
+# Entry of the spatial index: grid cell, GPS coordinates, seconds since the
+# epoch, activity code, song id (see store.RECORD), IMEI code and position
+# of the record in the history of the IMEI.
+ENTRY = np.dtype([('cell', '<i8'),
+                  ('latitude', '<f8'),
+                  ('longitude', '<f8'),
+                  ('timestamp', '<i8'),
+                  ('activity', 'i1'),
+                  ('song', '<i4'),
+                  ('imei', '<i4'),
+                  ('position', '<i8'),
+                 ])
+
+
+class SpatialIndex(object):
+    """
+    Grid index of the locations of the user states of a
+    store.ColumnarStore, answering radius and k-nearest queries.
+
+    The globe is divided into cells of cell_size degrees of latitude and
+    longitude. The entries are kept in an array sorted by cell, the cells of
+    a row of the grid being numbered by increasing longitude, so that the
+    entries of a row of cells around a location are one slice found by
+    bisection. A query only computes the distances to the entries of the
+    cells intersecting the circle around the location.
+
+    The index registers itself as a listener of the store. New entries are
+    kept aside and scanned in full by the queries, until there are enough
+    of them to be merged into the sorted array.
+
+    The distances are great circle distances (geodesic.haversine), within
+    0.56% of the ellipsoidal ones.
+
+    Parameters
+    ----------
+    store               : store.ColumnarStore
+                        The store to index. Its existing histories are
+                        indexed on creation.
+    cell_size           : float
+                        The size of the cells, in degrees.
+    merge_size          : int
+                        The minimum number of new entries merged at once
+                        into the sorted array.
+    """
+
+    def __init__(self, store, cell_size=0.01, merge_size=65536):
+        if not isinstance(store, ColumnarStore):
+            raise Exception('Given store is not a ColumnarStore object.')
+        if cell_size <= 0 or cell_size > 180:
+            raise Exception('Given cell size is not in (0, 180].')
+        self.store = store
+        self.cell_size = float(cell_size)
+        self.rows = int(np.ceil(180.0 / self.cell_size))
+        self.columns = int(np.ceil(360.0 / self.cell_size))
+        self.merge_size = merge_size
+        self.imei_codes = {}
+        self.imeis = []
+        self.entries = np.zeros(0, dtype=ENTRY)
+        # Contiguous copy of the sorted cells, bisected by the queries
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_count = 0
+        for imei in store.imeis():
+            self.add(imei, store.history(imei), 0)
+        self._merge()
+        store.add_listener(self)
+
+    def __len__(self):
+        return len(self.entries) + self.pending_count
+
+    def add(self, imei, records, start):
+        """
+        Indexes the RECORD array written for the IMEI, start being the
+        position of its first record in the history.
+        """
+        if not len(records):
+            return
+        code = self.imei_codes.get(imei)
+        if code is None:
+            code = self.imei_codes[imei] = len(self.imeis)
+            self.imeis.append(imei)
+        entries = np.empty(len(records), dtype=ENTRY)
+        for field in ('latitude', 'longitude', 'timestamp', 'activity',
+                      'song'):
+            entries[field] = records[field]
+        entries['cell'] = self.cells(entries['latitude'],
+                                     entries['longitude'])
+        entries['imei'] = code
+        entries['position'] = np.arange(start, start + len(records))
+        self.pending.append(entries)
+        self.pending_count += len(entries)
+        if self.pending_count >= max(self.merge_size, len(self.entries) // 8):
+            self._merge()
+
+    def cells(self, latitudes, longitudes):
+        """
+        Returns the cells of the given coordinates, in degrees.
+        """
+        rows = np.clip(np.floor((np.asarray(latitudes) + 90.0) /
+                                self.cell_size).astype(np.int64),
+                       0, self.rows - 1)
+        columns = np.floor((np.asarray(longitudes) + 180.0) /
+                           self.cell_size).astype(np.int64) % self.columns
+        return rows * self.columns + columns
+
+    def within(self, location, radius, activities=None, start=None,
+               end=None):
+        """
+        Returns the user states within radius of the location, nearest
+        first.
+
+        Parameters
+        ----------
+        location            : (float, float)
+                            A couple of GPS coordinates (WGS84 format).
+        radius              : float
+                            The radius of the search, in meters.
+        activities          : list
+                            The activities (see user_state.ACTIVITIES) the
+                            user states are restricted to, all by default.
+        start               : datetime.datetime
+                            The earliest timestamp of the user states.
+        end                 : datetime.datetime
+                            The timestamp the user states are before.
+
+        Returns
+        -------
+        Returns the list of the (distance, imei, position) triples of the
+        matching user states, position being the one of the user state in
+        the history of the IMEI.
+        """
+        entries, distances = self.search(location, radius, activities,
+                                         start, end)
+        order = np.argsort(distances, kind='mergesort')
+        return self._matches(entries[order], distances[order])
+
+    def nearest(self, location, count, activities=None, start=None,
+                end=None):
+        """
+        Returns the count user states nearest to the location, nearest
+        first, with the same arguments and result as within.
+        """
+        if count < 1:
+            return []
+        radius = self.cell_size * np.pi / 180.0 * geodesic.EARTH_RADIUS
+        while True:
+            entries, distances = self.search(location, radius, activities,
+                                             start, end)
+            # Every entry closer than radius has been found, so the count
+            # nearest ones are among them
+            if len(distances) >= count or \
+                    radius >= np.pi * geodesic.EARTH_RADIUS:
+                break
+            radius *= 4
+        if len(distances) > count:
+            selected = np.argpartition(distances, count - 1)[:count]
+            entries, distances = entries[selected], distances[selected]
+        order = np.argsort(distances, kind='mergesort')
+        return self._matches(entries[order], distances[order])
+
+    def states(self, matches):
+        """
+        Iterates over the user states of the (distance, imei, position)
+        triples returned by within and nearest.
+        """
+        histories = {}
+        for _, imei, position in matches:
+            if imei not in histories:
+                histories[imei] = self.store.history(imei)
+            for user_state in self.store.states(
+                    imei, histories[imei][position:position + 1]):
+                yield user_state
+
+    def search(self, location, radius, activities=None, start=None,
+               end=None):
+        """
+        Returns the ENTRY array of the user states within radius of the
+        location, in no particular order, and the array of their distances.
+        Same arguments as within.
+        """
+        latitude, longitude = location
+        if self.pending_count and len(self.pending) > 1:
+            self.pending = [np.concatenate(self.pending)]
+        candidates = [self.entries[low:high] for low, high
+                      in self._slices(latitude, longitude, radius)]
+        candidates.extend(self.pending)
+        entries = np.concatenate(candidates) if candidates \
+            else np.zeros(0, dtype=ENTRY)
+        if activities is not None:
+            codes = [ACTIVITIES[activity] for activity in activities]
+            entries = entries[np.in1d(entries['activity'], codes)]
+        if start is not None:
+            entries = entries[entries['timestamp'] >=
+                              encode_timestamp(start)]
+        if end is not None:
+            entries = entries[entries['timestamp'] < encode_timestamp(end)]
+        distances = geodesic.haversine(latitude, longitude,
+                                       entries['latitude'],
+                                       entries['longitude'])
+        selected = distances <= radius
+        return entries[selected], distances[selected]
+
+    def _slices(self, latitude, longitude, radius):
+        """
+        Returns the (low, high) bounds of the slices of the sorted entries
+        in the cells intersecting the circle of the given radius.
+        """
+        if not len(self.entries):
+            return []
+        angle = radius / geodesic.EARTH_RADIUS
+        if angle >= np.pi:
+            return [(0, len(self.entries))]
+        spread = np.degrees(angle)
+        first_row, last_row = [
+            int(row) for row in np.clip(np.floor(
+                (np.array([latitude - spread, latitude + spread]) + 90.0) /
+                self.cell_size), 0, self.rows - 1)]
+        # Largest difference of longitude on the circle, unless it contains
+        # a pole
+        if abs(latitude) + spread >= 90.0:
+            ranges = [(0, self.columns - 1)]
+        else:
+            width = np.degrees(np.arcsin(np.sin(angle) /
+                                         np.cos(np.radians(latitude))))
+            first_column = int(np.floor((longitude - width + 180.0) /
+                                        self.cell_size))
+            last_column = int(np.floor((longitude + width + 180.0) /
+                                       self.cell_size))
+            if last_column - first_column + 1 >= self.columns:
+                ranges = [(0, self.columns - 1)]
+            elif first_column < 0:
+                ranges = [(first_column + self.columns, self.columns - 1),
+                          (0, last_column)]
+            elif last_column >= self.columns:
+                ranges = [(first_column, self.columns - 1),
+                          (0, last_column - self.columns)]
+            else:
+                ranges = [(first_column, last_column)]
+        rows = np.arange(first_row, last_row + 1, dtype=np.int64) * \
+            self.columns
+        lows = np.concatenate([rows + first for first, _ in ranges])
+        highs = np.concatenate([rows + last + 1 for _, last in ranges])
+        lows = np.searchsorted(self.keys, lows)
+        highs = np.searchsorted(self.keys, highs)
+        return [(low, high) for low, high in zip(lows.tolist(),
+                                                 highs.tolist())
+                if high > low]
+
+    def _merge(self):
+        """
+        Merges the new entries into the sorted array.
+        """
+        if not self.pending:
+            return
+        pending = np.concatenate(self.pending)
+        pending = pending[np.argsort(pending['cell'], kind='mergesort')]
+        self.entries = np.insert(
+            self.entries,
+            np.searchsorted(self.keys, pending['cell'],
+                            side='right'),
+            pending)
+        self.keys = np.ascontiguousarray(self.entries['cell'])
+        self.pending = []
+        self.pending_count = 0
+
+    def _matches(self, entries, distances):
+        imeis = self.imeis
+        return [(distance, imeis[code], position) for distance, code, position
+                in zip(distances.tolist(), entries['imei'].tolist(),
+                       entries['position'].tolist())]
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Store Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import calendar
+from datetime import datetime
+
+import numpy as np
+
+from song import intern_song
+from metrics import METRICS
+from user_state import UserState, ACTIVITIES, ACTIVITY_NAMES
+
+
+class UserStateStore(object):
+    """
+    Interface of the backends the user state histories are written to.
+    A store is used as a context manager, or closed explicitly.
+
+    Attributes
+    ----------
+    deferred            : bool
+                        Whether the written user states only reach the
+                        files on commit, and not when the buffers fill up,
+                        so that the files only change on commit, see
+                        parser.parse_csv_incremental.
+    """
+
+    deferred = False
+
+    def write(self, user_state):
+        """
+        Appends the user state to the history of its IMEI.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Makes the written user states visible to the readers.
+        """
+        pass
+
+    def commit(self):
+        """
+        Makes the written user states durable: they survive the process
+        being killed after the call.
+        """
+        self.flush()
+
+    def pending_paths(self):
+        """
+        Returns the list of the paths of the files the next commit appends
+        to, so that they can be truncated back if it is interrupted.
+        """
+        return []
+
+    def close(self):
+        """
+        Flushes the store and releases its resources.
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Fixed-width record of a user state in the columnar store:
+# seconds since the epoch (UTC), GPS coordinates, activity code (see
+# user_state.ACTIVITIES) and song id (line number in the songs file).
+RECORD = np.dtype([('timestamp', '<i8'),
+                   ('latitude', '<f8'),
+                   ('longitude', '<f8'),
+                   ('activity', 'i1'),
+                   ('song', '<i4'),
+                  ])
+
+
+class ColumnarStore(UserStateStore):
+    """
+    Columnar store of the user state histories.
+
+    The history of each IMEI is a '<imei>.states' file of fixed-width
+    RECORD entries, appended to and opened with np.memmap, so that the
+    columns can be used as arrays without building any Python object.
+    The songs are stored by id, the query strings being listed in order in
+    a 'songs.txt' file.
+
+    Parameters
+    ----------
+    directory           : str
+                        The directory holding the files of the store.
+    buffer_size         : int
+                        The number of records buffered before a flush.
+    """
+
+    def __init__(self, directory='.', buffer_size=65536):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.buffers = {}
+        self.buffered = 0
+        self.song_ids = {}
+        self.query_strings = []
+        self.pending_songs = []
+        self.counts = {}
+        self.listeners = []
+        if os.path.exists(self._songs_path()):
+            with open(self._songs_path(), 'r+b') as songs_file:
+                lines = songs_file.read().split('\n')
+                if lines[-1]:
+                    # Left incomplete by a process killed while writing it
+                    songs_file.truncate(songs_file.tell() - len(lines[-1]))
+                for line in lines[:-1]:
+                    self._add_song(line)
+
+    def path(self, imei):
+        """
+        Returns the path of the history file of the given IMEI.
+        """
+        return os.path.join(self.directory, str(imei) + '.states')
+
+    def imeis(self):
+        """
+        Returns the sorted list of the IMEIs with a history in the store.
+        """
+        self.flush()
+        return sorted(name[:-len('.states')] for name in
+                      os.listdir(self.directory) if name.endswith('.states'))
+
+    def length(self, imei):
+        """
+        Returns the number of records written for the IMEI, buffered ones
+        included.
+        """
+        count = self.counts.get(imei)
+        if count is None:
+            path = self.path(imei)
+            count = os.path.getsize(path) // RECORD.itemsize \
+                if os.path.exists(path) else 0
+            count += sum(1 if isinstance(record, tuple) else len(record)
+                         for record in self.buffers.get(imei, ()))
+            self.counts[imei] = count
+        return count
+
+    def add_listener(self, listener):
+        """
+        Registers an index to keep up to date: on every write, its
+        add(imei, records, start) method is called with the RECORD array
+        written for the IMEI and the position of the first of them in the
+        history.
+        """
+        self.listeners.append(listener)
+
+    def song_id(self, query_string):
+        """
+        Returns the id of the song, registering it if it is new.
+        """
+        song_id = self.song_ids.get(query_string)
+        if song_id is None:
+            if '\n' in query_string:
+                raise Exception('Given query string contains a newline.')
+            song_id = self._add_song(query_string)
+            self.pending_songs.append(query_string)
+        return song_id
+
+    def write(self, user_state):
+        """
+        Buffers the user state, flushing the buffers once they hold
+        buffer_size records.
+        """
+        record = (encode_timestamp(user_state.timestamp),
+                  user_state.location[0],
+                  user_state.location[1],
+                  ACTIVITIES[user_state.activity],
+                  self.song_id(user_state.song.query_string))
+        self._append(user_state.imei, record, 1)
+        if self.buffered >= self.buffer_size and not self.deferred:
+            self.flush()
+
+    def write_chunk(self, chunk):
+        """
+        Appends a whole block of resolved rows, as returned by
+        parser.resolve_chunk, without building any UserState object.
+        """
+        records = np.empty(len(chunk['imei']), dtype=RECORD)
+        records['timestamp'] = chunk['timestamp'].astype(np.int64)
+        records['latitude'] = chunk['latitude']
+        records['longitude'] = chunk['longitude']
+        records['activity'] = chunk['activity']
+        # The ids are the ones of the query strings of the interned songs, as
+        # in write
+        song_ids = {}
+        records['song'] = [song_ids[song] if song in song_ids
+                           else song_ids.setdefault(
+                               song, self.song_id(song.query_string))
+                           for song in chunk['song']]
+        imeis, inverse = np.unique(chunk['imei'], return_inverse=True)
+        # A stable sort keeps the records of each IMEI in their block order
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.searchsorted(inverse[order], np.arange(len(imeis) + 1))
+        for index, imei in enumerate(imeis):
+            block = records[order[bounds[index]:bounds[index + 1]]]
+            self._append(str(imei), block, len(block))
+        if self.buffered >= self.buffer_size and not self.deferred:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the buffered records and songs to their files.
+        """
+        bytes_written = 0
+        if self.pending_songs:
+            data = ''.join(query_string + '\n' for query_string
+                           in self.pending_songs)
+            with open(self._songs_path(), 'ab') as songs_file:
+                songs_file.write(data)
+            bytes_written += len(data)
+            self.pending_songs = []
+        for imei, records in self.buffers.iteritems():
+            with open(self.path(imei), 'ab') as history_file:
+                for block in _record_blocks(records):
+                    block.tofile(history_file)
+                    bytes_written += block.nbytes
+        METRICS.increment('bytes_written', bytes_written)
+        self.buffers = {}
+        self.buffered = 0
+
+    def pending_paths(self):
+        """
+        Returns the paths of the histories with buffered records. The songs
+        file is left out: the songs it lists beyond the ones committed are
+        only never referred to.
+        """
+        return [self.path(imei) for imei in self.buffers]
+
+    def history(self, imei):
+        """
+        Returns the history of the IMEI as a read-only memory-mapped array of
+        RECORD entries, in the order they were written.
+        """
+        if imei in self.buffers:
+            self.flush()
+        path = self.path(imei)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=RECORD)
+        return np.memmap(path, dtype=RECORD, mode='r')
+
+    def states(self, imei, records=None):
+        """
+        Iterates over the history of the IMEI, or over the given records of
+        it, as UserState objects. Their songs are interned lazily, so that
+        reading the history never looks a song up.
+        """
+        if records is None:
+            records = self.history(imei)
+        for record in records:
+            yield UserState(imei, ACTIVITY_NAMES[record['activity']],
+                            (float(record['latitude']),
+                             float(record['longitude'])),
+                            decode_timestamp(record['timestamp']),
+                            intern_song(self.query_strings[record['song']],
+                                        lazy=True))
+
+    def merge(self, directory):
+        """
+        Appends the histories of the columnar store in the given directory to
+        the ones of this store, translating its song ids.
+        Returns the number of records appended.
+        """
+        other = ColumnarStore(directory)
+        song_ids = np.array([self.song_id(query_string) for query_string
+                             in other.query_strings], dtype=np.int32)
+        self.flush()
+        count = 0
+        for imei in other.imeis():
+            records = np.array(other.history(imei))
+            records['song'] = song_ids[records['song']]
+            start = self.length(imei)
+            with open(self.path(imei), 'ab') as history_file:
+                records.tofile(history_file)
+            METRICS.increment('bytes_written', records.nbytes)
+            self.counts[imei] = start + len(records)
+            for listener in self.listeners:
+                listener.add(imei, records, start)
+            count += len(records)
+        return count
+
+    def _append(self, imei, records, count):
+        """
+        Buffers a record tuple or a RECORD array of the IMEI, and notifies
+        the listeners.
+        """
+        start = self.length(imei)
+        self.buffers.setdefault(imei, []).append(records)
+        self.buffered += count
+        self.counts[imei] = start + count
+        if self.listeners:
+            if isinstance(records, tuple):
+                records = np.array([records], dtype=RECORD)
+            for listener in self.listeners:
+                listener.add(imei, records, start)
+
+    def _songs_path(self):
+        return os.path.join(self.directory, 'songs.txt')
+
+    def _add_song(self, query_string):
+        song_id = len(self.query_strings)
+        self.query_strings.append(query_string)
+        self.song_ids[query_string] = song_id
+        return song_id
+
+
+def _record_blocks(records):
+    """
+    Groups a buffer mixing record tuples and RECORD arrays into RECORD
+    arrays, in order.
+    """
+    tuples = []
+    for record in records:
+        if isinstance(record, tuple):
+            tuples.append(record)
+            continue
+        if tuples:
+            yield np.array(tuples, dtype=RECORD)
+            tuples = []
+        yield record
+    if tuples:
+        yield np.array(tuples, dtype=RECORD)
+
+
+def encode_timestamp(timestamp):
+    """
+    Returns the datetime as an int number of seconds since the epoch, the
+    datetime being taken as UTC.
+    """
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def decode_timestamp(seconds):
+    """
+    Returns the datetime of the given number of seconds since the epoch.
+    """
+    return datetime.utcfromtimestamp(int(seconds))
@@ -2,18 +2,55 @@
 """
 Tests for the Recom system
 
+Usage: tests.py [--network]
+
+The test_* functions run offline. main, which looks songs up on Discogs, is
+only run with --network.
+
 @author: ymiche
 @version: 0.1
 """
 
-from datetime import datetime
+import os
+import sys
+import time
+import glob
+import signal
+import gzip
+import shutil
+import tempfile
+import threading
+import random
+import contextlib
+import cPickle as pkl
+from datetime import datetime, timedelta
+
+import numpy as np
+import requests
+
+import geodesic
+import song as song_module
+import user_state as user_state_module
 from song import Song
 from user_state import UserState
+from reader import UserStateReader
+from release_db import ReleaseDatabase, build_release_database
+from text_index import TextIndex
+from catalog import SongCatalog
+from cache import MetadataCache, NegativeCache
+from dead_letters import DeadLetterWriter, read_dead_letters
+from store import ColumnarStore, encode_timestamp
+from time_index import TimeIndex
+from spatial_index import SpatialIndex
+from writer import UserStateWriter
+from benchmarks import FakeDiscogs, write_csv, generate_lines
+import parser as parser_module
+from metrics import METRICS
 
 
 def main():
     """
-    Main test function for now.
+    Compares two songs and two user states looked up on Discogs.
     """
     imei1 = 123456789012345
     activity1 = 'STILL'
@@ -39,5 +76,992 @@ def main():
     print userstate1.distance(userstate2)
 
 
+def write_legacy_user_states(file_path, states):
+    """
+    Writes (imei, activity, location, timestamp, song attributes) states to
+    a file as UserState.write did before the slots: plain objects pickled
+    with protocol 0, one gzip member each.
+    """
+    classes = (song_module.Song, user_state_module.UserState)
+
+    class LegacySong(object):
+        pass
+
+    class LegacyUserState(object):
+        pass
+
+    # The pickler checks that the classes are found under their names
+    LegacySong.__module__, LegacySong.__name__ = 'song', 'Song'
+    LegacyUserState.__module__, LegacyUserState.__name__ = 'user_state', \
+        'UserState'
+    song_module.Song = LegacySong
+    user_state_module.UserState = LegacyUserState
+    try:
+        for imei, activity, location, timestamp, attributes in states:
+            song = LegacySong()
+            song.__dict__.update(attributes)
+            user_state = LegacyUserState()
+            user_state.__dict__.update(imei=imei, activity=activity,
+                                       location=location,
+                                       timestamp=timestamp, song=song)
+            with contextlib.closing(gzip.GzipFile(file_path, 'ab')) \
+                    as write_file:
+                pkl.dump(user_state, write_file)
+    finally:
+        song_module.Song, user_state_module.UserState = classes
+
+
+def test_legacy_pickles():
+    """
+    Loads a user state file written before Song and UserState had slots.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(directory, '123456789012345.pkl.gz')
+        attributes = {'query_string': 'Legacy Pickle Song',
+                      'release_id': 42,
+                      'genre': 'Electronic',
+                      'style': 'Europop',
+                      'tempo': 0,
+                      'year': 1997,
+                      'country': 'Denmark',
+                      'sens_me_values': (0, 0)}
+        write_legacy_user_states(file_path, [
+            ('123456789012345', 'Standing', (60.17, 24.94),
+             datetime(2013, 1, 1, 12, 0, 0), attributes),
+            ('123456789012345', 'Walking', (60.18, 24.95),
+             datetime(2013, 1, 1, 12, 5, 0), attributes)])
+        user_states = []
+        with contextlib.closing(gzip.GzipFile(file_path, 'rb')) as read_file:
+            while True:
+                try:
+                    user_states.append(pkl.load(read_file))
+                except EOFError:
+                    break
+        assert len(user_states) == 2
+        song = song_module.intern_song('Legacy Pickle Song', lazy=True)
+        for user_state in user_states:
+            assert user_state.song is song
+        assert song.is_resolved()
+        assert (song.release_id, song.genre, song.year) == \
+            (42, 'Electronic', 1997)
+        assert user_states[1].activity == 'Walking'
+        reader = UserStateReader(file_path)
+        assert len(reader) == 2
+        assert [user_state.timestamp for user_state in reader] == \
+            [datetime(2013, 1, 1, 12, 0, 0), datetime(2013, 1, 1, 12, 5, 0)]
+    finally:
+        shutil.rmtree(directory)
+
+
+RELEASES_DUMP = """<releases>
+<release id="101" status="Accepted">
+  <artists><artist><name>Aqua (2)</name></artist></artists>
+  <title>Barbie Girl</title>
+  <genres><genre>Electronic</genre></genres>
+  <styles><style>Europop</style></styles>
+  <country>Denmark</country>
+  <released>1997-05-14</released>
+  <master_id is_main_release="true">11</master_id>
+</release>
+<release id="102" status="Accepted">
+  <artists><artist><name>Cher</name></artist></artists>
+  <title>Turn Back Time</title>
+  <genres><genre>Pop</genre></genres>
+  <styles><style>Ballad</style></styles>
+  <country>Unknown</country>
+  <released>1989</released>
+</release>
+</releases>
+"""
+
+
+def test_release_database_offline():
+    """
+    Resolves songs offline from a release database built from a small
+    synthetic dump, and compares them.
+    """
+    directory = tempfile.mkdtemp()
+    saved = (song_module.RELEASE_DB, song_module.CACHE, song_module.OFFLINE)
+    try:
+        dump_path = os.path.join(directory, 'releases.xml')
+        with open(dump_path, 'wb') as dump_file:
+            dump_file.write(RELEASES_DUMP)
+        database_path = os.path.join(directory, 'releases.db')
+        counts = build_release_database([dump_path], database_path)
+        assert counts == {'releases': 2, 'masters': 0}
+        song_module.RELEASE_DB = ReleaseDatabase(database_path)
+        song_module.CACHE = None
+        song_module.OFFLINE = True
+        song1 = song_module.intern_song('Aqua - Barbie Girl')
+        song2 = song_module.intern_song('turn back time')
+        assert (song1.release_id, song1.genre, song1.style, song1.tempo,
+                song1.year, song1.country) == \
+            (101, 'Electronic', 'Europop', 0, 1997, 'Denmark')
+        assert (song2.release_id, song2.year) == (102, 1989)
+        distances = song_module.distance_songs(song1, song2)
+        assert distances['distance_tempo'] == 0
+        assert distances['distance_year'] == 8
+        assert distances['distance_country'] == -1.0
+        try:
+            song_module.intern_song('Not In The Dump')
+        except song_module.SongNotFoundError:
+            pass
+        else:
+            raise AssertionError('Offline lookup of an unknown song passed.')
+    finally:
+        song_module.RELEASE_DB, song_module.CACHE, song_module.OFFLINE = \
+            saved
+        shutil.rmtree(directory)
+
+
+def test_text_index_coverage():
+    """
+    Checks that a short indexed text does not answer a longer query string
+    sharing one of its words, and that punctuation-only titles are told
+    apart.
+    """
+    index = TextIndex()
+    index.add(1, 'Love')
+    index.add(2, 'Aqua - Barbie Girl')
+    index.add(3, '!!!')
+    assert index.release_id('Whitney Houston - I Will Always Love You') \
+        is None
+    assert index.release_id('Barbie Girl') == 2
+    assert song_module.normalize_query_string('!!!') != \
+        song_module.normalize_query_string('???')
+    assert index.release_id('!!!') == 3
+    assert index.release_id('???') is None
+
+
+def resolve_concurrently(query_string, threads, found=True):
+    """
+    Resolves the interned lazy song of the query string on several threads
+    at once, through stand-ins of the Discogs Search and Release calls
+    which hold the search until the other threads wait for it.
+
+    Returns
+    -------
+    Returns the numbers of Search and Release calls, the number of calls
+    coalesced, and the list of the errors raised in the threads.
+    """
+    discogs = song_module.discogs
+    originals = (discogs.Search, discogs.Release)
+    saved = (song_module.CACHE, song_module.RELEASE_DB,
+             song_module.TEXT_INDEX, song_module.NEGATIVE_CACHE,
+             song_module.RATE_LIMITER, song_module.OFFLINE)
+    calls = {'Search': 0, 'Release': 0}
+    coalesced = song_module.IN_FLIGHT.coalesced
+
+    class Result(object):
+        def __init__(self, data):
+            self.data = data
+
+    class Search(object):
+        def __init__(self, query_string):
+            calls['Search'] += 1
+
+        def results(self):
+            deadline = time.time() + 5.0
+            while song_module.IN_FLIGHT.coalesced - coalesced < \
+                    threads - 1 and time.time() < deadline:
+                time.sleep(0.001)
+            return [Result({'id': 7})] if found else []
+
+    def release(release_id):
+        calls['Release'] += 1
+        return Result({'id': release_id, 'genres': ['Electronic'],
+                       'styles': ['Europop'], 'year': 1997,
+                       'country': 'Denmark'})
+
+    song = song_module.intern_song(query_string, lazy=True)
+    errors = []
+
+    def resolve():
+        try:
+            song.resolve()
+        except song_module.SongNotFoundError, error:
+            errors.append(error)
+
+    discogs.Search, discogs.Release = Search, release
+    song_module.CACHE = song_module.RELEASE_DB = song_module.TEXT_INDEX = \
+        song_module.NEGATIVE_CACHE = song_module.RATE_LIMITER = None
+    song_module.OFFLINE = False
+    try:
+        workers = [threading.Thread(target=resolve)
+                   for _ in xrange(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        discogs.Search, discogs.Release = originals
+        (song_module.CACHE, song_module.RELEASE_DB, song_module.TEXT_INDEX,
+         song_module.NEGATIVE_CACHE, song_module.RATE_LIMITER,
+         song_module.OFFLINE) = saved
+    return calls['Search'], calls['Release'], \
+        song_module.IN_FLIGHT.coalesced - coalesced, errors
+
+
+def test_coalesced_resolution(threads=8):
+    """
+    Resolves one interned lazy song on several threads at once: a single
+    lookup is made, and its error is shared.
+    """
+    searches, releases, coalesced, errors = resolve_concurrently(
+        'Coalesced Song', threads)
+    assert (searches, releases, coalesced, errors) == (1, 1, threads - 1, [])
+    song = song_module.intern_song('Coalesced Song', lazy=True)
+    assert song.is_resolved() and song.release_id == 7
+    searches, releases, coalesced, errors = resolve_concurrently(
+        'Coalesced Missing Song', threads, found=False)
+    assert (searches, releases, coalesced) == (1, 0, threads - 1)
+    assert len(errors) == threads
+    assert all(error is errors[0] for error in errors)
+
+
+def resolved_song(query_string, genre='Pop', style='Ballad', tempo=0,
+                  year=1990, country='France', release_id=1):
+    """
+    Returns an interned song resolved with the given metadata, without any
+    lookup.
+    """
+    song = song_module.intern_song(query_string, lazy=True)
+    song.assign((release_id, genre, style, tempo, year, country, (1.0, 1.0)))
+    return song
+
+
+def test_unknown_countries():
+    """
+    Checks that the countries missing from the table are treated as missing
+    by distance_countries, as by SongCatalog.
+    """
+    songs = [resolved_song('Country Song Atlantis', country='Atlantis'),
+             resolved_song('Country Song France', country='France'),
+             resolved_song('Country Song Unknown', country='Unknown'),
+             resolved_song('Country Song Germany', country='Germany')]
+    catalog = SongCatalog(songs)
+    matrix = catalog.distance_matrix(catalog, 'country')
+    for index1, song1 in enumerate(songs):
+        for index2, song2 in enumerate(songs):
+            distance = song_module.distance_countries(song1.country,
+                                                      song2.country)
+            assert abs(matrix[index1, index2] - distance) < 1e-6
+    assert song_module.distance_countries('Atlantis', 'France') == -1.0
+    song_module.distance_songs(songs[0], songs[1])
+
+
+def test_chunked_parsing():
+    """
+    Checks that the chunked and row by row parsings store the same user
+    states, and that they both reject a block in which a row with three
+    coordinates makes up for one with a single one.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(directory, 'rows.csv')
+        write_csv(file_path, 2500, imeis=7, songs=30)
+        stores = []
+        with FakeDiscogs():
+            for name, parse in (('rows', parser_module.parse_csv),
+                                ('chunks', parser_module.parse_csv_chunked)):
+                with ColumnarStore(os.path.join(directory, name)) as store:
+                    if parse is parser_module.parse_csv_chunked:
+                        parse(file_path, store=store, chunk_size=300)
+                    else:
+                        parse(file_path, store=store)
+                stores.append(ColumnarStore(os.path.join(directory, name)))
+        rows_store, chunks_store = stores
+        assert rows_store.query_strings == chunks_store.query_strings
+        assert sorted(rows_store.imeis()) == sorted(chunks_store.imeis())
+        for imei in rows_store.imeis():
+            assert (rows_store.history(imei) ==
+                    chunks_store.history(imei)).all()
+        lines = list(generate_lines(2))
+        lines[0] = lines[0].replace('",', ',2.0",', 1)
+        lines[1] = lines[1].replace(',24.9', '', 1)
+        malformed_path = os.path.join(directory, 'malformed.csv')
+        with open(malformed_path, 'wb') as malformed_file:
+            malformed_file.write(''.join(lines))
+        with FakeDiscogs():
+            for parse in (parser_module.parse_csv,
+                          parser_module.parse_csv_chunked):
+                store = ColumnarStore(os.path.join(directory, 'malformed'))
+                try:
+                    parse(malformed_path, store=store)
+                except Exception, error:
+                    assert 'coordinates' in str(error)
+                else:
+                    raise AssertionError('Malformed locations were parsed.')
+    finally:
+        shutil.rmtree(directory)
+
+
+def user_states(imei, count, first=datetime(2013, 1, 1), song=None):
+    """
+    Returns count user states of the IMEI, a minute apart.
+    """
+    if song is None:
+        song = resolved_song('User State Song')
+    return [UserState(imei, 'Walking', (60.17 + index * 1e-4, 24.94),
+                      first + timedelta(minutes=index), song)
+            for index in xrange(count)]
+
+
+def test_user_state_reader():
+    """
+    Builds the index of a user state file written in several gzip members,
+    indexes the states appended later, and reads the latest ones and the
+    ones of a time window by decoding only the members holding them.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        imei = '123456789012345'
+        states = user_states(imei, 3000)
+        with UserStateWriter(directory, buffer_size=4096,
+                             member_size=16384) as writer:
+            for user_state in states[:2000]:
+                writer.write(user_state)
+        path = writer.path(imei)
+        reader = UserStateReader(path)
+        assert len(reader) == 2000
+        assert len(reader.members) > 10
+        assert os.path.exists(path + '.idx')
+        decoded = []
+        member_data = reader._member_data
+        reader._member_data = lambda member_index: \
+            decoded.append(member_index) or member_data(member_index)
+        latest = reader.latest(5)
+        assert [user_state.timestamp for user_state in latest] == \
+            [user_state.timestamp for user_state in states[1995:2000]]
+        assert set(decoded) == set([len(reader.members) - 1]) or \
+            set(decoded) == set([len(reader.members) - 2,
+                                 len(reader.members) - 1])
+        with UserStateWriter(directory, member_size=16384) as writer:
+            for user_state in states[2000:]:
+                writer.write(user_state)
+        assert reader.build_index() == 1000
+        assert len(reader) == 3000
+        reloaded = UserStateReader(path)
+        assert len(reloaded) == 3000 and reloaded.build_index() == 0
+        window = list(reloaded.between(datetime(2013, 1, 1, 10),
+                                       datetime(2013, 1, 1, 11)))
+        assert [user_state.timestamp for user_state in window] == \
+            [datetime(2013, 1, 1, 10) + timedelta(minutes=index)
+             for index in xrange(60)]
+        assert [user_state.location for user_state in reloaded.latest(2)] == \
+            [user_state.location for user_state in states[-2:]]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_pipeline_metrics():
+    """
+    Checks the counts and timers of the row by row stages, and that a
+    disabled registry records nothing.
+    """
+    directory = tempfile.mkdtemp()
+    enabled = METRICS.enabled
+    try:
+        file_path = os.path.join(directory, 'rows.csv')
+        write_csv(file_path, 2345, imeis=3, songs=10)
+        with FakeDiscogs():
+            METRICS.reset()
+            with ColumnarStore(os.path.join(directory, 'on')) as store:
+                assert parser_module.parse_csv(file_path, store=store) == 2345
+            snapshot = METRICS.snapshot()
+            assert snapshot['counters']['rows_parsed'] == 2345
+            assert snapshot['counters']['states_written'] == 2345
+            assert 'rows_dropped' not in snapshot['counters']
+            for timer in ('parse', 'resolve', 'write'):
+                assert snapshot['timers'][timer]['count'] == 2345
+            METRICS.reset()
+            METRICS.enabled = False
+            with ColumnarStore(os.path.join(directory, 'off')) as store:
+                assert parser_module.parse_csv(file_path, store=store) == 2345
+            snapshot = METRICS.snapshot()
+            assert snapshot['counters'] == {} and snapshot['timers'] == {}
+    finally:
+        METRICS.enabled = enabled
+        METRICS.reset()
+        shutil.rmtree(directory)
+
+
+@contextlib.contextmanager
+def isolated_lookups(**settings):
+    """
+    Resolves the songs through Discogs only, without any cache, database,
+    index or rate limiter, the given globals of the song module being
+    overridden, and restores the globals on exit.
+    """
+    names = ('CACHE', 'RELEASE_DB', 'TEXT_INDEX', 'NEGATIVE_CACHE',
+             'RATE_LIMITER', 'OFFLINE', 'RETRIES', 'RETRY_DELAY')
+    saved = [getattr(song_module, name) for name in names]
+    song_module.CACHE = song_module.RELEASE_DB = song_module.TEXT_INDEX = \
+        song_module.NEGATIVE_CACHE = song_module.RATE_LIMITER = None
+    song_module.OFFLINE = False
+    for name, value in settings.iteritems():
+        setattr(song_module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in zip(names, saved):
+            setattr(song_module, name, value)
+
+
+@contextlib.contextmanager
+def failing_discogs(errors):
+    """
+    Installs a FakeDiscogs whose searches of the query strings in errors
+    raise the error given for them, and yields the list of the query
+    strings searched.
+    """
+    searched = []
+    with FakeDiscogs() as fake:
+        search = fake.search
+
+        def failing_search(query_string):
+            searched.append(query_string)
+            if query_string in errors:
+                raise errors[query_string]
+            return search(query_string)
+
+        song_module.discogs.Search = failing_search
+        yield searched
+
+
+def test_metadata_cache():
+    """
+    Checks the normalized keys, the least recently used eviction, the
+    expiry, the merge of the entries of another cache and the persistence
+    of MetadataCache.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(directory, 'cache.pkl.gz')
+        cache = MetadataCache(file_path, max_size=3, ttl=60.0)
+        for index in xrange(3):
+            cache.set_release_id('Artist - Song %d' % index, index)
+        assert cache.get_release_id('artist song 0') == 0
+        cache.set_release_id('Artist - Song 3', 3)
+        assert cache.get_release_id('Artist - Song 1') is None
+        assert [cache.get_release_id('Artist - Song %d' % index)
+                for index in (2, 3, 0)] == [2, 3, 0]
+        cache.set_details(7, ('Pop', 'Ballad', 0, 1990, 'France'))
+        try:
+            cache.set_details(8, ('Pop', 'Ballad'))
+        except Exception:
+            pass
+        else:
+            raise AssertionError('Incomplete release details were cached.')
+        stale = time.time() - 120.0
+        cache.merge(release_ids=[('artist song 0', (stale, 10)),
+                                 ('old song', (stale, 11))],
+                    details=[(9, (stale, ('Rock', 'Punk', 0, 1977, 'UK')))])
+        assert [key for key, _ in cache.entries()[0]] == \
+            ['artist song 3', 'artist song 0', 'old song']
+        assert [key for key, _ in cache.entries(since=stale + 1)[0]] == \
+            ['artist song 3', 'artist song 0']
+        assert cache.expire() == 2
+        assert cache.get_release_id('Artist - Song 0') == 0
+        assert cache.get_release_id('Old Song') is None
+        assert cache.get_details(9) is None
+        cache.save()
+        reloaded = MetadataCache(file_path, max_size=3, ttl=60.0)
+        assert reloaded.entries() == cache.entries()
+        assert reloaded.get_details(7) == ('Pop', 'Ballad', 0, 1990,
+                                           'France')
+        stats = cache.stats()
+        assert (stats['release_ids'], stats['details']) == (2, 1)
+        assert (stats['hits'], stats['misses']) == (5, 3)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_negative_cache():
+    """
+    Checks the expiry and the least recently used eviction of NegativeCache,
+    and that the songs failing on a transient error are looked up again
+    sooner than the ones Discogs does not know.
+    """
+    cache = NegativeCache(max_size=2, ttl=60.0, transient_ttl=0.05)
+    transient = song_module.TransientLookupError('503 Service Unavailable')
+    permanent = song_module.SongNotFoundError('404 Not Found')
+    cache.set('transient', transient, transient=True)
+    cache.set('permanent', permanent)
+    assert cache.get('transient') is transient
+    time.sleep(0.1)
+    assert cache.get('transient') is None
+    assert cache.get('permanent') is permanent
+    cache.set('other', permanent)
+    assert cache.get('permanent') is permanent
+    cache.set('last', permanent)
+    assert len(cache) == 2 and cache.get('other') is None
+    assert cache.stats() == {'hits': 3, 'failures': 2}
+    errors = {'Negative Transient Song':
+                  song_module.discogs.DiscogsAPIError('503 Unavailable'),
+              'Negative Missing Song':
+                  song_module.discogs.DiscogsAPIError('404 Not Found')}
+    negative_cache = NegativeCache(ttl=60.0, transient_ttl=0.2)
+    with isolated_lookups(NEGATIVE_CACHE=negative_cache, RETRIES=1,
+                          RETRY_DELAY=0.001):
+        with failing_discogs(errors) as searched:
+            for attempt in xrange(2):
+                for query_string, error_class in (
+                        ('Negative Transient Song',
+                         song_module.TransientLookupError),
+                        ('Negative Missing Song',
+                         song_module.SongNotFoundError)):
+                    for _ in xrange(3):
+                        try:
+                            song_module.intern_song(query_string)
+                        except error_class:
+                            pass
+                        else:
+                            raise AssertionError('Failing song resolved.')
+                time.sleep(0.3)
+    # One retry per lookup, the transient failure being looked up again
+    # once expired
+    assert searched.count('Negative Transient Song') == 4
+    assert searched.count('Negative Missing Song') == 1
+    assert negative_cache.hits == 9
+
+
+def test_discogs_retries():
+    """
+    Checks that call_discogs retries the transient errors RETRIES times with
+    an exponential backoff, and the other ones never.
+    """
+    assert song_module.is_transient_error(requests.ConnectionError())
+    assert song_module.is_transient_error(
+        song_module.discogs.DiscogsAPIError('429 Too Many Requests'))
+    assert song_module.is_transient_error(
+        song_module.discogs.DiscogsAPIError('502 Bad Gateway'))
+    assert not song_module.is_transient_error(
+        song_module.discogs.DiscogsAPIError('404 Not Found'))
+    assert not song_module.is_transient_error(
+        song_module.discogs.DiscogsAPIError('Unexpected answer'))
+    delays = []
+    sleep = time.sleep
+    time.sleep = delays.append
+
+    def failing(errors):
+        calls = []
+
+        def function():
+            calls.append(None)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return 'release'
+        return function, calls
+
+    try:
+        with isolated_lookups(RETRIES=3, RETRY_DELAY=0.5):
+            function, calls = failing([requests.ConnectionError(),
+                                       song_module.discogs.DiscogsAPIError(
+                                           '503 Service Unavailable')])
+            assert song_module.call_discogs(function) == 'release'
+            assert (len(calls), delays) == (3, [0.5, 1.0])
+            del delays[:]
+            function, calls = failing([requests.Timeout()] * 5)
+            try:
+                song_module.call_discogs(function)
+            except song_module.TransientLookupError:
+                pass
+            else:
+                raise AssertionError('Failing call succeeded.')
+            assert (len(calls), delays) == (4, [0.5, 1.0, 2.0])
+            del delays[:]
+            function, calls = failing([song_module.discogs.DiscogsAPIError(
+                '404 Not Found')])
+            try:
+                song_module.call_discogs(function)
+            except song_module.SongNotFoundError:
+                pass
+            else:
+                raise AssertionError('Failing call succeeded.')
+            assert (len(calls), delays) == (1, [])
+            song_module.OFFLINE = True
+            function, calls = failing([])
+            try:
+                song_module.call_discogs(function)
+            except song_module.SongNotFoundError:
+                pass
+            else:
+                raise AssertionError('Offline call succeeded.')
+            assert len(calls) == 0
+    finally:
+        time.sleep = sleep
+
+
+def test_dead_letters():
+    """
+    Records the rows dropped on failed lookups to a dead-letter file, and
+    resolves the transient ones again from it once Discogs answers.
+    """
+    directory = tempfile.mkdtemp()
+    saved = parser_module.DEAD_LETTERS
+    try:
+        file_path = os.path.join(directory, 'dead_letters.csv')
+        query_strings = ('Dead Letter Song', 'Dead Letter Transient Song',
+                         'Dead Letter Missing Song')
+        rows = [('%015d' % (index % 2), datetime(2013, 1, 1, 12, index),
+                 query_strings[index % 3], 'Walking',
+                 (60.17 + index * 1e-5, 24.94 - index * 1e-5))
+                for index in xrange(9)]
+        errors = {query_strings[1]:
+                      song_module.discogs.DiscogsAPIError('500 Error'),
+                  query_strings[2]:
+                      song_module.discogs.DiscogsAPIError('404 Not Found')}
+        with isolated_lookups(RETRIES=0):
+            with failing_discogs(errors):
+                parser_module.DEAD_LETTERS = DeadLetterWriter(file_path)
+                with parser_module.DEAD_LETTERS:
+                    resolved = list(parser_module.resolve_user_states(rows))
+                assert parser_module.DEAD_LETTERS.rows_written == 6
+            parser_module.DEAD_LETTERS = None
+            assert [user_state.song.query_string for user_state
+                    in resolved] == [query_strings[0]] * 3
+            assert list(read_dead_letters(file_path)) == \
+                [row for row in rows if row[2] != query_strings[0]]
+            transient_rows = [row for row in rows
+                              if row[2] == query_strings[1]]
+            with failing_discogs({}):
+                resolved = list(parser_module.resolve_user_states(
+                    read_dead_letters(file_path, kinds=('transient',))))
+        assert [(user_state.imei, user_state.timestamp,
+                 user_state.song.query_string, user_state.activity,
+                 user_state.location) for user_state in resolved] == \
+            transient_rows
+        assert all(user_state.song.is_resolved() for user_state in resolved)
+    finally:
+        parser_module.DEAD_LETTERS = saved
+        shutil.rmtree(directory)
+
+
+def test_user_state_writer():
+    """
+    Writes the states of more IMEIs than open files, in several gzip members,
+    and reads them back, after a commit and after closing the writer.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        song = resolved_song('Writer Song')
+        states = dict(('%015d' % imei, user_states('%015d' % imei, 300,
+                                                   song=song))
+                      for imei in xrange(5))
+        writer = UserStateWriter(directory, max_open_files=2,
+                                 buffer_size=2048, member_size=8192)
+        for index in xrange(300):
+            if index == 150:
+                writer.commit()
+                assert not writer.streams
+                for imei, imei_states in states.iteritems():
+                    assert len(UserStateReader(writer.path(imei))) == 150
+            for imei in sorted(states):
+                writer.write(states[imei][index])
+                assert len(writer.streams) <= 2
+        writer.close()
+        try:
+            writer.write(states['%015d' % 0][0])
+        except Exception:
+            pass
+        else:
+            raise AssertionError('Closed writer accepted a state.')
+        sizes = 0
+        for imei, imei_states in states.iteritems():
+            reader = UserStateReader(writer.path(imei))
+            assert len(reader.members) > 2
+            assert [(user_state.imei, user_state.timestamp,
+                     user_state.location) for user_state in reader] == \
+                [(user_state.imei, user_state.timestamp, user_state.location)
+                 for user_state in imei_states]
+            sizes += os.path.getsize(writer.path(imei))
+        stats = writer.stats()
+        assert stats['states_written'] == 1500
+        assert stats['bytes_pickled'] == sum(
+            len(pkl.dumps(user_state, pkl.HIGHEST_PROTOCOL))
+            for imei_states in states.itervalues()
+            for user_state in imei_states)
+        assert (stats['bytes_written'], stats['bytes_open']) == (sizes, 0)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_columnar_store():
+    """
+    Writes user states to a columnar store, reads them back from a reopened
+    store, and merges another store with its own song ids into it.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        songs = [resolved_song('Columnar Song %d' % index)
+                 for index in xrange(3)]
+        states = [UserState('%015d' % (index % 4), ('Standing', 'Walking',
+                                                    'Running')[index % 3],
+                            (60.17 + index * 1e-4, 24.94 - index * 1e-4),
+                            datetime(2013, 1, 1) + timedelta(seconds=index),
+                            songs[index % 3 if index < 500 else 0])
+                  for index in xrange(1000)]
+        with ColumnarStore(os.path.join(directory, 'first'),
+                           buffer_size=64) as store:
+            for user_state in states[:500]:
+                store.write(user_state)
+            assert store.length('%015d' % 1) == 125
+        with ColumnarStore(os.path.join(directory, 'second'),
+                           buffer_size=64) as other:
+            other.write(UserState('%015d' % 9, 'Running', (0.0, 0.0),
+                                  datetime(2013, 2, 1), songs[2]))
+            for user_state in states[500:]:
+                other.write(user_state)
+        assert other.query_strings[:2] == ['Columnar Song 2',
+                                           'Columnar Song 0']
+        store = ColumnarStore(os.path.join(directory, 'first'))
+        assert store.query_strings == ['Columnar Song %d' % index
+                                       for index in xrange(3)]
+        assert store.merge(os.path.join(directory, 'second')) == 501
+        store = ColumnarStore(os.path.join(directory, 'first'))
+        assert sorted(store.imeis()) == ['%015d' % imei
+                                         for imei in (0, 1, 2, 3, 9)]
+
+        def fields(user_state):
+            return (user_state.imei, user_state.activity, user_state.location,
+                    user_state.timestamp, user_state.song.query_string)
+
+        for imei in xrange(4):
+            imei = '%015d' % imei
+            assert [fields(user_state) for user_state
+                    in store.states(imei)] == \
+                [fields(user_state) for user_state in states
+                 if user_state.imei == imei]
+        assert [fields(user_state) for user_state
+                in store.states('%015d' % 9)] == \
+            [('%015d' % 9, 'Running', (0.0, 0.0), datetime(2013, 2, 1),
+              'Columnar Song 2')]
+    finally:
+        shutil.rmtree(directory)
+
+
+def random_user_states(count, imeis, locations, seed=0):
+    """
+    Returns count user states of the given number of IMEIs, at the given
+    (latitude, longitude, spread) locations, with distinct timestamps
+    written out of time order.
+    """
+    draw = random.Random(seed)
+    song = resolved_song('Index Song')
+    minutes = range(count)
+    draw.shuffle(minutes)
+    states = []
+    for index, minute in enumerate(minutes):
+        latitude, longitude, spread = locations[index % len(locations)]
+        states.append(UserState(
+            '%015d' % draw.randrange(imeis),
+            ('Standing', 'Walking', 'Running')[draw.randrange(3)],
+            (latitude + draw.uniform(-spread, spread),
+             longitude + draw.uniform(-spread, spread)),
+            datetime(2013, 1, 1) + timedelta(minutes=minute), song))
+    return states
+
+
+def test_time_index():
+    """
+    Compares the time range queries of a TimeIndex kept up to date on
+    writes, and of one built on the reopened store, to a full scan.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        store = ColumnarStore(directory, buffer_size=64)
+        index = TimeIndex(store, merge_size=50)
+        for user_state in random_user_states(1500, 4, [(60.17, 24.94, 0.1)]):
+            store.write(user_state)
+        store.flush()
+        timestamps = dict((imei, store.history(imei)['timestamp'].tolist())
+                          for imei in store.imeis())
+        windows = [(datetime(2013, 1, 1, hour), datetime(2013, 1, 1, hour,
+                                                         minute))
+                   for hour, minute in ((0, 1), (3, 30), (10, 59), (20, 0))]
+        windows.append((datetime(2012, 1, 1), datetime(2014, 1, 1)))
+        for current in (index, TimeIndex(ColumnarStore(directory))):
+            for start, end in windows:
+                low, high = encode_timestamp(start), encode_timestamp(end)
+                matches = sorted((timestamp, imei, position)
+                                 for imei, imei_timestamps
+                                 in timestamps.iteritems()
+                                 for position, timestamp
+                                 in enumerate(imei_timestamps)
+                                 if low <= timestamp < high)
+                assert current.global_range(start, end) == \
+                    [(imei, position) for _, imei, position in matches]
+                for imei in timestamps:
+                    assert current.range(imei, start, end).tolist() == \
+                        [position for _, match_imei, position in matches
+                         if match_imei == imei]
+                    assert current.columns(imei, start, end)[
+                        'timestamp'].tolist() == \
+                        [timestamp for timestamp, match_imei, _ in matches
+                         if match_imei == imei]
+            imei = '%015d' % 2
+            assert len(current.last(imei, timedelta(hours=2))) == \
+                sum(1 for timestamp in timestamps[imei]
+                    if timestamp > max(timestamps[imei]) - 7200)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_spatial_index():
+    """
+    Compares the radius and nearest neighbour queries of a SpatialIndex,
+    with merged and pending entries, to a full scan, around Helsinki and
+    across the antimeridian.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        store = ColumnarStore(directory, buffer_size=64)
+        index = SpatialIndex(store, cell_size=0.01, merge_size=100)
+        for user_state in random_user_states(
+                1450, 5, [(60.17, 24.94, 0.05), (0.0, 179.99, 0.02),
+                          (0.0, -179.99, 0.02)]):
+            store.write(user_state)
+        assert index.pending_count and len(index) == 1450
+        histories = dict((imei, store.history(imei))
+                         for imei in store.imeis())
+
+        def scan(location, radius, activities=None):
+            matches = []
+            for imei, history in histories.iteritems():
+                distances = geodesic.haversine(location[0], location[1],
+                                               history['latitude'],
+                                               history['longitude'])
+                for position, distance in enumerate(distances.tolist()):
+                    if distance <= radius and (activities is None or
+                                               history['activity'][position]
+                                               in activities):
+                        matches.append((distance, imei, position))
+            return sorted(matches)
+
+        for location, radius in (((60.17, 24.94), 500.0),
+                                 ((60.2, 24.9), 3000.0),
+                                 ((0.0, 180.0), 1500.0),
+                                 ((0.0, 179.99), 10.0)):
+            expected = scan(location, radius)
+            assert sorted(index.within(location, radius)) == expected
+            assert index.nearest(location, 7) == \
+                scan(location, 1e7)[:7]
+            assert sorted(index.within(location, radius,
+                                       activities=['Running'])) == \
+                scan(location, radius, [2])
+        assert len(scan((0.0, 180.0), 1500.0)) > 0
+        assert [user_state.location for user_state
+                in index.states(index.nearest((0.0, -179.99), 3))] == \
+            [(history['latitude'], history['longitude'])
+             for history in [histories[imei][position]
+                             for _, imei, position
+                             in scan((0.0, -179.99), 1e7)[:3]]]
+    finally:
+        shutil.rmtree(directory)
+
+
+def killed_run(run):
+    """
+    Calls run in a child process, which it must kill with SIGKILL.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run()
+        finally:
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGKILL
+
+
+def test_checkpoint_resume():
+    """
+    Kills incremental parsings midway through a batch and while committing
+    one, the last commit being torn, and checks that resuming them stores
+    every row exactly once, in files which read back.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(directory, 'rows.csv')
+        write_csv(file_path, 5000, imeis=7, songs=30)
+        stores = (('pickles', lambda path: UserStateWriter(
+                      path, buffer_size=4096, member_size=16384)),
+                  ('columns', lambda path: ColumnarStore(path,
+                                                         buffer_size=100)))
+
+        def kill_at_write(store, writes):
+            write = store.write
+            def killing_write(user_state):
+                write(user_state)
+                killing_write.calls += 1
+                if killing_write.calls == writes:
+                    os.kill(os.getpid(), signal.SIGKILL)
+            killing_write.calls = 0
+            store.write = killing_write
+
+        def kill_at_commit(store, commits):
+            commit = store.commit
+            def killing_commit():
+                paths = store.pending_paths()
+                commit()
+                killing_commit.calls += 1
+                if killing_commit.calls == commits:
+                    with open(paths[0], 'r+b') as output_file:
+                        output_file.truncate(os.path.getsize(paths[0]) - 3)
+                    os.kill(os.getpid(), signal.SIGKILL)
+            killing_commit.calls = 0
+            store.commit = killing_commit
+
+        for name, open_store in stores:
+            for kill, argument in ((kill_at_write, 2500),
+                                   (kill_at_commit, 3)):
+                output = os.path.join(directory, '%s-%s' % (name, argument))
+                checkpoint_path = output + '.checkpoint'
+                os.makedirs(output)
+
+                def run():
+                    store = open_store(output)
+                    kill(store, argument)
+                    parser_module.parse_csv_incremental(
+                        file_path, checkpoint_path, store=store,
+                        batch_size=1000)
+
+                with FakeDiscogs():
+                    killed_run(run)
+                    with open_store(output) as store:
+                        parser_module.parse_csv_incremental(
+                            file_path, checkpoint_path, store=store,
+                            batch_size=1000)
+                if isinstance(store, ColumnarStore):
+                    store = ColumnarStore(output)
+                    assert sum(len(list(store.states(imei)))
+                               for imei in store.imeis()) == 5000
+                else:
+                    paths = glob.glob(os.path.join(output, '*.pkl.gz'))
+                    assert len(paths) == 7
+                    assert sum(len(list(UserStateReader(path)))
+                               for path in paths) == 5000
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_tests():
+    """
+    Runs the test_* functions, in the order they are defined.
+    """
+    tests = sorted((function.func_code.co_firstlineno, name, function)
+                   for name, function in globals().items()
+                   if name.startswith('test_') and callable(function))
+    for _, name, function in tests:
+        function()
+        print '%s passed' % name
+    print '%d tests passed' % len(tests)
+
+
 if __name__ == '__main__':
-    main()
+    if '--network' in sys.argv[1:]:
+        main()
+    else:
+        run_tests()
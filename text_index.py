@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Text Index Module for the Recommendation System.
+
+Offline resolution of the query strings to Discogs release ids, through an
+in-memory inverted index over the names of the known releases, see
+song.TEXT_INDEX. The index is built from a release database (see
+release_db) and the release ids of a metadata cache, and learns the ones
+found on Discogs while parsing.
+
+Usage: text_index.py [options] <index file>
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import math
+import logging
+import threading
+import cPickle as pkl
+from array import array
+from optparse import OptionParser
+
+import numpy as np
+
+from song import normalize_query_string
+from release_db import ReleaseDatabase
+from cache import MetadataCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class TextIndex(object):
+    """
+    Inverted index from the tokens of the normalized query strings (see
+    song.normalize_query_string) to the releases, ranked with BM25.
+
+    A query string whose normalized form is the one of an indexed text is
+    answered by a dict lookup. The others are scored against the documents
+    holding any of their tokens, using NumPy over the posting arrays of the
+    tokens, rarest first. The index can be shared between threads.
+
+    Parameters
+    ----------
+    file_path           : str
+                        The path of the file the index is persisted in,
+                        loaded if it exists. If None, the index only lives
+                        in memory.
+    k1                  : float
+                        The BM25 term frequency saturation.
+    b                   : float
+                        The BM25 document length normalization.
+    min_coverage        : float
+                        The minimum share of the inverse document frequency
+                        of its tokens a document must share with the query,
+                        and the query with the document, for release_id to
+                        return it.
+    common_size         : int
+                        The number of documents beyond which a token is
+                        only scored over the documents holding a rarer
+                        token of the query, if any, which bounds the time of
+                        a search.
+
+    Attributes
+    ----------
+    exact               : dict
+                        The release id of each indexed text.
+    keys                : list of str
+                        The indexed text of each document.
+    release_ids         : array
+                        The release id of each document.
+    lengths             : array
+                        The number of tokens of each document.
+    postings            : dict
+                        The (documents, frequencies) arrays of each token.
+    """
+
+    VERSION = 2
+
+    def __init__(self, file_path=None, k1=1.2, b=0.75, min_coverage=0.6,
+                 common_size=10000):
+        if not 0.0 <= min_coverage <= 1.0:
+            raise Exception('Given minimum coverage is not between 0 and 1.')
+        self.file_path = file_path
+        self.k1 = k1
+        self.b = b
+        self.min_coverage = min_coverage
+        self.common_size = common_size
+        self.exact = {}
+        self.keys = []
+        self.release_ids = array('l')
+        self.lengths = array('i')
+        self.postings = {}
+        self.total_length = 0
+        self.lock = threading.Lock()
+        if file_path is not None and os.path.exists(file_path):
+            self.load()
+
+    def __len__(self):
+        return len(self.release_ids)
+
+    def add(self, release_id, text):
+        """
+        Indexes the text, such as an 'artist - title' name or a query
+        string, as a document of the release. Texts already indexed are
+        skipped.
+        """
+        key = normalize_query_string(text)
+        if not key:
+            return
+        with self.lock:
+            if key in self.exact:
+                return
+            self.exact[key] = release_id
+            tokens = key.split()
+            document = len(self.release_ids)
+            self.keys.append(key)
+            self.release_ids.append(release_id)
+            self.lengths.append(len(tokens))
+            self.total_length += len(tokens)
+            for token in set(tokens):
+                documents, frequencies = self.postings.setdefault(
+                    token, (array('i'), array('B')))
+                documents.append(document)
+                frequencies.append(min(tokens.count(token), 255))
+
+    def add_release_database(self, release_db):
+        """
+        Indexes the releases of a release_db.ReleaseDatabase.
+        """
+        for release_id, key in release_db.documents():
+            self.add(release_id, key)
+
+    def add_cache(self, cache):
+        """
+        Indexes the query strings of a cache.MetadataCache.
+        """
+        with cache.lock:
+            items = [(query_string, release_id) for query_string,
+                     (_, release_id) in cache.release_ids.iteritems()]
+        for query_string, release_id in items:
+            self.add(release_id, query_string)
+
+    def search(self, query_string, count=10):
+        """
+        Ranks the documents holding any token of the query string.
+
+        Parameters
+        ----------
+        query_string        : str
+                            The query string.
+        count               : int
+                            The maximum number of documents returned.
+
+        Returns
+        -------
+        Returns the list of the (score, coverage, release id) triples of the
+        count best documents, best first. The coverage is the lowest of the
+        shares of the inverse document frequency of the tokens of the
+        document the query holds, and of the tokens of the query the
+        document holds: the common words a query has in excess, such as
+        '(Live)', barely lower it, while a short document matching a word
+        of a longer title does not cover it.
+        """
+        tokens = set(normalize_query_string(query_string).split())
+        if not tokens or count < 1:
+            return []
+        with self.lock:
+            total = len(self.release_ids)
+            if total == 0:
+                return []
+            lengths = np.frombuffer(self.lengths, dtype=np.int32)
+            average_length = float(self.total_length) / total
+            found = []
+            idfs = {}
+            for token in tokens:
+                postings = self.postings.get(token)
+                count_found = len(postings[0]) if postings is not None else 0
+                idf = idfs[token] = math.log(1.0 + (total - count_found +
+                                                    0.5) / (count_found + 0.5))
+                if count_found:
+                    found.append((count_found, idf, postings))
+            # Rarest tokens first, so that the common ones are only scored
+            # over the documents holding a rarer one
+            found.sort(key=lambda entry: entry[0])
+            candidates = None
+            matches = []
+            for count_found, idf, (documents, frequencies) in found:
+                documents = np.frombuffer(documents, dtype=np.int32)
+                frequencies = np.frombuffer(frequencies, dtype=np.uint8)
+                if count_found > self.common_size and candidates is not None:
+                    # The documents of a token are in increasing order
+                    positions = np.minimum(
+                        np.searchsorted(documents, candidates),
+                        count_found - 1)
+                    held = documents[positions] == candidates
+                    documents = candidates[held]
+                    frequencies = frequencies[positions[held]]
+                scores = idf * frequencies * (self.k1 + 1) / (
+                    frequencies + self.k1 * (1 - self.b + self.b *
+                                             lengths[documents] /
+                                             average_length))
+                matches.append((documents, scores))
+                candidates = documents if candidates is None \
+                    else np.union1d(candidates, documents)
+            if not matches:
+                return []
+            documents, inverse = np.unique(
+                np.concatenate([match[0] for match in matches]),
+                return_inverse=True)
+            scores = np.bincount(inverse, np.concatenate(
+                [match[1] for match in matches]))
+            count = min(count, len(documents))
+            best = np.argpartition(-scores, count - 1)[:count]
+            best = best[np.argsort(-scores[best], kind='mergesort')]
+            return [(float(scores[index]),
+                     self._coverage(self.keys[documents[index]], idfs,
+                                    total),
+                     self.release_ids[documents[index]]) for index in best]
+
+    def _coverage(self, key, idfs, total):
+        """
+        Returns the lowest of the shares of the inverse document frequency
+        of the tokens of the indexed text the query tokens hold, and of the
+        query tokens, whose inverse document frequencies are given, the
+        indexed text holds.
+        """
+        held = 0.0
+        weight = 0.0
+        key_tokens = set(key.split())
+        for token in key_tokens:
+            found = len(self.postings[token][0])
+            idf = math.log(1.0 + (total - found + 0.5) / (found + 0.5))
+            weight += idf
+            if token in idfs:
+                held += idf
+        if not weight:
+            return 0.0
+        query_held = sum(idf for token, idf in idfs.iteritems()
+                         if token in key_tokens)
+        return min(held / weight, query_held / sum(idfs.itervalues()))
+
+    def release_id(self, query_string):
+        """
+        Returns the release id of the query string: the one of the same
+        normalized text if indexed, of the best ranked document with a
+        coverage of at least min_coverage otherwise, None if there is none.
+        """
+        release_id = self.exact.get(normalize_query_string(query_string))
+        if release_id is not None:
+            return release_id
+        for _, coverage, release_id in self.search(query_string):
+            if coverage >= self.min_coverage:
+                return release_id
+        return None
+
+    def load(self):
+        """
+        Loads the index from file_path, replacing the current one.
+        """
+        with open(self.file_path, 'rb') as index_file:
+            content = pkl.load(index_file)
+        if content.get('version') != self.VERSION:
+            raise Exception('Index file has an unsupported version.')
+        with self.lock:
+            self.keys = content['keys']
+            self.release_ids = array('l', content['release_ids'])
+            self.exact = dict(zip(self.keys, self.release_ids))
+            self.lengths = array('i', content['lengths'])
+            self.postings = dict(
+                (token, (array('i', documents), array('B', frequencies)))
+                for token, (documents, frequencies)
+                in content['postings'].iteritems())
+            self.total_length = sum(self.lengths)
+
+    def save(self):
+        """
+        Writes the index to file_path, replacing it atomically.
+        """
+        if self.file_path is None:
+            raise Exception('Index has no file path to be saved to.')
+        with self.lock:
+            content = {'version': self.VERSION,
+                       'keys': self.keys,
+                       'release_ids': self.release_ids.tostring(),
+                       'lengths': self.lengths.tostring(),
+                       'postings': dict(
+                           (token, (documents.tostring(),
+                                    frequencies.tostring()))
+                           for token, (documents, frequencies)
+                           in self.postings.iteritems()),
+                      }
+            temp_path = self.file_path + '.tmp'
+            with open(temp_path, 'wb') as index_file:
+                pkl.dump(content, index_file, pkl.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.file_path)
+
+
+def main():
+    """
+    Builds or extends a text index from a release database and metadata
+    caches.
+
+    Usage: text_index.py [options] <index file>
+    """
+    option_parser = OptionParser(usage='%prog [options] <index file>')
+    option_parser.add_option('-D', '--release-db', dest='release_db',
+                             help='release database indexed')
+    option_parser.add_option('-c', '--cache', dest='caches', default=[],
+                             action='append',
+                             help='metadata cache file indexed, can be '
+                                  'repeated')
+    options, args = option_parser.parse_args()
+    if len(args) != 1:
+        option_parser.error('Expected exactly one index file.')
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: '
+                               '%(message)s')
+    index = TextIndex(args[0])
+    if options.release_db is not None:
+        index.add_release_database(ReleaseDatabase(options.release_db))
+    for cache_path in options.caches:
+        index.add_cache(MetadataCache(cache_path))
+    index.save()
+    logger.info('Indexed %d documents, %d tokens.', len(index),
+                len(index.postings))
+
+
+if __name__ == '__main__':
+    main()
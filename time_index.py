@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Time Index Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import bisect
+from datetime import timedelta
+
+import numpy as np
+
+from store import ColumnarStore, encode_timestamp, decode_timestamp
+
+
+class TimeIndex(object):
+    """
+    Sorted timestamp index over the histories of a store.ColumnarStore,
+    answering time range queries in O(log n + k).
+
+    The index keeps, for every IMEI, the timestamps of its records in sorted
+    order along with their positions in the history, and the same for all
+    the IMEIs together. It registers itself as a listener of the store, so
+    that it is kept up to date on every write. Records written in time order
+    are appended to the index of their IMEI in constant time, late ones are
+    inserted with bisect. The index of all the IMEIs is kept in sorted
+    arrays: new records are kept aside, and merged into them in batches
+    once there are enough of them or on the next global query.
+
+    Parameters
+    ----------
+    store               : store.ColumnarStore
+                        The store to index. Its existing histories are
+                        indexed on creation.
+    merge_size          : int
+                        The minimum number of new records merged at once
+                        into the index of all the IMEIs.
+    """
+
+    def __init__(self, store, merge_size=65536):
+        if not isinstance(store, ColumnarStore):
+            raise Exception('Given store is not a ColumnarStore object.')
+        self.store = store
+        self.merge_size = merge_size
+        self.timestamps = {}
+        self.positions = {}
+        self.imei_codes = {}
+        self.imeis = []
+        self.global_timestamps = np.zeros(0, dtype=np.int64)
+        self.global_codes = np.zeros(0, dtype=np.int32)
+        self.global_positions = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_count = 0
+        for imei in store.imeis():
+            self.add(imei, store.history(imei), 0)
+        self._merge()
+        store.add_listener(self)
+
+    def add(self, imei, records, start):
+        """
+        Indexes the RECORD array written for the IMEI, start being the
+        position of its first record in the history.
+        """
+        if not len(records):
+            return
+        timestamps = self.timestamps.setdefault(imei, [])
+        positions = self.positions.setdefault(imei, [])
+        for offset, timestamp in enumerate(records['timestamp'].tolist()):
+            position = start + offset
+            if not timestamps or timestamp >= timestamps[-1]:
+                timestamps.append(timestamp)
+                positions.append(position)
+            else:
+                index = bisect.bisect_right(timestamps, timestamp)
+                timestamps.insert(index, timestamp)
+                positions.insert(index, position)
+        code = self.imei_codes.get(imei)
+        if code is None:
+            code = self.imei_codes[imei] = len(self.imeis)
+            self.imeis.append(imei)
+        self.pending.append((records['timestamp'].astype(np.int64),
+                             np.full(len(records), code, dtype=np.int32),
+                             np.arange(start, start + len(records),
+                                       dtype=np.int64)))
+        self.pending_count += len(records)
+        if self.pending_count >= max(self.merge_size,
+                                     len(self.global_timestamps) // 8):
+            self._merge()
+
+    def range(self, imei, start, end):
+        """
+        Returns the positions, in the history of the IMEI, of the records
+        with a timestamp in [start, end), in time order.
+
+        Parameters
+        ----------
+        imei                : str
+                            The IMEI of the user.
+        start               : datetime.datetime
+                            The beginning of the time window.
+        end                 : datetime.datetime
+                            The end of the time window, excluded.
+
+        Returns
+        -------
+        Returns an int array of positions.
+        """
+        timestamps = self.timestamps.get(imei, [])
+        low = bisect.bisect_left(timestamps, encode_timestamp(start))
+        high = bisect.bisect_left(timestamps, encode_timestamp(end))
+        return np.array(self.positions[imei][low:high] if high > low else [],
+                        dtype=np.intp)
+
+    def last(self, imei, duration, now=None):
+        """
+        Returns the positions of the records of the IMEI in the duration
+        preceding now, now included, in time order.
+
+        Parameters
+        ----------
+        duration            : datetime.timedelta
+                            The length of the time window.
+        now                 : datetime.datetime
+                            The end of the time window, defaults to the
+                            timestamp of the latest record of the IMEI.
+        """
+        if now is None:
+            timestamps = self.timestamps.get(imei)
+            if not timestamps:
+                return np.zeros(0, dtype=np.intp)
+            now = decode_timestamp(timestamps[-1])
+        return self.range(imei, now - duration, now + timedelta(seconds=1))
+
+    def columns(self, imei, start, end):
+        """
+        Returns the RECORD array of the records of the IMEI with a timestamp
+        in [start, end), in time order. For histories written in time order
+        the array is a view on the memory-mapped history.
+        """
+        positions = self.range(imei, start, end)
+        history = self.store.history(imei)
+        if len(positions) and \
+                positions[-1] - positions[0] == len(positions) - 1 and \
+                (np.diff(positions) == 1).all():
+            return history[positions[0]:positions[-1] + 1]
+        return history[positions]
+
+    def states(self, imei, start, end):
+        """
+        Iterates over the user states of the IMEI with a timestamp in
+        [start, end), in time order.
+        """
+        return self.store.states(imei, self.columns(imei, start, end))
+
+    def global_range(self, start, end):
+        """
+        Returns the (imei, position) couples of the records of all the IMEIs
+        with a timestamp in [start, end), in time order.
+        """
+        self._merge()
+        low, high = np.searchsorted(self.global_timestamps,
+                                    [encode_timestamp(start),
+                                     encode_timestamp(end)]).tolist()
+        if high <= low:
+            return []
+        imeis = self.imeis
+        return [(imeis[code], position) for code, position
+                in zip(self.global_codes[low:high].tolist(),
+                       self.global_positions[low:high].tolist())]
+
+    def global_columns(self, start, end):
+        """
+        Returns a dict mapping the IMEIs with records in [start, end) to the
+        RECORD arrays of these records, in time order.
+        """
+        positions = {}
+        for imei, position in self.global_range(start, end):
+            positions.setdefault(imei, []).append(position)
+        return dict((imei, self.store.history(imei)[np.array(imei_positions)])
+                    for imei, imei_positions in positions.iteritems())
+
+    def global_states(self, start, end):
+        """
+        Iterates over the user states of all the IMEIs with a timestamp in
+        [start, end), in time order.
+        """
+        histories = {}
+        for imei, position in self.global_range(start, end):
+            if imei not in histories:
+                histories[imei] = self.store.history(imei)
+            for user_state in self.store.states(
+                    imei, histories[imei][position:position + 1]):
+                yield user_state
+
+    def _merge(self):
+        """
+        Merges the new records into the sorted arrays of all the IMEIs, after
+        the indexed records of the same timestamp.
+        """
+        if not self.pending:
+            return
+        timestamps, codes, positions = [np.concatenate(column) for column
+                                        in zip(*self.pending)]
+        order = np.argsort(timestamps, kind='mergesort')
+        timestamps = timestamps[order]
+        indices = np.searchsorted(self.global_timestamps, timestamps,
+                                  side='right')
+        self.global_timestamps = np.insert(self.global_timestamps, indices,
+                                           timestamps)
+        self.global_codes = np.insert(self.global_codes, indices,
+                                      codes[order])
+        self.global_positions = np.insert(self.global_positions, indices,
+                                          positions[order])
+        self.pending = []
+        self.pending_count = 0
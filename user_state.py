@@ -11,14 +11,15 @@ import numpy as np
 from geopy.distance import vincenty
 import cPickle as pkl
 import gzip,contextlib
+import struct
 
 
 import discogs_client as discogs
 discogs.user_agent = 'MyRecommendationSystem/0.1'
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from song import Song
+from song import Song, intern_song
 
 
 class UserState(object):
@@ -32,8 +33,19 @@ class UserState(object):
                     query_string for that song, and the integer is the release
                     id of the master release associated to it.
 
+    UserState objects are immutable. To keep millions of them in memory, the
+    IMEI is interned, and the location, timestamp and activity are packed
+    together in a single RECORD string, decoded on access. The timestamp is
+    a naive datetime, taken as UTC.
+
+    They pickle as (VERSION, imei, record, song) tuples. The plain
+    attribute dicts of the pickles written before are still loaded.
     """
 
+    __slots__ = ('imei', 'song', '_record')
+
+    VERSION = 1
+
     def __init__(self, imei, activity, location, timestamp, song):
         # Verify some things about the arguments
         # The IMEI should be a 15 digit number
@@ -44,7 +56,7 @@ class UserState(object):
                                                         (15 digits).')
         # The activity should belong to the list of possible activities
 
-        if activity not in ACTIVITIES.keys():
+        if activity not in ACTIVITIES:
             raise Exception('Given activity is not recognized.')
         # The location needs to be a couple of floats
         if not isinstance(location, tuple):
@@ -59,11 +71,47 @@ class UserState(object):
         if not isinstance(song, Song):
             raise Exception('Given song is not a Song object.')
         # Initialize the object
-        self.imei = imei
-        self.activity = activity
-        self.location = location
-        self.timestamp = timestamp
-        self.song = song
+        object.__setattr__(self, 'imei', intern(imei))
+        object.__setattr__(self, 'song', song)
+        object.__setattr__(self, '_record',
+                           _encode(activity, location, timestamp))
+
+    def __setattr__(self, name, value):
+        raise Exception('UserState objects are immutable.')
+
+    def __delattr__(self, name):
+        raise Exception('UserState objects are immutable.')
+
+    def __getstate__(self):
+        return (self.VERSION, self.imei, self._record, self.song)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickles written before the slots, whose song is not interned
+            state = (self.VERSION, state['imei'],
+                     _encode(state['activity'], state['location'],
+                             state['timestamp']),
+                     intern_song(state['song'].query_string, lazy=True))
+        version, imei, record, song = state
+        if version != self.VERSION:
+            raise Exception('Given user state pickle version is not \
+                supported.')
+        object.__setattr__(self, 'imei', intern(imei))
+        object.__setattr__(self, 'song', song)
+        object.__setattr__(self, '_record', record)
+
+    @property
+    def activity(self):
+        return ACTIVITY_NAMES[RECORD.unpack(self._record)[4]]
+
+    @property
+    def location(self):
+        return RECORD.unpack(self._record)[:2]
+
+    @property
+    def timestamp(self):
+        _, _, seconds, microseconds, _ = RECORD.unpack(self._record)
+        return EPOCH + timedelta(seconds=seconds, microseconds=microseconds)
 
     def distance(self, userstate2):
         """
@@ -71,10 +119,15 @@ class UserState(object):
         """
         return distance_user_states(self, userstate2)
 
-    def write(self):
+    def write(self, store=None):
         """
         Writes the user state to the disk.
+        If a store.UserStateStore is given, such as a writer.UserStateWriter
+        or a store.ColumnarStore, the user state is written to it instead.
         """
+        if store is not None:
+            store.write(self)
+            return
         with contextlib.closing(gzip.GzipFile(str(self.imei)+'.pkl.gz', 'ab')) as write_file:
             pkl.dump(self, write_file)
 
@@ -114,7 +167,9 @@ def distance_user_states(userstate1, userstate2):
 def distance_locations(location1, location2):
     """
     Calculates the distance between two GPS locations.
-    Uses the geopy module for Vincenty's formula.
+    Uses geopy for Vincenty's formula, which is faster than NumPy for a
+    single couple; see geodesic.one_to_many and geodesic.many_to_many to
+    compare many locations at once.
     Returns a distance in meters.
 
     Parameters
@@ -191,3 +246,23 @@ ACTIVITIES = {'Standing':   0,
               'Walking':    1,
               'Running': 2
               }
+
+# Activities by code
+ACTIVITY_NAMES = dict((code, intern(name)) for name, code
+                      in ACTIVITIES.iteritems())
+
+# Packed fields of a user state: latitude, longitude, seconds and
+# microseconds since EPOCH, activity code
+RECORD = struct.Struct('<ddqib')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _encode(activity, location, timestamp):
+    """
+    Returns the RECORD string of the fields of a user state.
+    """
+    delta = timestamp - EPOCH
+    return RECORD.pack(location[0], location[1],
+                       delta.days * 86400 + delta.seconds, delta.microseconds,
+                       ACTIVITIES[activity])
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Writer Module for the Recommendation System.
+
+@author: ymiche
+@version: 0.1
+"""
+
+import os
+import time
+import gzip
+import cPickle as pkl
+from collections import OrderedDict
+
+from store import UserStateStore
+from metrics import METRICS
+
+
+class UserStateWriter(UserStateStore):
+    """
+    Buffered writer of user states to their per-IMEI '<imei>.pkl.gz' files.
+
+    The pickled states are buffered in memory and written out by size or by
+    time. The gzip streams of the files are kept open in a pool of
+    max_open_files, the least recently used one being closed when a new
+    file has to be opened, so that consecutive flushes to a file go to the
+    same gzip member, up to member_size bytes: a member is closed once it
+    holds that many, so that reader.UserStateReader reads the latest states
+    of a long history without decoding all of it. Use it as a context manager, or call close(): every
+    buffered state is written and every stream closed, on error as well, so
+    that no truncated gzip member is left behind.
+
+    The files hold the same stream of pickled UserState objects as the ones
+    written by UserState.write.
+
+    Parameters
+    ----------
+    directory           : str
+                        The directory in which the files are written.
+    max_open_files      : int
+                        The maximum number of gzip streams kept open.
+    buffer_size         : int
+                        The number of pickled bytes buffered before a flush.
+    flush_interval      : float
+                        The maximum time, in seconds, between two flushes.
+    compresslevel       : int
+                        The gzip compression level.
+    member_size         : int
+                        The number of uncompressed bytes beyond which the
+                        gzip member of a file is closed.
+
+    Attributes
+    ----------
+    bytes_pickled       : int
+                        The number of uncompressed bytes written.
+    open_bytes          : dict
+                        The number of uncompressed bytes written to the
+                        gzip member of each open stream.
+    flush_count         : int
+                        The number of flushes done.
+    states_written      : int
+                        The number of user states written.
+    """
+
+    def __init__(self, directory='.', max_open_files=64, buffer_size=1 << 20,
+                 flush_interval=5.0, compresslevel=9, member_size=1 << 20):
+        if max_open_files < 1:
+            raise Exception('Given maximum number of open files is smaller \
+                than one.')
+        self.directory = directory
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+        self.member_size = member_size
+        self.streams = OrderedDict()
+        self.buffers = {}
+        self.buffered_bytes = 0
+        self.last_flush = time.time()
+        self.bytes_pickled = 0
+        self.flush_count = 0
+        self.states_written = 0
+        self.open_bytes = {}
+        self._closed_bytes = 0
+        self._closed_pickled = 0
+        self._reported_bytes = 0
+        self.closed = False
+
+    def path(self, imei):
+        """
+        Returns the path of the file of the given IMEI.
+        """
+        return os.path.join(self.directory, str(imei) + '.pkl.gz')
+
+    def write(self, user_state):
+        """
+        Buffers the user state, flushing the buffers if they are full or if
+        the last flush is older than flush_interval.
+        """
+        if self.closed:
+            raise Exception('Writer is closed.')
+        data = pkl.dumps(user_state, pkl.HIGHEST_PROTOCOL)
+        self.buffers.setdefault(user_state.imei, []).append(data)
+        self.buffered_bytes += len(data)
+        self.states_written += 1
+        if self.deferred:
+            return
+        if self.buffered_bytes >= self.buffer_size or \
+                time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all the buffered states to their gzip streams.
+        """
+        for imei, chunks in self.buffers.iteritems():
+            pending = []
+            size = self.open_bytes.get(imei, 0)
+            for data in chunks:
+                pending.append(data)
+                size += len(data)
+                if size >= self.member_size:
+                    self._write(imei, ''.join(pending))
+                    self._close_stream(imei)
+                    pending = []
+                    size = 0
+            if pending:
+                self._write(imei, ''.join(pending))
+        self.buffers = {}
+        self.buffered_bytes = 0
+        self.last_flush = time.time()
+        self.flush_count += 1
+        self._report_bytes()
+
+    def commit(self):
+        """
+        Flushes the buffers and closes the open streams, so that the gzip
+        members written so far are complete.
+        """
+        self.flush()
+        while self.streams:
+            self._close_stream(self.streams.keys()[0])
+        self._report_bytes()
+
+    def pending_paths(self):
+        """
+        Returns the paths of the files with buffered states or an open
+        stream.
+        """
+        return [self.path(imei) for imei
+                in set(self.buffers) | set(self.streams)]
+
+    def close(self):
+        """
+        Flushes the buffers and closes all the open streams.
+        """
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            while self.streams:
+                self._close_stream(self.streams.keys()[0])
+            self.closed = True
+            self._report_bytes()
+
+    def bytes_written(self):
+        """
+        Returns the number of compressed bytes of the gzip members closed
+        so far. The size of the open members is only known once they are
+        closed, zlib holding back part of their compressed data.
+        """
+        return self._closed_bytes
+
+    def stats(self):
+        """
+        Returns a dict with the write statistics.
+        """
+        bytes_written = self.bytes_written()
+        return {'states_written': self.states_written,
+                'bytes_pickled': self.bytes_pickled,
+                'bytes_written': bytes_written,
+                'bytes_open': sum(self.open_bytes.itervalues()),
+                'flush_count': self.flush_count,
+                'compression_ratio': float(self._closed_pickled) /
+                                     bytes_written if bytes_written else 0.0,
+                'open_files': len(self.streams),
+               }
+
+    def _stream(self, imei):
+        """
+        Returns the open (raw file, gzip stream, start offset) of the IMEI,
+        opening it if needed.
+        """
+        stream = self.streams.pop(imei, None)
+        if stream is None:
+            while len(self.streams) >= self.max_open_files:
+                self._close_stream(self.streams.keys()[0])
+            raw_file = open(self.path(imei), 'ab')
+            raw_file.seek(0, os.SEEK_END)
+            start = raw_file.tell()
+            gzip_file = gzip.GzipFile(filename='', mode='ab',
+                                      compresslevel=self.compresslevel,
+                                      fileobj=raw_file)
+            stream = (raw_file, gzip_file, start)
+            self.open_bytes[imei] = 0
+        # Re-inserting moves the stream to the most recently used end
+        self.streams[imei] = stream
+        return stream
+
+    def _write(self, imei, data):
+        self._stream(imei)[1].write(data)
+        self.bytes_pickled += len(data)
+        self.open_bytes[imei] += len(data)
+
+    def _report_bytes(self):
+        """
+        Adds the compressed bytes of the members closed since the last call
+        to the bytes_written counter of metrics.METRICS.
+        """
+        bytes_written = self.bytes_written()
+        METRICS.increment('bytes_written',
+                          bytes_written - self._reported_bytes)
+        self._reported_bytes = bytes_written
+
+    def _close_stream(self, imei):
+        raw_file, gzip_file, start = self.streams.pop(imei)
+        try:
+            gzip_file.close()
+            self._closed_bytes += raw_file.tell() - start
+            self._closed_pickled += self.open_bytes[imei]
+        finally:
+            del self.open_bytes[imei]
+            raw_file.close()